@@ -4,4 +4,13 @@ Tools for extracting spectra from 2D images
 
 ### from ex1d import ex1d
 from ex2d import ex2d
-
+from patch import Patch, plan_patches, extract_patch, profile_summary
+from patch import estimate_patch_memory, split_patch
+from scheduler import extract_patches
+from resolution import ResolutionMatrix
+from checkpoint import Checkpoint, input_hash
+from tune import tune_patches
+from model import ModelImage
+from cache import PatchCache
+from xprofile import ProfileTable
+from rectify import RectifiedImage, rectify
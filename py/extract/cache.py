@@ -0,0 +1,121 @@
+"""
+Local cache of extracted patches keyed by the hash of their inputs
+
+A patch's core flux, ivar, and resolution diagonals depend only upon its
+image and ivar subregion, the PSF, its wavelengths and spectra, and the
+extraction parameters.  PatchCache stores each result in a .npz file named
+by the hash of those inputs, so that rerunning an extraction after
+changing some of them only recomputes the patches that actually changed.
+The least recently used files are evicted to keep the cache within a size
+limit.
+"""
+
+import os
+import tempfile
+import numpy as N
+
+import specter
+from specter.util import input_hash
+from specter.extract.patch import estimate_patch_memory
+
+class PatchCache(object):
+    """
+    Directory of cached patch results with least recently used eviction
+    """
+    def __init__(self, directory, psfhash, max_bytes=None):
+        """
+        directory : cache directory, created if needed
+        psfhash : hash of the PSF, which the cache can't hash itself,
+            e.g. input_hash('file:'+psffile)
+        max_bytes : if set, evict the least recently used results when
+            the cache is larger than this
+        """
+        if not psfhash:
+            raise ValueError, "PatchCache requires a PSF hash"
+        self.directory = directory
+        self.psfhash = psfhash
+        self.max_bytes = max_bytes
+        self.nhit = 0
+        self.nmiss = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._nbytes = sum([os.path.getsize(f) for f in self._files()])
+
+    def _files(self):
+        return [os.path.join(self.directory, f)
+                for f in os.listdir(self.directory) if f.endswith('.npz')]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def key(self, img, imgivar, patch, ndiag, regularize, fibermask=None,
+            max_memory=None, mixed_precision=False):
+        """
+        Return the cache key of patch extracted from img, imgivar with
+        extract_patch options ndiag, regularize, fibermask, max_memory,
+        and mixed_precision
+        """
+        xmin, xmax, ymin, ymax = patch.xyrange
+        speclo, spechi = patch.specrange
+        if fibermask is not None:
+            fibermask = N.asarray(fibermask[speclo:spechi])
+        #- max_memory only changes the results of patches that it splits
+        if max_memory is not None and estimate_patch_memory(patch) <= max_memory:
+            max_memory = None
+        return input_hash(specter.__version__, self.psfhash,
+            img[ymin:ymax, xmin:xmax], imgivar[ymin:ymax, xmin:xmax],
+            tuple(patch.xyrange), patch.specrange, patch.ww, patch.nlo,
+            patch.ncore, ndiag, regularize, fibermask, max_memory,
+            bool(mixed_precision))
+
+    def get(self, key):
+        """
+        Return cached (flux, ivar, Rd) for key, or None if it isn't cached
+        """
+        path = self._path(key)
+        try:
+            with N.load(path) as data:
+                result = (data['flux'], data['ivar'], data['Rd'])
+        except (IOError, KeyError, ValueError):
+            self.nmiss += 1
+            return None
+        #- Mark as recently used
+        os.utime(path, None)
+        self.nhit += 1
+        return result
+
+    def put(self, key, flux, ivar, Rd):
+        """
+        Cache results flux[nspec, ncore], ivar[nspec, ncore], and
+        Rd[nspec, 2*ndiag+1, ncore] under key
+        """
+        #- Write to a temporary file and rename so that readers never see
+        #- a partial file
+        fd, tmpfile = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as fx:
+            N.savez(fx, flux=flux, ivar=ivar, Rd=Rd)
+        path = self._path(key)
+        if os.path.exists(path):
+            self._nbytes -= os.path.getsize(path)
+        os.rename(tmpfile, path)
+        self._nbytes += os.path.getsize(path)
+
+        if self.max_bytes is not None and self._nbytes > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used results until the cache is no
+        larger than max_bytes
+        """
+        files = sorted(self._files(), key=os.path.getmtime)
+        self._nbytes = sum([os.path.getsize(f) for f in files])
+        for path in files:
+            if self._nbytes <= max_bytes:
+                break
+            size = os.path.getsize(path)
+            try:
+                os.remove(path)
+                self._nbytes -= size
+            except OSError:
+                pass
@@ -0,0 +1,198 @@
+"""
+Append-only checkpoint of completed extraction patches
+
+The checkpoint is a FITS file whose primary header records a hash of the
+extraction inputs, followed by one image HDU per completed patch holding
+the core flux, ivar, and resolution diagonals for that patch.  Patches are
+appended as they finish so that an interrupted extraction can resume
+without redoing completed patches.
+"""
+
+import os
+import numpy as N
+import fitsio
+
+from specter.util import input_hash
+
+def _header_params(hdr):
+    """
+    Return dictionary of parameters from PNAMEn/PVALUEn header keywords,
+    or None if there are none
+    """
+    if 'NPARAMS' not in hdr:
+        return None
+    params = dict()
+    for i in range(hdr['NPARAMS']):
+        value = hdr['PVALUE{}'.format(i)]
+        #- fitsio reads integers as long, which would change input_hash()
+        if isinstance(value, long):
+            value = int(value)
+        params[hdr['PNAME{}'.format(i)].strip()] = value
+    return params
+
+def read_params(filename):
+    """
+    Return the parameters dictionary recorded in checkpoint filename, or
+    None if the file doesn't exist or no parameters were recorded
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        hdr = fitsio.read_header(filename, 0)
+    except IOError:
+        return None
+    return _header_params(hdr)
+
+def _card(name, value, comment=''):
+    """
+    Return an 80 character FITS header card for an int or string value
+    """
+    if isinstance(value, str):
+        value = "{:20s}".format("'{:8s}'".format(value))
+    else:
+        value = "{:>20d}".format(value)
+    return '{:8s}= {} / {}'.format(name, value, comment)[0:80].ljust(80)
+
+def _image_hdu(data, keys):
+    """
+    Return the bytes of a FITS IMAGE extension holding float64 array data,
+    with extra header keys given as a list of (name, value, comment)
+    """
+    cards = [_card('XTENSION', 'IMAGE', 'IMAGE extension'),
+             _card('BITPIX', -64, 'number of bits per data pixel'),
+             _card('NAXIS', data.ndim, 'number of data axes')]
+    for i, n in enumerate(data.shape[::-1]):
+        cards.append(_card('NAXIS{}'.format(i+1), n, 'length of data axis {}'.format(i+1)))
+    cards += [_card('PCOUNT', 0, 'required keyword; must = 0'),
+              _card('GCOUNT', 1, 'required keyword; must = 1')]
+    cards += [_card(*key) for key in keys]
+    cards.append('END'.ljust(80))
+
+    header = ''.join(cards)
+    header += ' ' * (-len(header) % 2880)
+    pixels = N.ascontiguousarray(data, dtype='>f8').tostring()
+    pixels += '\0' * (-len(pixels) % 2880)
+    return header + pixels
+
+class Checkpoint(object):
+    """
+    Append-only checkpoint file of completed patches
+    """
+    def __init__(self, filename, hashval, params=None):
+        """
+        Open checkpoint filename, creating it if needed
+
+        filename : checkpoint FITS filename
+        hashval : hash of the extraction inputs, e.g. from input_hash();
+            an existing checkpoint with a different hash raises ValueError,
+            and one that can't be read raises IOError
+        params : optional dictionary of extraction parameters to record
+            in a new checkpoint, e.g. automatically tuned values that
+            should be reused when resuming; see read_params()
+
+        self.done is a dictionary of the completed results read from an
+        existing checkpoint, keyed by patch index:
+            done[ipatch] = (flux, ivar, Rd)
+        """
+        self.filename = filename
+        self.hashval = hashval
+        self.params = params
+        self.done = dict()
+
+        if os.path.exists(filename):
+            self._load()
+        else:
+            self._create(filename)
+
+        #- Patches are appended as complete HDUs with plain file writes,
+        #- flushed after each one so that a killed process doesn't lose
+        #- them; fitsio would need to close and reopen the file, rescanning
+        #- every HDU, to do the same
+        self._fx = open(filename, 'ab')
+
+    def _create(self, filename):
+        """
+        Create a new checkpoint file holding just the primary header
+        """
+        fx = fitsio.FITS(filename, 'rw', clobber=True)
+        hdr = [dict(name='CHKHASH', value=self.hashval,
+            comment='hash of extraction inputs')]
+        if self.params is not None:
+            hdr.append(dict(name='NPARAMS', value=len(self.params)))
+            for i, key in enumerate(sorted(self.params)):
+                hdr.append(dict(name='PNAME{}'.format(i), value=key))
+                hdr.append(dict(name='PVALUE{}'.format(i), value=self.params[key]))
+        fx.write(None, header=hdr)
+        fx.close()
+
+    def _load(self):
+        """
+        Read the completed patches from an existing checkpoint file
+        """
+        #- Read-only, since reading a truncated HDU in 'rw' mode silently
+        #- pads the file instead of raising IOError
+        try:
+            fx = fitsio.FITS(self.filename)
+            hdr = fx[0].read_header()
+        except IOError:
+            raise IOError, "Unreadable checkpoint {}".format(self.filename)
+
+        if hdr.get('CHKHASH') != self.hashval:
+            fx.close()
+            raise ValueError, "Checkpoint {} was written for different inputs or options".format(self.filename)
+        self.params = _header_params(hdr)
+
+        #- A crash while appending can leave a truncated final HDU
+        truncated = False
+        for hdu in fx[1:]:
+            try:
+                hdr = hdu.read_header()
+                data = hdu.read()
+            except IOError:
+                truncated = True
+                break
+            self.done[hdr['IPATCH']] = (data[:, 0], data[:, 1], data[:, 2:])
+        fx.close()
+
+        #- Rewrite without the truncated HDU so that appends stay readable;
+        #- the old file is only replaced once the new one is complete
+        if truncated:
+            tmpfile = self.filename + '.tmp'
+            self._create(tmpfile)
+            with open(tmpfile, 'ab') as fx:
+                for ipatch in sorted(self.done):
+                    self._append(fx, ipatch, *self.done[ipatch])
+            os.rename(tmpfile, self.filename)
+
+    def _append(self, fx, ipatch, flux, ivar, Rd):
+        nspec, ndiag2, ncore = Rd.shape
+        data = N.empty( (nspec, ndiag2+2, ncore) )
+        data[:, 0] = flux
+        data[:, 1] = ivar
+        data[:, 2:] = Rd
+        fx.write(_image_hdu(data, [('IPATCH', ipatch, 'patch index')]))
+        fx.flush()
+
+    def add(self, patch, flux, ivar, Rd):
+        """
+        Append results for Patch object patch to the checkpoint
+
+        flux[nspec, ncore], ivar[nspec, ncore], Rd[nspec, 2*ndiag+1, ncore]
+        """
+        self._append(self._fx, patch.ipatch, flux, ivar, Rd)
+
+    def close(self):
+        """
+        Close the checkpoint file
+        """
+        if self._fx is not None:
+            self._fx.close()
+            self._fx = None
+
+    def remove(self):
+        """
+        Remove the checkpoint file, e.g. after the full output is written
+        """
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -3,134 +3,488 @@
 """
 1D Extraction like Horne 1986
 
+Each CCD row is fit as a sum of cross-dispersion profiles, one per
+spectrum, either Gaussians with the PSF xsigma or profiles interpolated from
+a ProfileTable of the actual PSF spots.  Rows are independent, so the profiles and normal equations are
+built for a batch of rows at once.  Only neighboring spectra overlap, so
+the normal equations of each row are banded and are solved together with
+a banded Cholesky factorization vectorized across rows.
+
+Groups of spectra, and optionally chunks of rows within a group, don't
+interact and can be extracted by a pool of processes that read the image
+and mask from shared memory and write into shared output arrays.  An
+Ex1dPool keeps such a pool for repeated calls on the same image.
+
 Stephen Bailey, LBL
 Spring 2013
 """
 
 import sys
 import os
+import multiprocessing as MP
 import numpy as N
 import math
 
-from specter.util import gausspix, weighted_solve
+from specter.util import gaussint
+from specter.util.sharedmem import shared_array, as_shared, is_shared, limit_blas_threads
+
+#- Filled by _set_worker in each worker process (or this process)
+_worker = dict()
+
+def _set_worker(img, mask, psf, profiles, spectra, specivar, imgmodel,
+                specoff, yoff):
+    """
+    Store shared inputs and outputs for use by _ex1d_task; spectra and
+    specivar[i, j] are for spectrum specoff+i and row yoff+j
+    """
+    _worker.update(img=img, mask=mask, psf=psf, profiles=profiles,
+        spectra=spectra, specivar=specivar, imgmodel=imgmodel,
+        specoff=specoff, yoff=yoff)
+
+def _init_worker(*args):
+    """
+    Initialize a worker process with one BLAS thread and the shared arrays
+    """
+    limit_blas_threads(1)
+    _set_worker(*args)
+
+def _ex1d_task(task):
+    """
+    Extract task = (speclo, spechi, ylo, yhi, opts) into the shared outputs,
+    where opts is a dictionary of the ex1d options for this call
+    """
+    speclo, spechi, ylo, yhi, opts = task
+    w = _worker
+    flux, ivar = _ex1d_group(w['img'], w['mask'], w['psf'], opts['readnoise'],
+        (speclo, spechi), (ylo, yhi), opts['rows_per_batch'], w['imgmodel'],
+        next_group=(spechi < opts['specmax']), profiles=w['profiles'],
+        reweight=opts['reweight'])
+    ii = slice(speclo-w['specoff'], spechi-w['specoff'])
+    jj = slice(ylo-w['yoff'], yhi-w['yoff'])
+    w['spectra'][ii, jj] = flux
+    w['specivar'][ii, jj] = ivar
+    return task[0:4]
+
+class Ex1dPool(object):
+    """
+    Pool of worker processes for many ex1d calls on the same image
+
+    The workers are forked and given the image, mask, PSF, and profiles
+    once, instead of by every ex1d call, e.g. for each chunk of rows in
+    bin/quicklook.  The contents of img and mask may change between calls.
+    """
+    def __init__(self, img, mask, psf, numcores, profiles=None):
+        """
+        img[ny, nx], mask[ny, nx] : CCD image and mask in shared memory,
+            see specter.util.sharedmem.shared_array
+        psf : PSF object
+        numcores : number of worker processes
+        profiles : optional ProfileTable, see ex1d
+
+        Pass the same img, mask, psf, and profiles to ex1d(pool=...)
+        """
+        if not (is_shared(img) and is_shared(mask)):
+            raise ValueError, "img and mask must be in shared memory"
+        self.img = img
+        self.mask = mask
+        self.psf = psf
+        self.profiles = profiles
+        self.spectra = shared_array((psf.nspec, img.shape[0]))
+        self.specivar = shared_array((psf.nspec, img.shape[0]))
+        initargs = (img, mask, psf, profiles, self.spectra, self.specivar,
+                    None, 0, 0)
+        self.pool = MP.Pool(numcores, initializer=_init_worker, initargs=initargs)
+
+    def close(self):
+        """
+        Stop the worker processes
+        """
+        self.pool.terminate()
+        self.pool.join()
 
 def ex1d(img, mask, psf, readnoise=2.5,
               specrange=None, yrange=None,
-              nspec_per_group=20, debug=False, model=False):
+              nspec_per_group=20, model=False, rows_per_batch=500,
+              numcores=1, rows_per_chunk=None, verbose=False,
+              profiles=None, reweight=True, pool=None):
     """
     Extract spectra from an image using row-by-row weighted extraction.
-    
+
     Inputs:
         img[ny, nx]     CCD image
         mask[ny, nx]    0=good, non-zero=bad
         psf object
-        
+
     Optional Inputs:
         readnoise = CCD readnoise
         specrange = (specmin, specmax) Spectral range to extract (default all)
         yrange = (ymin, ymax) CCD y (row) range to extract (default all rows)
         --> ranges are python-like, i.e. yrange=(0,100) extracts 100 rows
             from 0 to 99 inclusive but not row 100.
-            
-        groupspec: extract spectra in groups of N spectra
+
+        nspec_per_group: extract spectra in groups of N spectra
             (faster if spectra are physically separated into non-overlapping
             groups)
-            
-        debug: if True, stop with prompt after each row
-        
+        model: if True, also return the model image
+        rows_per_batch: number of rows to solve together; limits memory
+        numcores: number of processes extracting groups in parallel
+        rows_per_chunk: also split each group into chunks of this many
+            rows, e.g. to spread a single group across processes
+        verbose: if True, print progress for each group or chunk
+        profiles: ProfileTable covering specrange to interpolate
+            cross-dispersion profiles from instead of using Gaussians
+            with psf.xsigma
+        reweight: if False, skip re-extracting with weights that include
+            the model shot noise; faster, but the flux is weighted only
+            by readnoise.  ivar still includes the shot noise.
+        pool: Ex1dPool created with the same img, mask, psf, and profiles
+            to extract with instead of numcores new processes; doesn't
+            support model=True
+
     Returns:
         spectra[nspec, ny]   - extracted spectra
-        specivar[nspec, ny]  - inverse variance of spectra  
+        specivar[nspec, ny]  - inverse variance of spectra
+        imgmodel[ny, nx]     - model image, only if model=True
     """
 
     #- Range of spectra to extract
-    specmin, specmax = specrange if (specrange is not None) else (0, psf.nspec)        
+    specmin, specmax = specrange if (specrange is not None) else (0, psf.nspec)
     nspec = specmax - specmin
-    
+
     #- Rows to extract
     ymin, ymax = yrange if (yrange is not None) else (0, psf.npix_y)
     ny = ymax - ymin
-    nx = img.shape[0]
-    xx = N.arange(nx)
-    
-    spectra = N.zeros((nspec, ny))
-    specivar = N.zeros((nspec, ny))
-    
-    if model:
-        imgmodel = N.zeros(img.shape)
-        
-    #- Loop over groups of spectra
+
+    #- Groups of spectra, optionally split into chunks of rows
+    if rows_per_chunk is None:
+        rows_per_chunk = ny
+    tasks = list()
     for speclo in range(specmin, specmax, nspec_per_group):
         spechi = min(specmax, speclo+nspec_per_group)
-                
-        #- Calc trace centers (x0) and gaussian sigmas (xsigma) for each row
-        allx0 = N.zeros((nspec_per_group, ymax-ymin))
-        allxsigma = N.zeros((nspec_per_group, ymax-ymin))
-        rows = N.arange(ymin, ymax)
-        for ispec in range(speclo, spechi):
-            w = psf.wavelength(ispec, y=rows)
-            allx0[ispec-speclo] = psf.x(ispec, w)
-            allxsigma[ispec-speclo] = psf.xsigma(ispec, w)
-                
-        #- Loop over CCD rows
-        for irow, row in enumerate(range(ymin, ymax)):
-            if row%500 == 0:
-                print "Row %3d spectra %d:%d" % (row, speclo, spechi)
-        
-            #- Determine x range covered for this row of this group of spectra
-            wlo = psf.wavelength(speclo, y=row)
-            whi = psf.wavelength(spechi-1, y=row)
-            if speclo == 0:
-                xmin = 0
-            else:
-                xmin = int(0.5*(psf.x(speclo-1, wlo) + psf.x(speclo, wlo)))
-        
-            if spechi >= psf.nspec:
-                xmax = psf.npix_x
-            else:
-                xmax = int(0.5*(psf.x(spechi-1, wlo) + psf.x(spechi, wlo)) + 1)
-                
-            #- Design matrix for pixels = A * flux for this row
-            A = N.zeros( (xmax-xmin, spechi-speclo) )
-            for ispec in range(speclo, spechi):
-                # w = psf.wavelength(ispec, y=row)
-                # x0 = psf.x(ispec, w)
-                # xsigma = psf.xsigma(ispec, w)
-                x0 = allx0[ispec-speclo, irow]
-                xsigma = allxsigma[ispec-speclo, irow]
-            
-                #- x range for single spectrum on single row
-                xlo = max(xmin, int(x0-5*xsigma))
-                xhi = min(xmax, int(x0+5*xsigma+1))
-            
-                A[xlo-xmin:xhi-xmin, ispec-speclo] = gausspix(xx[xlo:xhi], x0, xsigma)
-            
-            #- Original solve, weighting by input ivar
-            ### tmpspec, iCov = weighted_solve(A, img[row, xmin:xmax], ivar[row, xmin:xmax])
-
-            #- Solve weighting only by readnoise and mask
-            nx = xmax-xmin
-            xvar = N.ones(nx)*readnoise**2 * (mask[row, xmin:xmax] == 0)
-            tmpspec, iCov = weighted_solve(A, img[row, xmin:xmax], 1.0/xvar)
-            
-            #- Re-extract with weight incluing model shot noise
-            xvar = (A.dot(tmpspec) + readnoise**2) * (mask[row, xmin:xmax] == 0)
-            tmpspec, iCov = weighted_solve(A, img[row, xmin:xmax], 1.0/xvar)
-
-            if model:
-                imgmodel[row, xmin:xmax] = A.dot(tmpspec)
-                
-            spectra[speclo-specmin:spechi-specmin, row-ymin] = tmpspec
-            specivar[speclo-specmin:spechi-specmin, row-ymin] = iCov.diagonal()   
-            
-            if debug:
-                print speclo, row
-                import IPython
-                IPython.embed()                
-                
+        for ylo in range(ymin, ymax, rows_per_chunk):
+            tasks.append( (speclo, spechi, ylo, min(ymax, ylo+rows_per_chunk)) )
+    numcores = max(1, min(numcores, len(tasks)))
+
+    #- Options that may differ between calls with the same pool
+    opts = dict(readnoise=readnoise, specmax=specmax,
+                rows_per_batch=rows_per_batch, reweight=reweight)
+    tasks = [t + (opts,) for t in tasks]
+
+    if pool is not None:
+        if (img is not pool.img) or (mask is not pool.mask) or \
+           (psf is not pool.psf) or (profiles is not pool.profiles):
+            raise ValueError, "img, mask, psf, and profiles must be those of the pool"
+        if model:
+            raise ValueError, "model=True isn't supported with a pool"
+        for speclo, spechi, ylo, yhi in pool.pool.imap_unordered(_ex1d_task, tasks):
+            if verbose:
+                print "Spectra %d:%d rows %d:%d" % (speclo, spechi, ylo, yhi)
+                sys.stdout.flush()
+        spectra = pool.spectra[specmin:specmax, ymin:ymax].copy()
+        specivar = pool.specivar[specmin:specmax, ymin:ymax].copy()
+        return spectra, specivar
+
+    if numcores > 1:
+        img = as_shared(img)
+        mask = as_shared(mask)
+        spectra = shared_array((nspec, ny))
+        specivar = shared_array((nspec, ny))
+        imgmodel = shared_array(img.shape) if model else None
+    else:
+        spectra = N.zeros((nspec, ny))
+        specivar = N.zeros((nspec, ny))
+        imgmodel = N.zeros(img.shape) if model else None
+
+    initargs = (img, mask, psf, profiles, spectra, specivar, imgmodel,
+                specmin, ymin)
+    if numcores == 1:
+        pool = None
+        _set_worker(*initargs)
+        results = (_ex1d_task(t) for t in tasks)
+    else:
+        pool = MP.Pool(numcores, initializer=_init_worker, initargs=initargs)
+        results = pool.imap_unordered(_ex1d_task, tasks)
+
+    try:
+        for speclo, spechi, ylo, yhi in results:
+            if verbose:
+                print "Spectra %d:%d rows %d:%d" % (speclo, spechi, ylo, yhi)
+                sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _worker.clear()
+
     if model:
         return spectra, specivar, imgmodel
     else:
         return spectra, specivar
-    
-        
+
+def resample_rows(psf, flux, ivar, wavelengths, specrange=None, yrange=None):
+    """
+    Resample ex1d spectra per CCD row onto a common wavelength grid
+
+    Inputs:
+        psf : PSF object
+        flux[nspec, ny], ivar[nspec, ny] : ex1d outputs
+        wavelengths : output wavelength grid [Angstroms]
+        specrange, yrange : ranges that were passed to ex1d
+
+    Returns flux[nspec, nwave] in photons/A and ivar[nspec, nwave],
+    linearly interpolated between rows.  ivar is 0 outside the extracted
+    rows and next to rows with ivar 0.
+    """
+    specmin, specmax = specrange if (specrange is not None) else (0, psf.nspec)
+    ymin, ymax = yrange if (yrange is not None) else (0, psf.npix_y)
+    rows = N.arange(ymin, ymax)
+    wavelengths = N.asarray(wavelengths)
+    nwave = len(wavelengths)
+
+    rflux = N.zeros((specmax-specmin, nwave))
+    rivar = N.zeros((specmax-specmin, nwave))
+    for i, ispec in enumerate(range(specmin, specmax)):
+        w = psf.wavelength(ispec, y=rows)
+        dwdy = N.gradient(w)
+        f = flux[i] / dwdy
+        iv = ivar[i] * dwdy**2
+        rflux[i] = N.interp(wavelengths, w, f, left=0.0, right=0.0)
+        rivar[i] = N.interp(wavelengths, w, iv, left=0.0, right=0.0)
+
+        #- Rows on either side of each output wavelength must be good
+        j = N.clip(N.searchsorted(w, wavelengths), 1, len(w)-1)
+        bad = (iv[j-1] == 0) | (iv[j] == 0)
+        rivar[i, bad] = 0.0
+
+    return rflux, rivar
+
+def _ex1d_group(img, mask, psf, readnoise, specrange, yrange, rows_per_batch,
+                imgmodel=None, next_group=False, profiles=None,
+                reweight=True):
+    """
+    Extract rows yrange of a group of spectra specrange; see ex1d
+
+    Returns flux[nspec, ny], ivar[nspec, ny], and fills imgmodel if not None.
+    If next_group is True, the group starting at spechi is also extracted
+    and it fills the model columns from its own xmin, so that the two
+    groups never write the same pixels.
+    """
+    speclo, spechi = specrange
+    ymin, ymax = yrange
+    rows = N.arange(ymin, ymax)
+
+    #- Calc wavelengths, trace centers (x0), and gaussian sigmas (xsigma)
+    #- for each row; xsigma isn't needed for tabulated profiles
+    allw = N.zeros((spechi-speclo, ymax-ymin))
+    allx0 = N.zeros((spechi-speclo, ymax-ymin))
+    allxsigma = None if profiles is not None else allw.copy()
+    for ispec in range(speclo, spechi):
+        w = allw[ispec-speclo] = psf.wavelength(ispec, y=rows)
+        allx0[ispec-speclo] = psf.x(ispec, w)
+        if profiles is None:
+            allxsigma[ispec-speclo] = psf.xsigma(ispec, w)
+
+    #- x range covered by this group of spectra on each row, from halfway
+    #- to the neighboring spectra
+    wlo = psf.wavelength(speclo, y=rows)
+    if speclo == 0:
+        xmin = N.zeros(len(rows), dtype=int)
+    else:
+        xmin = (0.5*(psf.x(speclo-1, wlo) + psf.x(speclo, wlo))).astype(int)
+    if spechi >= psf.nspec:
+        xmax = N.zeros(len(rows), dtype=int) + psf.npix_x
+    else:
+        xmax = (0.5*(psf.x(spechi-1, wlo) + psf.x(spechi, wlo)) + 1).astype(int)
+    xmax = N.minimum(xmax, img.shape[1])
+
+    if next_group:
+        whi = psf.wavelength(spechi, y=rows)
+        xnext = (0.5*(psf.x(spechi-1, whi) + psf.x(spechi, whi))).astype(int)
+        xmodel = N.minimum(xmax, xnext)
+    else:
+        xmodel = xmax
+
+    flux = N.zeros((spechi-speclo, len(rows)))
+    ivar = N.zeros((spechi-speclo, len(rows)))
+    for i in range(0, len(rows), rows_per_batch):
+        ii = slice(i, i+rows_per_batch)
+        if profiles is None:
+            prof = (allxsigma[:, ii].T, )
+        else:
+            prof = (allw[:, ii].T, profiles, speclo)
+        flux[:, ii], ivar[:, ii] = _ex1d_rows(img, mask, readnoise,
+            rows[ii], xmin[ii], xmax[ii], allx0[:, ii].T, prof,
+            imgmodel, xmodel[ii], reweight)
+
+    return flux, ivar
+
+def _ex1d_rows(img, mask, readnoise, rows, xmin, xmax, x0, prof, imgmodel,
+               xmodel, reweight=True):
+    """
+    Extract a batch of rows
+
+    rows[nr] : CCD rows
+    xmin[nr], xmax[nr] : range of columns to fit on each row
+    x0[nr, nspec] : trace centers
+    prof : (xsigma[nr, nspec],) Gaussian sigmas, or
+        (wave[nr, nspec], profiles, speclo) to use ProfileTable profiles,
+        where speclo is the first spectrum
+    imgmodel : if not None, model image to fill for columns xmin:xmodel
+    reweight : if False, don't re-solve with the shot noise weights
+
+    Returns flux[nspec, nr], ivar[nspec, nr]
+    """
+    #- Pixels [nr, npix] of each row, padded to the widest row
+    npix = N.max(xmax - xmin)
+    pix = xmin[:, None] + N.arange(npix)
+    inrow = pix < xmax[:, None]
+    pix = N.minimum(pix, img.shape[1]-1)
+    data = img[rows[:, None], pix]
+    good = inrow & (mask[rows[:, None], pix] == 0)
+
+    #- Profiles [nr, npix, nspec] of each spectrum integrated over pixels,
+    #- covering columns xlo:xhi [nr, nspec] and truncated to each row
+    if len(prof) == 1:
+        A, xlo, xhi = _gauss_profiles(pix, x0, prof[0])
+    else:
+        A, xlo, xhi = _table_profiles(pix, x0, *prof)
+    A *= inrow[:, :, None]
+
+    #- Spectra k apart overlap if their profiles share a column on any row
+    nspec = x0.shape[1]
+    nband = 0
+    while nband+1 < nspec and \
+          N.any(N.minimum(xhi[:, :-(nband+1)], xmax[:, None]) > \
+                N.maximum(xlo[:, nband+1:], xmin[:, None])):
+        nband += 1
+
+    #- Solve weighting only by readnoise and mask
+    weight = good / readnoise**2
+    flux, iCov = _banded_solve(A, data, weight, nband)
+
+    #- Re-extract with weight including model shot noise, or just use
+    #- those weights for ivar
+    model = N.einsum('rpi,ri->rp', A, flux)
+    weight = good / (N.maximum(model, 0.0) + readnoise**2)
+    if reweight:
+        flux, iCov = _banded_solve(A, data, weight, nband)
+    else:
+        iCov = [N.einsum('rpi,rpi,rp->ri', A, A, weight)]
+
+    if imgmodel is not None:
+        model = N.einsum('rpi,ri->rp', A, flux)
+        r = N.repeat(rows[:, None], pix.shape[1], axis=1)
+        ok = inrow & (pix < xmodel[:, None])
+        imgmodel[r[ok], pix[ok]] = model[ok]
+
+    return flux.T, iCov[0].T
+
+def _gauss_profiles(pix, x0, xsigma):
+    """
+    Gaussian profiles truncated at 5 sigma, see _ex1d_rows
+    """
+    nr, npix = pix.shape
+    nspec = x0.shape[1]
+    xlo = (x0 - 5*xsigma).astype(int)
+    xhi = (x0 + 5*xsigma + 1).astype(int)
+
+    #- Evaluate each profile only on its own columns xlo:xhi [nr, nspec, nw]
+    #- rather than across every column of the group
+    nw = N.max(xhi - xlo)
+    cols = xlo[:, :, None] + N.arange(nw)
+    sig = xsigma[:, :, None]
+    xc = x0[:, :, None]
+    p = gaussint(cols+0.5, xc, sig) - gaussint(cols-0.5, xc, sig)
+
+    A = N.zeros((nr, npix, nspec))
+    j = cols - pix[:, 0:1, None]
+    ok = (cols < xhi[:, :, None]) & (j >= 0) & (j < npix)
+    r, i, _ = N.nonzero(ok)
+    A[r, j[ok], i] = p[ok]
+    return A, xlo, xhi
+
+def _table_profiles(pix, x0, wave, profiles, speclo):
+    """
+    Profiles interpolated from ProfileTable profiles, see _ex1d_rows
+    """
+    nr, npix = pix.shape
+    nspec = x0.shape[1]
+    A = N.zeros((nr, npix, nspec))
+    xlo = N.zeros((nr, nspec), dtype=int)
+    xhi = N.zeros((nr, nspec), dtype=int)
+    r = N.arange(nr)[:, None]
+    for i in range(nspec):
+        cols, p = profiles.profiles(speclo+i, wave[:, i], x0[:, i])
+        j = cols - pix[:, 0:1]
+        ok = (j >= 0) & (j < npix)
+        A[N.broadcast_to(r, j.shape)[ok], j[ok], i] = p[ok]
+        xlo[:, i] = cols[:, 0]
+        xhi[:, i] = cols[:, -1] + 1
+    return A, xlo, xhi
+
+def _banded_solve(A, data, weight, nband):
+    """
+    Weighted least squares fit of data[nr, npix] = A[nr, npix, n] x[nr, n]
+    for every row r, given weight[nr, npix] and that A^T W A has nband
+    off-diagonals
+
+    Returns x[nr, n] and the diagonals iCov[nband+1][nr, n] of A^T W A,
+    iCov[k][:, i] = (A^T W A)[i, i+k]
+    """
+    nr, npix, n = A.shape
+    WA = A * weight[:, :, None]
+    y = N.einsum('rpi,rp->ri', WA, data)
+    iCov = list()
+    for k in range(nband+1):
+        d = N.zeros((nr, n))
+        d[:, 0:n-k] = N.einsum('rpi,rpi->ri', WA[:, :, 0:n-k], A[:, :, k:])
+        iCov.append(d)
+
+    #- Spectra without any weight on a row are solved as 0
+    M = [d.copy() for d in iCov]
+    M[0][M[0] <= 0] = 1.0
+
+    return _cholesky_banded_solve(M, y), iCov
+
+def _cholesky_banded_solve(M, y):
+    """
+    Solve M_r x_r = y_r for symmetric positive definite banded matrices M_r
+
+    M : list of nband+1 arrays, M[k][r, i] = M_r[i, i+k]
+    y : array[nr, n]
+
+    Returns x[nr, n].  Loops over the band in python, vectorized over r.
+    """
+    nr, n = y.shape
+    nband = len(M) - 1
+
+    #- Cholesky factor M_r = L_r L_r^T with L[k][r, j] = L_r[j+k, j]
+    L = [N.zeros((nr, n)) for k in range(nband+1)]
+    for j in range(n):
+        d = M[0][:, j].copy()
+        for k in range(1, min(nband, j)+1):
+            d -= L[k][:, j-k]**2
+        L[0][:, j] = N.sqrt(d)
+        for m in range(1, min(nband, n-1-j)+1):
+            s = M[m][:, j].copy()
+            for k in range(max(0, j+m-nband), j):
+                s -= L[j+m-k][:, k] * L[j-k][:, k]
+            L[m][:, j] = s / L[0][:, j]
+
+    #- Forward substitution L z = y
+    z = N.zeros((nr, n))
+    for j in range(n):
+        s = y[:, j].copy()
+        for k in range(max(0, j-nband), j):
+            s -= L[j-k][:, k] * z[:, k]
+        z[:, j] = s / L[0][:, j]
+
+    #- Back substitution L^T x = z
+    x = N.zeros((nr, n))
+    for j in range(n-1, -1, -1):
+        s = z[:, j].copy()
+        for i in range(j+1, min(n-1, j+nband)+1):
+            s -= L[i-j][:, j] * x[:, i]
+        x[:, j] = s / L[0][:, j]
+
+    return x
@@ -3,14 +3,17 @@
 """
 
 import sys
+from time import time
 import numpy as np
 import scipy.sparse
 import scipy.linalg
 from scipy.sparse import spdiags, issparse
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import spsolve, splu, cg, LinearOperator
 
 def ex2d(image, ivar, psf, specrange, wavelengths, xyrange=None,
-         full_output=False, regularize=0.0):
+         full_output=False, regularize=0.0, reject_nsigma=None,
+         reject_maxiter=10, profile=False, mixed_precision=False,
+         fibermask=None, A=None):
     """
     2D PSF extraction of flux from image given pixel inverse variance.
     
@@ -26,11 +29,45 @@ def ex2d(image, ivar, psf, specrange, wavelengths, xyrange=None,
             cutout of this region from the full image
         full_output : if True, return a dictionary of outputs including
             intermediate outputs such as the projection matrix.
+        regularize : amount of regularization to limit ringing
+        reject_nsigma : if set, iteratively reject pixels whose residual
+            from the extracted model is more than this many sigma,
+            e.g. cosmic rays.  The mask of rejected pixels is returned in
+            the full_output dictionary as 'mask'.
+        reject_maxiter : maximum number of rejection iterations
+        profile : if True, include a 'profile' dictionary in the
+            full_output results with per-stage wall times (time_projection,
+            time_icov, time_solve, time_resolution), matrix dimensions
+            (npix, nflux), nonzero counts (nnz_A, nnz_iCov), PSF spot cache
+            hits and misses, and the iCov condition number (cond).
+        mixed_precision : if True, assemble iCov and do the factorization
+            and eigendecomposition in float32.  The deconvolved flux
+            solution is refined to float64 precision, but R and ivar keep
+            float32 accuracy: they are accepted only if they reproduce the
+            float64 iCov 1 to a relative 1e-4 in every flux bin (see
+            _resolution_ok), else they are recomputed in float64.  Accepted
+            R and ivar typically differ from float64 by ~1e-5, and the R
+            convolved flux by up to ~1e-3 of its uncertainty.  Poorly
+            conditioned iCov, e.g. with bins narrower than the PSF or the
+            weakly constrained border bins of a patch, fail the check, so
+            this only saves time for well conditioned ones.  The flux
+            solve stays in float64 if reject_nsigma is set.
+        fibermask : array[nspec] of fiber mask values, nonzero = bad.
+            Masked fibers are removed from the extraction.  If None,
+            fibers without any unmasked pixels along their trace are
+            treated as masked.
+        A : precomputed projection matrix from projection_matrix() with
+            the same inputs, e.g. built ahead of time in another thread;
+            its time and PSF spot cache use are then not in the profile
         
     Returns (flux, ivar, R):
         flux[nspec, nwave] = extracted resolution convolved flux
         ivar[nspec, nwave] = inverse variance of flux
         R : 2D resolution matrix to convert
+
+    Masked fibers and flux bins without any pixel weight are not
+    extracted; they are returned with flux = ivar = 0 and an identity
+    resolution matrix.
     """
 
     #- Range of image to consider
@@ -49,81 +86,360 @@ def ex2d(image, ivar, psf, specrange, wavelengths, xyrange=None,
     nspec = specrange[1] - specrange[0]
     nwave = len(wavelengths)
     
+    #- Dead or masked fibers are left out of the system entirely
+    livefiber = _live_fibers(psf, ivar, specrange, wavelengths, xyrange,
+                             fibermask)
+
     #- Solve AT W pix = (AT W A) flux
     
     #- Projection matrix and inverse covariance
-    A = psf.projection_matrix(specrange, wavelengths, xyrange)
+    #- With A given, spots evaluated meanwhile (e.g. by the thread that
+    #- builds A for the next patch) aren't counted
+    t0 = time()
+    if A is None:
+        nhit, nmiss = psf.cache_stats()
+        A = _projection_matrix(psf, specrange, wavelengths, xyrange, livefiber)
+        nhit, nmiss = np.subtract(psf.cache_stats(), (nhit, nmiss))
+    elif A.shape != (npix, np.count_nonzero(livefiber)*nwave):
+        raise ValueError, "A shape {} doesn't match the inputs".format(A.shape)
+    else:
+        nhit, nmiss = 0, 0
+    t1 = time()
 
     #- Pixel weights matrix
     w = ivar.ravel()
     W = spdiags(ivar.ravel(), 0, npix, npix)
 
-    #-----
-    #- Extend A with an optional regularization term to limit ringing.
-    #- If any flux bins don't contribute to these pixels,
-    #- also use this term to constrain those flux bins to 0.
-    
-    #- Original: exclude flux bins with 0 pixels contributing
-    # ibad = (A.sum(axis=0).A == 0)[0]
-    
-    #- Identify fluxes with very low weights of pixels contributing            
+    #- Also drop flux bins that no unmasked pixel constrains;
+    #- ikeep are the indices of the remaining bins in the full flux array
     fluxweight = W.dot(A).sum(axis=0).A[0]
-    minweight = 0.01*np.max(fluxweight)
-    ibad = fluxweight < minweight
-    
-    #- Add regularization of low weight fluxes
-    I = regularize*scipy.sparse.identity(nspec*nwave)
-    I.data[0,ibad] = minweight - fluxweight[ibad]
-    
-    #- Only need to extend A if regularization is non-zero
-    if np.any(I.data):
-        pix = np.concatenate( (image.ravel(), np.zeros(nspec*nwave)) )
-        Ax = scipy.sparse.vstack( (A, I) )
-        wx = np.concatenate( (w, np.ones(nspec*nwave)) )
+    ikeep = np.where(np.repeat(livefiber, nwave))[0]
+    if np.any(fluxweight == 0):
+        ii = np.where(fluxweight > 0)[0]
+        A = A[:, ii].tocsr()
+        fluxweight = fluxweight[ii]
+        ikeep = ikeep[ii]
+    nflux = len(ikeep)
+
+    mask = np.zeros(npix, dtype=bool)
+    if nflux == 0:
+        #- Nothing left to solve; all bins are reinserted below
+        xflux = fluxivar = eigvals = np.zeros(0)
+        R = np.zeros( (0, 0) )
+        iCov = scipy.sparse.csr_matrix( (0, 0) )
+        t2 = t3 = t4 = time()
     else:
-        pix = image.ravel()
-        Ax = A
-        wx = w
+        #-----
+        #- Extend A with an optional regularization term to limit ringing.
+        #- Flux bins with only a small weight of pixels contributing
+        #- are also constrained towards 0 by this term.
 
-    #- Inverse covariance
-    Wx = spdiags(wx, 0, len(wx), len(wx))
-    iCov = Ax.T.dot(Wx.dot(Ax))
-    
-    #- Solve (image = A flux) weighted by Wx:
-    #-     A^T W image = (A^T W A) flux = iCov flux    
-    y = Ax.T.dot(Wx.dot(pix))
-    
-    xflux = spsolve(iCov, y).reshape((nspec, nwave))
-
-    #- Solve for Resolution matrix
-    try:
-        R, fluxivar = resolution_from_icov(iCov)
-    except np.linalg.linalg.LinAlgError, err:
-        outfile = 'LinAlgError_{}-{}_{}-{}.fits'.format(specrange[0], specrange[1], waverange[0], waverange[1])
-        print "ERROR: Linear Algebra didn't converge"
-        print "Dumping {} for debugging".format(outfile)
-        import fitsio
-        fitsio.write(outfile, image, clobber=True)
-        fitsio.write(outfile, ivar, extname='IVAR')
-        fitsio.write(outfile, A.data, extname='ADATA') 
-        fitsio.write(outfile, A.indices, extname='AINDICES')
-        fitsio.write(outfile, A.indptr, extname='AINDPTR')
-        fitsio.write(outfile, iCov.toarray(), extname='ICOV')
-        raise err
+        #- Identify fluxes with very low weights of pixels contributing
+        minweight = 0.01*np.max(fluxweight)
+        ibad = fluxweight < minweight
+
+        #- Add regularization of low weight fluxes
+        I = regularize*scipy.sparse.identity(nflux)
+        I.data[0,ibad] = minweight - fluxweight[ibad]
+
+        #- Only need to extend A if regularization is non-zero
+        if np.any(I.data):
+            pix = np.concatenate( (image.ravel(), np.zeros(nflux)) )
+            Ax = scipy.sparse.vstack( (A, I) )
+            wx = np.concatenate( (w, np.ones(nflux)) )
+        else:
+            pix = image.ravel()
+            Ax = A
+            wx = w
+
+        #- Inverse covariance
+        Wx = spdiags(wx, 0, len(wx), len(wx))
+        if mixed_precision and reject_nsigma is None:
+            Ax32 = Ax.astype(np.float32)
+            Wx32 = spdiags(wx.astype(np.float32), 0, len(wx), len(wx))
+            iCov = Ax32.T.dot(Wx32.dot(Ax32))
+        else:
+            iCov = Ax.T.dot(Wx.dot(Ax))
+
+        #- Solve (image = A flux) weighted by Wx:
+        #-     A^T W image = (A^T W A) flux = iCov flux
+        y = Ax.T.dot(Wx.dot(pix))
+        t2 = time()
+
+        #- float64 iCov if it has been formed, e.g. by outlier rejection
+        iCov64 = None
+        if iCov.dtype == np.float32:
+            xflux = _refine_solve(Ax, Wx, iCov, y)
+            if xflux is None:
+                #- Refinement didn't converge; start over in float64
+                iCov = Ax.T.dot(Wx.dot(Ax))
+                xflux = spsolve(iCov, y)
+        elif reject_nsigma is None:
+            xflux = spsolve(iCov, y)
+        else:
+            xflux, iCov, mask = _reject_outliers(A, image.ravel(), w, iCov, y,
+                reject_nsigma, reject_maxiter)
+            if mixed_precision:
+                iCov64 = iCov
+                iCov = iCov.astype(np.float32)
+        t3 = time()
+
+        #- Solve for Resolution matrix
+        try:
+            R, fluxivar, eigvals = resolution_from_icov(iCov, return_eigenvalues=True)
+            if iCov.dtype == np.float32:
+                #- Check against iCov 1 evaluated in float64
+                one = np.ones(nflux)
+                if iCov64 is None:
+                    ref = Ax.T.dot(Wx.dot(Ax.dot(one)))
+                else:
+                    ref = iCov64.dot(one)
+                if _resolution_ok(R, fluxivar, ref):
+                    R = R.astype(np.float64)
+                    fluxivar = fluxivar.astype(np.float64)
+                    eigvals = eigvals.astype(np.float64)
+                else:
+                    if iCov64 is None:
+                        iCov64 = Ax.T.dot(Wx.dot(Ax))
+                    iCov = iCov64
+                    R, fluxivar, eigvals = resolution_from_icov(iCov, return_eigenvalues=True)
+        except np.linalg.linalg.LinAlgError, err:
+            outfile = 'LinAlgError_{}-{}_{}-{}.fits'.format(specrange[0], specrange[1], waverange[0], waverange[1])
+            print "ERROR: Linear Algebra didn't converge"
+            print "Dumping {} for debugging".format(outfile)
+            import fitsio
+            fitsio.write(outfile, image, clobber=True)
+            fitsio.write(outfile, ivar, extname='IVAR')
+            fitsio.write(outfile, A.data, extname='ADATA') 
+            fitsio.write(outfile, A.indices, extname='AINDICES')
+            fitsio.write(outfile, A.indptr, extname='AINDPTR')
+            fitsio.write(outfile, iCov.toarray(), extname='ICOV')
+            raise err
+        t4 = time()
+
+    #- Reinsert removed bins with zero flux and ivar and unit resolution
+    nfull = nspec*nwave
+    if nflux < nfull:
+        xflux = _expand(xflux, ikeep, nfull)
+        fluxivar = _expand(fluxivar, ikeep, nfull)
+        Rx = np.identity(nfull, dtype=R.dtype)
+        Rx[np.ix_(ikeep, ikeep)] = R
+        R = Rx
         
     #- Convolve with Resolution matrix to decorrelate errors
+    xflux = xflux.reshape((nspec, nwave))
     fluxivar = fluxivar.reshape((nspec, nwave))
     rflux = R.dot(xflux.ravel()).reshape(xflux.shape)
 
     if full_output:
+        if nflux < nfull:
+            A = _expand_sparse(A, None, ikeep, nfull)
+            iCov = _expand_sparse(iCov, ikeep, ikeep, nfull)
         results = dict(flux=rflux, ivar=fluxivar, R=R, xflux=xflux, A=A)
         results['iCov'] = iCov
+        results['mask'] = mask.reshape((ny, nx))
+        if profile:
+            if len(eigvals) == 0:
+                cond = 1.0
+            elif eigvals[0] > 0:
+                cond = eigvals[-1] / eigvals[0]
+            else:
+                cond = np.inf
+            results['profile'] = dict(
+                time_projection=t1-t0, time_icov=t2-t1,
+                time_solve=t3-t2, time_resolution=t4-t3,
+                npix=npix, nflux=nflux, nnz_A=A.nnz, nnz_iCov=iCov.nnz,
+                cache_hits=nhit, cache_misses=nmiss, cond=cond)
         return results
     else:
         return rflux, fluxivar, R
     
+def projection_matrix(psf, specrange, wavelengths, xyrange, ivar,
+                      fibermask=None):
+    """
+    Return the projection matrix that ex2d would build for these inputs,
+    with columns for only the fibers that are not masked or dead
+
+    ivar is the inverse variance of the xyrange subimage, used to find
+    dead fibers if fibermask is None; see ex2d
+    """
+    livefiber = _live_fibers(psf, ivar, specrange, wavelengths, xyrange,
+                             fibermask)
+    return _projection_matrix(psf, specrange, wavelengths, xyrange, livefiber)
+
+def _live_fibers(psf, ivar, specrange, wavelengths, xyrange, fibermask):
+    """
+    Return boolean array[nspec] of fibers to extract
+    """
+    if fibermask is None:
+        return ~_dead_fibers(psf, ivar, specrange, wavelengths, xyrange)
+    else:
+        return (np.asarray(fibermask) == 0)
+
+def _dead_fibers(psf, ivar, specrange, wavelengths, xyrange):
+    """
+    Return boolean array[nspec] of fibers with no unmasked pixels
+    along their traces within the xyrange subimage ivar
+    """
+    xmin, xmax, ymin, ymax = xyrange
+    ny, nx = ivar.shape
+    x, y = psf.xy(np.arange(specrange[0], specrange[1]), wavelengths)
+    ix = np.round(x).astype(int) - xmin
+    iy = np.round(y).astype(int) - ymin
+    inside = (0 <= ix) & (ix < nx) & (0 <= iy) & (iy < ny)
+    tracewt = np.zeros(x.shape)
+    tracewt[inside] = ivar[iy[inside], ix[inside]]
+    return ~np.any(tracewt > 0, axis=1)
+
+def _projection_matrix(psf, specrange, wavelengths, xyrange, livefiber):
+    """
+    psf.projection_matrix with columns for only the livefiber spectra
+    """
+    #- Contiguous [lo, hi) ranges of live fibers
+    blocks = list()
+    for ispec in specrange[0] + np.where(livefiber)[0]:
+        if len(blocks) > 0 and blocks[-1][1] == ispec:
+            blocks[-1][1] += 1
+        else:
+            blocks.append([ispec, ispec+1])
+
+    if len(blocks) == 0:
+        xmin, xmax, ymin, ymax = xyrange
+        return scipy.sparse.csr_matrix( ((ymax-ymin)*(xmax-xmin), 0) )
+    elif len(blocks) == 1:
+        return psf.projection_matrix(tuple(blocks[0]), wavelengths, xyrange)
+    else:
+        A = [psf.projection_matrix(tuple(b), wavelengths, xyrange) for b in blocks]
+        return scipy.sparse.hstack(A).tocsr()
+
+def _expand(x, ikeep, n):
+    """
+    Return array[n] with x at indices ikeep and 0 elsewhere
+    """
+    result = np.zeros(n, dtype=x.dtype)
+    result[ikeep] = x
+    return result
+
+def _expand_sparse(M, irow, icol, n):
+    """
+    Map the rows (if irow is not None) and columns of sparse matrix M
+    to indices irow and icol of a larger matrix with n columns (and rows)
+    """
+    M = M.tocoo()
+    if irow is None:
+        shape = (M.shape[0], n)
+        row = M.row
+    else:
+        shape = (n, n)
+        row = irow[M.row]
+    return scipy.sparse.csr_matrix( (M.data, (row, icol[M.col])), shape=shape )
+
+def _reject_outliers(A, pix, w, iCov, y, nsigma, maxiter):
+    """
+    Iteratively reject pixels with large residuals from the model A xflux
+
+    Rather than refactoring iCov after each iteration, the factorization of
+    the original iCov is reused via the Woodbury identity for the rank-k
+    downdate iCov - U^T D U where U are the rows of A for the k rejected
+    pixels and D are their weights.  Pixels whose rejection would leave
+    the system singular are kept.
+
+    Inputs:
+        A[npix, nflux] : sparse projection matrix
+        pix[npix] : image pixels
+        w[npix] : pixel weights (inverse variance)
+        iCov[nflux, nflux] : sparse inverse covariance (including any
+            regularization terms)
+        y[nflux] : A^T W pix (including any regularization terms)
+        nsigma : rejection threshold
+        maxiter : maximum number of iterations
+
+    Returns xflux[nflux], downdated iCov, mask[npix] (True = rejected)
+    """
+    lu = splu(iCov.tocsc())
+    xflux = lu.solve(y)
+    mask = np.zeros(len(pix), dtype=bool)
+    for i in range(maxiter):
+        #- An outlier also distorts the model of its neighbors, so only
+        #- reject the worst pixels each iteration
+        chi = np.abs(pix - A.dot(xflux)) * np.sqrt(w * ~mask)
+        chimax = np.max(chi)
+        if chimax <= nsigma:
+            break
+        newmask = mask | (chi > max(nsigma, 0.5*chimax))
+
+        #- Downdate iCov and y for the rejected pixels
+        ii = np.where(newmask)[0]
+        U = A[ii]
+        D = w[ii]
+        yx = y - U.T.dot(D * pix[ii])
+
+        #- Woodbury: (M - U^T D U)^-1 =
+        #-     M^-1 + M^-1 U^T (D^-1 - U M^-1 U^T)^-1 U M^-1
+        Z = lu.solve(U.T.toarray())
+        C = np.diag(1.0/D) - U.dot(Z)
+        if np.linalg.cond(C) > 1.0/sys.float_info.epsilon:
+            break
+
+        x0 = lu.solve(yx)
+        xflux = x0 + Z.dot(np.linalg.solve(C, U.dot(x0)))
+        mask = newmask
 
-def sym_sqrt(a):
+    if np.any(mask):
+        ii = np.where(mask)[0]
+        U = A[ii]
+        iCov = iCov - U.T.dot(spdiags(w[ii], 0, len(ii), len(ii)).dot(U))
+
+    return xflux, iCov, mask
+
+def _refine_solve(Ax, Wx, iCov32, y, rtol=1e-13, maxiter=50):
+    """
+    Solve (Ax^T Wx Ax) x = y to float64 precision using a float32 iCov
+
+    The sparse LU factorization of the float32 iCov32 is used to
+    precondition conjugate gradient iterations on the float64 system,
+    whose residuals are evaluated with sparse matrix-vector products
+    without forming the float64 iCov.  This is iterative refinement that
+    still converges when cond(iCov) is too large for plain float32
+    refinement.
+
+    Returns x, or None if the refinement did not converge
+    """
+    n = len(y)
+    lu = splu(iCov32.tocsc())
+    x0 = lu.solve(y.astype(np.float32)).astype(np.float64)
+    op = LinearOperator((n, n), dtype=np.float64,
+        matvec=lambda v: Ax.T.dot(Wx.dot(Ax.dot(v))))
+    precond = LinearOperator((n, n), dtype=np.float64,
+        matvec=lambda v: lu.solve(v.astype(np.float32)).astype(np.float64))
+    x, info = cg(op, y, x0=x0, tol=rtol, maxiter=maxiter, M=precond)
+    if info != 0:
+        return None
+
+    #- Final residual check in float64
+    r = y - op.matvec(x)
+    if np.linalg.norm(r) > 10*rtol*np.linalg.norm(y):
+        return None
+
+    return x
+
+def _resolution_ok(R, ivar, ref, rtol=1e-4):
+    """
+    Check a float32 resolution matrix against the float64 iCov
+
+    R and ivar from resolution_from_icov satisfy S = diag(sqrt(ivar)) R
+    where S S = iCov, and R rows sum to 1.  Thus S S 1 = n * (R n) with
+    n = sqrt(ivar), which must match ref = iCov 1 evaluated in float64 to
+    relative error rtol in every flux bin; a norm over all bins would let
+    the poorly constrained ones be arbitrarily wrong.
+    """
+    #- Negative float32 ivar gives nan, which fails the check
+    with np.errstate(invalid='ignore'):
+        n = np.sqrt(ivar.astype(np.float64))
+        resid = n * R.astype(np.float64).dot(n) - ref
+        return np.all(np.abs(resid) <= rtol * np.abs(ref))
+
+def sym_sqrt(a, return_eigenvalues=False):
     """
     NAME: sym_sqrt
 
@@ -134,14 +450,17 @@ def sym_sqrt(a):
     ARGUMENT: a: real symmetric square 2D ndarray
 
     RETURNS: s such that a = numpy.dot(s, s)
+             if return_eigenvalues, returns (s, w) where w are the
+             (ascending, untrimmed) eigenvalues of a
 
     WRITTEN: Adam S. Bolton, U. of Utah, 2009
     """
     ### w, v = np.linalg.eigh(a)  #- np.linalg.eigh is single precision !?!
     w, v = scipy.linalg.eigh(a)
+    eigvals = w.copy()
     
     #- Trim meaningless eigenvalues below machine precision
-    ibad = w < w.max()*sys.float_info.epsilon
+    ibad = w < w.max()*np.finfo(w.dtype).eps
     w[ibad] = 0.0
         
     # dm = n.diagflat(n.sqrt(w))
@@ -152,9 +471,12 @@ def sym_sqrt(a):
     dm = spdiags(np.sqrt(w), 0, nw, nw)
     result = v.dot( dm.dot(v.T) )
     
-    return result
+    if return_eigenvalues:
+        return result, eigvals
+    else:
+        return result
 
-def resolution_from_icov(icov):
+def resolution_from_icov(icov, return_eigenvalues=False):
     """
     Function to generate the 'resolution matrix' in the simplest
     (no unrelated crosstalk) Bolton & Schlegel 2010 sense.
@@ -168,6 +490,9 @@ def resolution_from_icov(icov):
         R : resolution matrix
         ivar : R C R.T  -- decorrelated resolution convolved inverse variance
 
+    if return_eigenvalues, returns (R, ivar, w) where w are the eigenvalues
+    of icov in ascending order.
+
     WRITTEN: Adam S. Bolton, U. of Utah, 2009
     """
     #- force symmetry since due to rounding it might not be exactly symmetric
@@ -176,8 +501,11 @@ def resolution_from_icov(icov):
     if issparse(icov):
         icov = icov.toarray()
 
-    sqrt_icov = sym_sqrt(icov)
+    sqrt_icov, eigvals = sym_sqrt(icov, return_eigenvalues=True)
     norm_vector = np.sum(sqrt_icov, axis=1)
-    R = np.outer(norm_vector**(-1), np.ones(norm_vector.size)) * sqrt_icov
+    R = np.outer(norm_vector**(-1), np.ones(norm_vector.size, dtype=icov.dtype)) * sqrt_icov
     ivar = norm_vector**2  #- Bolton & Schlegel 2010 Eqn 13
-    return R, ivar
+    if return_eigenvalues:
+        return R, ivar, eigvals
+    else:
+        return R, ivar
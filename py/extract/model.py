@@ -0,0 +1,93 @@
+"""
+Model image of an extraction, accumulated patch by patch
+
+Every CCD row of a bundle is owned by exactly one patch (Patch.yrange), so
+adding the model A x of each patch on just the rows of its core builds the
+model image of the full extraction without double counting the overlapping
+borders.  The model is accumulated from pieces passed by extract_patch
+while the extraction runs, so residual and chi2 QA needs no extra
+projection.
+"""
+
+import numpy as N
+
+class ModelImage(object):
+    """
+    Full frame model image accumulated from per-patch pieces
+    """
+    def __init__(self, shape):
+        """
+        shape : (npix_y, npix_x) of the CCD image
+
+        self.image is the model image and self.covered is True for pixels
+        that received at least one piece
+        """
+        self.image = N.zeros(shape)
+        self.covered = N.zeros(shape, dtype=bool)
+
+    def add(self, xyrange, image):
+        """
+        Add image[ymax-ymin, xmax-xmin] at xyrange (xmin, xmax, ymin, ymax)
+        """
+        xmin, xmax, ymin, ymax = xyrange
+        self.image[ymin:ymax, xmin:xmax] += image
+        self.covered[ymin:ymax, xmin:xmax] = True
+
+    def chi2(self, img, imgivar):
+        """
+        Return chi2[npix_y, npix_x] = (img - model)^2 * imgivar, which is 0
+        for pixels not covered by the model
+        """
+        chi2 = (img - self.image)**2 * imgivar
+        chi2[~self.covered] = 0.0
+        return chi2
+
+    def fiber_chi2(self, psf, img, imgivar, specrange, halfwidth=None):
+        """
+        Sum chi2 of covered pixels with imgivar > 0 by nearest fiber trace
+
+        Inputs:
+            psf : PSF object
+            img[npix_y, npix_x] : CCD image that was extracted
+            imgivar[npix_y, npix_x] : inverse variance of img
+            specrange : (specmin, specmax) python style range of spectra
+
+        Optional Inputs:
+            halfwidth : only pixels within this many columns of a trace are
+                assigned to it; default is half of the median spacing of
+                the traces, or half of the spot width for a single spectrum
+
+        Returns numpy structured array with one row per spectrum and
+        columns SPECTRUM, CHI2, NPIX, and RCHI2 = CHI2/NPIX
+        """
+        specmin, specmax = specrange
+        nspec = specmax - specmin
+        chi2 = self.chi2(img, imgivar)
+        use = self.covered & (imgivar > 0)
+
+        rows = N.where(use.any(axis=1))[0]
+        xtrace = psf.x(N.arange(specmin, specmax))[:, rows]
+        if halfwidth is None:
+            if nspec > 1:
+                halfwidth = 0.5*N.median(N.diff(xtrace, axis=0))
+            else:
+                halfwidth = 0.5*psf.pix(specmin, 0.5*(psf.wmin+psf.wmax)).shape[1]
+
+        chi2sum = N.zeros(nspec)
+        npix = N.zeros(nspec, dtype=int)
+        x = N.arange(img.shape[1])
+        for j, iy in enumerate(rows):
+            #- Nearest trace to each pixel from the midpoints between traces
+            xt = xtrace[:, j]
+            ii = N.searchsorted(0.5*(xt[1:]+xt[:-1]), x)
+            ok = use[iy] & (N.abs(x - xt[ii]) <= halfwidth)
+            chi2sum += N.bincount(ii[ok], weights=chi2[iy, ok], minlength=nspec)
+            npix += N.bincount(ii[ok], minlength=nspec)
+
+        result = N.zeros(nspec, dtype=[('SPECTRUM', 'i4'), ('CHI2', 'f8'),
+                                       ('NPIX', 'i4'), ('RCHI2', 'f8')])
+        result['SPECTRUM'] = N.arange(specmin, specmax)
+        result['CHI2'] = chi2sum
+        result['NPIX'] = npix
+        result['RCHI2'] = chi2sum / N.maximum(npix, 1)
+        return result
@@ -0,0 +1,373 @@
+"""
+Divide an extraction into overlapping (bundle, wavelength) patches
+
+Each patch extracts a bundle of spectra over a core range of wavelengths
+plus a border of extra wavelengths on either side to minimize edge effects.
+Only the core wavelengths are kept in the final output, and every output
+(spectrum, wavelength) bin is owned by exactly one patch.  Likewise every
+CCD row of a bundle is owned by exactly one patch for the model image.
+"""
+
+from time import time
+import numpy as N
+from specter.extract.ex2d import ex2d, projection_matrix
+from specter.extract.resolution import ResolutionMatrix
+
+class Patch(object):
+    """
+    A single (bundle, wavelength) extraction patch
+    """
+    def __init__(self, ipatch, specrange, iwave, ncore, ww, nlo, nhi, xyrange,
+                 yrange=None):
+        """
+        ipatch : index of this patch within the plan
+        specrange : (speclo, spechi) spectra to extract, python style
+        iwave : index of first core wavelength in the full wavelength grid
+        ncore : number of core wavelength bins owned by this patch
+        ww : wavelengths to extract, including borders
+        nlo, nhi : number of border wavelength bins below/above the core
+        xyrange : (xmin, xmax, ymin, ymax) CCD subimage covering the core
+        yrange : (ymin, ymax) CCD rows of the core owned by this patch for
+            the model image; default xyrange[2:4]
+        """
+        self.ipatch = ipatch
+        self.specrange = specrange
+        self.iwave = iwave
+        self.ncore = ncore
+        self.ww = ww
+        self.nlo = nlo
+        self.nhi = nhi
+        self.xyrange = xyrange
+        if yrange is None:
+            yrange = tuple(xyrange[2:4])
+        self.yrange = yrange
+
+    @property
+    def nspec(self):
+        return self.specrange[1] - self.specrange[0]
+
+    @property
+    def nwave(self):
+        return len(self.ww)
+
+    @property
+    def core(self):
+        """slice of self.ww for the core wavelengths owned by this patch"""
+        return slice(self.nlo, self.nlo+self.ncore)
+
+    def __repr__(self):
+        return "Patch({}, specrange={}, wavelengths=({:.2f}, {:.2f}) -> ({:.2f}, {:.2f}))".format(
+            self.ipatch, self.specrange, self.ww[0], self.ww[-1],
+            self.ww[self.nlo], self.ww[self.nlo+self.ncore-1])
+
+def plan_patches(psf, wavelengths, specrange, bundlesize, nwstep, border=None):
+    """
+    Divide an extraction into a list of overlapping Patch objects
+
+    Inputs:
+        psf : PSF object
+        wavelengths : uniformly spaced 1D array of output wavelengths
+        specrange : (specmin, specmax) python style range of spectra
+        bundlesize : number of spectra to extract together
+        nwstep : number of core wavelength bins per patch
+
+    Optional Inputs:
+        border : number of CCD rows beyond the core subimage covered by
+            the border wavelengths; default is based upon the PSF spot size
+
+    Returns list of Patch objects, ordered by bundle then wavelength
+    """
+    specmin, specmax = specrange
+    nwave = len(wavelengths)
+    dw = wavelengths[1] - wavelengths[0]
+
+    patches = list()
+    for speclo in range(specmin, specmax, bundlesize):
+        spechi = min(speclo+bundlesize, specmax)
+        specmid = (speclo + spechi) // 2
+
+        for iwave in range(0, nwave, nwstep):
+            #- Low and High wavelengths for the core region
+            wlo = wavelengths[iwave]
+            whi = min(wavelengths[-1], wlo + nwstep*dw)
+
+            #- Identify subimage that covers the core wavelengths
+            xyrange = xlo,xhi,ylo,yhi = psf.xyrange((speclo, spechi), (wlo, whi))
+
+            #- Determine extra border wavelength extent
+            if border is None:
+                ny, nx = psf.pix(speclo, wlo).shape
+                ymin = ylo-ny+2
+                ymax = yhi+ny-2
+            else:
+                ymin = ylo-border
+                ymax = yhi+border
+
+            nlo = int((wlo - psf.wavelength(speclo, ymin))/dw)-1
+            nhi = int((psf.wavelength(speclo, ymax) - whi)/dw)-1
+            ww = N.arange(wlo-nlo*dw, whi+(nhi+0.5)*dw, dw)
+
+            #- The last core bin is also the first core bin of the next
+            #- patch; only the final patch keeps it
+            ncore = min(nwstep, nwave-iwave)
+
+            #- Rows owned by this patch end where the next patch's begin
+            if iwave == 0:
+                ycore = ylo
+            else:
+                ycore = _ycut(psf, specmid, wlo, dw)
+            if iwave+ncore < nwave:
+                yrange = (ycore, _ycut(psf, specmid, wavelengths[iwave+ncore], dw))
+            else:
+                yrange = (ycore, yhi)
+
+            patches.append(Patch(len(patches), (speclo, spechi), iwave,
+                                 ncore, ww, nlo, nhi, xyrange, yrange))
+
+    return patches
+
+def _ycut(psf, ispec, wavelength, dw):
+    """
+    Return the CCD row dividing wavelength from the bin dw below it
+    """
+    return int(round(psf.y(ispec, wavelength - 0.5*dw)))
+
+def extract_patch(img, imgivar, psf, patch, ndiag=10, regularize=0.0,
+                  profile=False, fibermask=None, max_memory=None, model=None,
+                  A=None, splitlock=None, mixed_precision=False):
+    """
+    Extract a single patch from the full image
+
+    Inputs:
+        img[npix_y, npix_x] : full CCD image
+        imgivar[npix_y, npix_x] : inverse variance of img
+        psf : PSF object
+        patch : Patch object
+
+    Optional Inputs:
+        ndiag : number of off-diagonal resolution matrix elements to keep
+        regularize : ex2d regularization amount
+        profile : if True, also return the ex2d profile dictionary with
+            an additional time_patch entry for the total wall time
+        fibermask : array[psf.nspec] of fiber mask values, nonzero = bad;
+            if None, ex2d derives a mask from imgivar
+        max_memory : if set, patches estimated to need more than this many
+            bytes are split into smaller patches before extracting.  Patches
+            are also split if extracting them raises a MemoryError.
+        model : object with an add(xyrange, image) method, e.g. ModelImage,
+            which is called with the model image A x of the patch on the
+            CCD rows patch.yrange that it owns
+        A : precomputed projection matrix from patch_projection(); it is
+            ignored if the patch is split
+        splitlock : lock to hold while extracting the pieces of a split
+            patch, e.g. if A was given and the PSF may be used by another
+            thread, since the pieces evaluate PSF spots
+        mixed_precision : passed to ex2d; see its accuracy there
+
+    Returns (flux, ivar, Rd) for just the core wavelengths of the patch:
+        flux[nspec, ncore]
+        ivar[nspec, ncore]
+        Rd[nspec, 2*ndiag+1, ncore] : diagonals of the resolution matrix
+
+    or (flux, ivar, Rd, profile) if profile is True
+    """
+    if max_memory is None or estimate_patch_memory(patch) <= max_memory:
+        try:
+            return _extract_patch(img, imgivar, psf, patch, ndiag=ndiag,
+                regularize=regularize, profile=profile, fibermask=fibermask,
+                model=model, A=A, mixed_precision=mixed_precision)
+        except MemoryError:
+            subpatches = split_patch(psf, patch)
+            if subpatches is None:
+                raise
+    else:
+        subpatches = split_patch(psf, patch)
+        if subpatches is None:
+            return _extract_patch(img, imgivar, psf, patch, ndiag=ndiag,
+                regularize=regularize, profile=profile, fibermask=fibermask,
+                model=model, A=A, mixed_precision=mixed_precision)
+
+    if splitlock is not None:
+        splitlock.acquire()
+    try:
+        results = [extract_patch(img, imgivar, psf, p, ndiag=ndiag,
+                       regularize=regularize, profile=profile,
+                       fibermask=fibermask, max_memory=max_memory, model=model,
+                       mixed_precision=mixed_precision)
+                   for p in subpatches]
+    finally:
+        if splitlock is not None:
+            splitlock.release()
+
+    #- Reassemble split along wavelength or spectra
+    if subpatches[0].specrange == patch.specrange:
+        flux = N.hstack([r[0] for r in results])
+        ivar = N.hstack([r[1] for r in results])
+        Rd = N.dstack([r[2] for r in results])
+    else:
+        flux = N.vstack([r[0] for r in results])
+        ivar = N.vstack([r[1] for r in results])
+        Rd = N.vstack([r[2] for r in results])
+
+    if profile:
+        return flux, ivar, Rd, _merge_profiles([r[3] for r in results])
+    else:
+        return flux, ivar, Rd
+
+def _extract_patch(img, imgivar, psf, patch, ndiag, regularize, profile,
+                   fibermask, model=None, A=None, mixed_precision=False):
+    """
+    Extract a single patch; see extract_patch
+    """
+    t0 = time()
+    xlo, xhi, ylo, yhi = xyrange = patch.xyrange
+    subimg = img[ylo:yhi, xlo:xhi]
+    subivar = imgivar[ylo:yhi, xlo:xhi]
+    if fibermask is not None:
+        fibermask = fibermask[patch.specrange[0]:patch.specrange[1]]
+
+    results = ex2d(subimg, subivar, psf,
+        specrange=patch.specrange, wavelengths=patch.ww,
+        xyrange=xyrange, regularize=regularize,
+        full_output=True, profile=profile, fibermask=fibermask, A=A,
+        mixed_precision=mixed_precision)
+    specflux, specivar, R = results['flux'], results['ivar'], results['R']
+
+    core = patch.core
+    Rd = ResolutionMatrix.from_dense(R, patch.nspec, ndiag, core).data
+
+    if model is not None:
+        #- Only the rows of the core, which no other patch owns
+        ymin, ymax = max(ylo, patch.yrange[0]), min(yhi, patch.yrange[1])
+        pix = results['A'].dot(results['xflux'].ravel()).reshape(subimg.shape)
+        model.add((xlo, xhi, ymin, ymax), pix[ymin-ylo:ymax-ylo])
+
+    if profile:
+        prof = results['profile']
+        prof['time_patch'] = time() - t0
+        return specflux[:, core], specivar[:, core], Rd, prof
+    else:
+        return specflux[:, core], specivar[:, core], Rd
+
+def patch_projection(imgivar, psf, patch, fibermask=None):
+    """
+    Return the projection matrix for extracting patch, which can be passed
+    to extract_patch to build it ahead of time
+
+    imgivar is the full image inverse variance and fibermask is as for
+    extract_patch
+    """
+    xlo, xhi, ylo, yhi = patch.xyrange
+    if fibermask is not None:
+        fibermask = fibermask[patch.specrange[0]:patch.specrange[1]]
+    return projection_matrix(psf, patch.specrange, patch.ww, patch.xyrange,
+                             imgivar[ylo:yhi, xlo:xhi], fibermask=fibermask)
+
+def _merge_profiles(profiles):
+    """
+    Combine the profiles of the pieces of a split patch
+    """
+    prof = dict()
+    for key in profiles[0]:
+        values = [p[key] for p in profiles]
+        if key in ('npix', 'nflux', 'cond'):
+            prof[key] = max(values)
+        else:
+            prof[key] = sum(values)
+    return prof
+
+def estimate_patch_memory(patch):
+    """
+    Estimate peak memory in bytes needed to extract patch
+
+    The peak is the larger of two stages of ex2d: building the projection
+    matrix [npix, nflux] as a dense array before converting it to sparse,
+    and the resolution matrix calculation which holds about six dense
+    [nflux, nflux] arrays at once (iCov, its eigenvectors, its square root,
+    R, and temporaries).  25% is added for the smaller arrays.
+    """
+    xmin, xmax, ymin, ymax = patch.xyrange
+    npix = (xmax-xmin) * (ymax-ymin)
+    nflux = patch.nspec * patch.nwave
+    return int(1.25 * 8 * max(npix*nflux, 6*nflux**2))
+
+def split_patch(psf, patch):
+    """
+    Split patch into two smaller patches that own the same output bins
+
+    Patches with more than one core wavelength are split in wavelength,
+    keeping the same number of border wavelengths; otherwise they are
+    split in spectra.  The new patches keep the ipatch of the original and
+    divide its model image rows.
+
+    Returns list of two Patch objects, or None if patch is a single
+    spectrum and wavelength
+    """
+    nlo, nhi = patch.nlo, patch.nhi
+    ww = patch.ww
+    ymin, ymax = patch.yrange
+    if patch.ncore > 1:
+        n1 = patch.ncore // 2
+        specmid = (patch.specrange[0] + patch.specrange[1]) // 2
+        ycut = min(max(ymin, _ycut(psf, specmid, ww[nlo+n1], ww[1]-ww[0])), ymax)
+        pieces = [(patch.specrange, patch.iwave, n1, ww[0:nlo+n1+nhi],
+                   (ymin, ycut)),
+                  (patch.specrange, patch.iwave+n1, patch.ncore-n1, ww[n1:],
+                   (ycut, ymax))]
+    elif patch.nspec > 1:
+        speclo, spechi = patch.specrange
+        specmid = speclo + patch.nspec//2
+        pieces = [((speclo, specmid), patch.iwave, patch.ncore, ww, patch.yrange),
+                  ((specmid, spechi), patch.iwave, patch.ncore, ww, patch.yrange)]
+    else:
+        return None
+
+    subpatches = list()
+    for specrange, iwave, ncore, ww, yrange in pieces:
+        #- Like plan_patches, the subimage covers one more wavelength bin
+        wlo = ww[nlo]
+        whi = ww[min(nlo+ncore, len(ww)-1)]
+        xyrange = psf.xyrange(specrange, (wlo, whi))
+        subpatches.append(Patch(patch.ipatch, specrange, iwave, ncore, ww,
+                                nlo, len(ww)-nlo-ncore, xyrange, yrange))
+
+    return subpatches
+
+def profile_summary(patches, profiles):
+    """
+    Aggregate per-patch ex2d profiles into a per-bundle summary table
+
+    Inputs:
+        patches : list of Patch objects
+        profiles : list of profile dictionaries from extract_patch,
+            one per patch
+
+    Returns numpy structured array with one row per bundle
+    """
+    timekeys = ('time_projection', 'time_icov', 'time_solve',
+                'time_resolution', 'time_patch')
+    dtype = [('SPECMIN', 'i4'), ('SPECMAX', 'i4'), ('NPATCH', 'i4')]
+    dtype += [(key.upper(), 'f8') for key in timekeys]
+    dtype += [('MAXNFLUX', 'i4'), ('NNZ_A', 'i8'), ('NNZ_ICOV', 'i8'),
+              ('CACHEHIT', 'f8'), ('MAXCOND', 'f8'), ('SLOWEST', 'i4')]
+
+    bundles = sorted(set([p.specrange for p in patches]))
+    summary = N.zeros(len(bundles), dtype=dtype)
+    for i, specrange in enumerate(bundles):
+        ii = [j for j, p in enumerate(patches) if p.specrange == specrange]
+        prof = [profiles[j] for j in ii]
+        row = summary[i]
+        row['SPECMIN'], row['SPECMAX'] = specrange[0], specrange[1]-1
+        row['NPATCH'] = len(ii)
+        for key in timekeys:
+            row[key.upper()] = sum([p[key] for p in prof])
+        row['MAXNFLUX'] = max([p['nflux'] for p in prof])
+        row['NNZ_A'] = sum([p['nnz_A'] for p in prof])
+        row['NNZ_ICOV'] = sum([p['nnz_iCov'] for p in prof])
+        nhit = sum([p['cache_hits'] for p in prof])
+        nmiss = sum([p['cache_misses'] for p in prof])
+        row['CACHEHIT'] = float(nhit) / max(1, nhit+nmiss)
+        row['MAXCOND'] = max([p['cond'] for p in prof])
+        row['SLOWEST'] = patches[ii[N.argmax([p['time_patch'] for p in prof])]].ipatch
+
+    return summary
@@ -0,0 +1,190 @@
+"""
+CCD image resampled along the traces of the spectra
+
+RectifiedImage resamples the columns around each spectrum's trace into a
+cube flux[nspec, nrow, nwidth] in which pixel j of row r of spectrum i is
+centered at x = xtrace[i, r] + j - halfwidth.  Row by row operations on a
+single spectrum are then contiguous array operations instead of slices
+gathered from the CCD image at positions recomputed from the PSF each
+time.  Each rectified pixel is one CCD pixel wide and so overlaps at most
+two CCD pixels; it is their overlap weighted sum, which preserves flux,
+and its variance is the correspondingly weighted sum of their variances.
+Neighboring rectified pixels share a CCD pixel and so are correlated; the
+inverse variance of the underlying CCD pixels is kept as well so that sums
+across a row, e.g. boxcar(), get the right variance.
+The cube can be written to a FITS file and memory mapped back as a cache.
+"""
+
+import numpy as N
+import fitsio
+
+from specter.io import memmap_image
+
+class RectifiedImage(object):
+    """
+    Image and inverse variance resampled along the traces of the spectra
+    """
+    def __init__(self, flux, ivar, xtrace, pixivar, specmin=0, ymin=0):
+        """
+        flux[nspec, nrow, nwidth], ivar[nspec, nrow, nwidth] : rectified
+            image and inverse variance
+        xtrace[nspec, nrow] : CCD x of the trace of each spectrum and row,
+            which is the center of the middle pixel of each row
+        pixivar[nspec, nrow, nwidth+1] : inverse variance of the CCD pixels
+            overlapped by each row, 0 off the CCD
+        specmin : first spectrum
+        ymin : first CCD row
+
+        Use rectify() to create one from a CCD image or
+        RectifiedImage.read() to read one from a file.
+        """
+        if flux.shape != ivar.shape or flux.shape[0:2] != xtrace.shape or \
+           pixivar.shape != flux.shape[0:2] + (flux.shape[2]+1,):
+            raise ValueError, "inconsistent shapes flux {}, ivar {}, xtrace {}, pixivar {}".format(
+                flux.shape, ivar.shape, xtrace.shape, pixivar.shape)
+        if flux.shape[2] % 2 != 1:
+            raise ValueError, "nwidth {} must be odd".format(flux.shape[2])
+        self.flux = flux
+        self.ivar = ivar
+        self.xtrace = xtrace
+        self.pixivar = pixivar
+        self.specmin = specmin
+        self.ymin = ymin
+
+    @property
+    def nspec(self):
+        return self.flux.shape[0]
+
+    @property
+    def halfwidth(self):
+        return self.flux.shape[2] // 2
+
+    @property
+    def rows(self):
+        """CCD rows of the cube"""
+        return self.ymin + N.arange(self.flux.shape[1])
+
+    def overlap(self):
+        """
+        Return f[nspec, nrow], the fraction of the first CCD pixel
+        overlapped by the first pixel of each row; pixel j is the sum of f
+        times CCD pixel j and 1-f times CCD pixel j+1 of pixivar
+        """
+        left = self.xtrace - self.halfwidth - 0.5
+        return N.floor(left + 0.5) + 0.5 - left
+
+    def boxcar(self, halfwidth=None):
+        """
+        Return flux[nspec, nrow], ivar[nspec, nrow] summed over the
+        pixels within halfwidth (default all) of each trace
+        """
+        if halfwidth is None:
+            halfwidth = self.halfwidth
+        j0 = self.halfwidth - halfwidth
+        j1 = self.halfwidth + halfwidth + 1
+        flux = self.flux[:, :, j0:j1].sum(axis=2)
+
+        #- The sum is over whole CCD pixels except for fractions f and 1-f
+        #- of the CCD pixels at either end
+        f = self.overlap()
+        pixivar = self.pixivar[:, :, j0:j1+1]
+        pixvar = 1.0 / N.where(pixivar > 0, pixivar, 1.0)
+        var = f**2 * pixvar[:, :, 0] + N.sum(pixvar[:, :, 1:-1], axis=2) + \
+              (1-f)**2 * pixvar[:, :, -1]
+        ivar = N.where(N.all(self.ivar[:, :, j0:j1] > 0, axis=2), 1.0/var, 0.0)
+        return flux, ivar
+
+    def write(self, filename):
+        """
+        Write to FITS filename with FLUX, IVAR, XTRACE, and PIXIVAR HDUs
+        """
+        hdr = fitsio.FITSHDR()
+        hdr.add_record(dict(name='SPECMIN', value=self.specmin, comment='First spectrum'))
+        hdr.add_record(dict(name='YMIN', value=self.ymin, comment='First CCD row'))
+        hdr.add_record(dict(name='HALFWID', value=self.halfwidth, comment='Pixels on either side of trace'))
+        fx = fitsio.FITS(filename, 'rw', clobber=True)
+        fx.write(N.asarray(self.flux, dtype='f8'), extname='FLUX', header=hdr)
+        fx.write(N.asarray(self.ivar, dtype='f8'), extname='IVAR')
+        fx.write(N.asarray(self.xtrace, dtype='f8'), extname='XTRACE')
+        fx.write(N.asarray(self.pixivar, dtype='f8'), extname='PIXIVAR')
+        fx.close()
+
+    @classmethod
+    def read(cls, filename, memmap=True):
+        """
+        Read a RectifiedImage written by write(); if memmap is True,
+        flux, ivar, xtrace and pixivar are read-only memory maps of the file
+        """
+        hdr = fitsio.read_header(filename, 'FLUX')
+        data = list()
+        for ext in ('FLUX', 'IVAR', 'XTRACE', 'PIXIVAR'):
+            x = memmap_image(filename, ext) if memmap else None
+            if x is None:
+                x = fitsio.read(filename, ext)
+            data.append(x)
+        return cls(*data, specmin=hdr['SPECMIN'], ymin=hdr['YMIN'])
+
+def rectify(img, ivar, psf, specrange=None, yrange=None, halfwidth=None):
+    """
+    Resample img and ivar along the traces of the spectra
+
+    Inputs:
+        img[ny, nx] : CCD image
+        ivar[ny, nx] : inverse variance of img
+        psf : PSF object
+
+    Optional Inputs:
+        specrange : (specmin, specmax) python style range of spectra,
+            default all
+        yrange : (ymin, ymax) python style range of CCD rows, default all
+        halfwidth : number of pixels on either side of each trace; default
+            half of the median spacing of the traces, or 3 times the PSF
+            xsigma for a single spectrum
+
+    Returns RectifiedImage.  Pixels off the edge of the CCD or overlapping
+    a CCD pixel with ivar=0 get ivar=0.
+    """
+    specmin, specmax = specrange if (specrange is not None) else (0, psf.nspec)
+    ymin, ymax = yrange if (yrange is not None) else (0, min(psf.npix_y, img.shape[0]))
+    nspec = specmax - specmin
+    rows = N.arange(ymin, ymax)
+    nx = img.shape[1]
+
+    xtrace = N.zeros((nspec, len(rows)))
+    for i in range(nspec):
+        w = psf.wavelength(specmin+i, y=rows)
+        xtrace[i] = psf.x(specmin+i, w)
+
+    if halfwidth is None:
+        if nspec > 1:
+            halfwidth = int(N.ceil(0.5*N.median(N.diff(xtrace, axis=0))))
+        else:
+            w = psf.wavelength(specmin, y=0.5*(ymin+ymax))
+            halfwidth = int(N.ceil(3*psf.xsigma(specmin, w)))
+    nwidth = 2*halfwidth + 1
+
+    flux = N.zeros((nspec, len(rows), nwidth))
+    rivar = N.zeros((nspec, len(rows), nwidth))
+    pixivar = N.zeros((nspec, len(rows), nwidth+1))
+    for i in range(nspec):
+        #- Rectified pixel j spans [left+j, left+j+1]; it overlaps CCD
+        #- pixel k0+j by a fraction f and pixel k0+j+1 by 1-f
+        left = xtrace[i] - halfwidth - 0.5
+        k0 = N.floor(left + 0.5).astype(int)
+        f = (k0 + 0.5 - left)[:, None]
+        cols = k0[:, None] + N.arange(nwidth+1)
+        onccd = (cols >= 0) & (cols < nx)
+        cols = N.clip(cols, 0, nx-1)
+        pix = N.where(onccd, img[rows[:, None], cols], 0.0)
+        pixivar[i] = N.where(onccd, ivar[rows[:, None], cols], 0.0)
+
+        flux[i] = f*pix[:, :-1] + (1-f)*pix[:, 1:]
+
+        #- Propagate variance, skipping pixels with zero weight
+        pixvar = 1.0 / N.where(pixivar[i] > 0, pixivar[i], 1.0)
+        var = f**2 * pixvar[:, :-1] + (1-f)**2 * pixvar[:, 1:]
+        bad = (pixivar[i, :, :-1] == 0) | ((pixivar[i, :, 1:] == 0) & (f < 1))
+        rivar[i] = N.where(bad, 0.0, 1.0/var)
+
+    return RectifiedImage(flux, rivar, xtrace, pixivar, specmin=specmin,
+                          ymin=ymin)
@@ -0,0 +1,139 @@
+"""
+Banded resolution matrices of extracted spectra
+
+Each extracted spectrum has its own resolution matrix R, which is
+concentrated near the diagonal.  ResolutionMatrix keeps the 2*ndiag+1
+central diagonals of R for a set of spectra in the same layout as the
+exspec RESOLUTION HDU:
+
+    data[ispec, k, j] = R_ispec[j + k - ndiag, j]
+
+i.e. column j of R_ispec is stored in data[ispec, :, j].  This is the
+scipy.sparse.dia_matrix layout with offsets ndiag - arange(2*ndiag+1).
+"""
+
+import numpy as N
+import scipy.sparse
+import fitsio
+
+class ResolutionMatrix(object):
+    """
+    Banded resolution matrices for a set of spectra
+    """
+    def __init__(self, data):
+        """
+        data[nspec, 2*ndiag+1, nwave] : diagonals of the resolution matrices
+        """
+        data = N.asarray(data)
+        if data.ndim != 3 or data.shape[1] % 2 != 1:
+            raise ValueError, "data must have shape [nspec, 2*ndiag+1, nwave]"
+        self.data = data
+
+    @property
+    def nspec(self):
+        return self.data.shape[0]
+
+    @property
+    def ndiag(self):
+        return self.data.shape[1] // 2
+
+    @property
+    def nwave(self):
+        return self.data.shape[2]
+
+    @property
+    def offsets(self):
+        """dia_matrix offsets (column - row) of each diagonal"""
+        return self.ndiag - N.arange(2*self.ndiag+1)
+
+    @staticmethod
+    def from_dense(R, nspec, ndiag, core=None):
+        """
+        Pack the diagonals of a dense resolution matrix, e.g. from ex2d
+
+        Inputs:
+            R[nspec*nwave, nspec*nwave] : resolution matrix of nspec spectra
+            nspec : number of spectra
+            ndiag : number of off-diagonal elements to keep
+
+        Optional Inputs:
+            core : slice of wavelength columns to keep; default all
+
+        Elements outside of R are packed as 0.  Returns ResolutionMatrix
+        """
+        nwave = R.shape[0] // nspec
+        if core is None:
+            core = slice(0, nwave)
+        cols = N.arange(nwave)[core]
+        rows = cols + N.arange(-ndiag, ndiag+1)[:, None]
+        inside = (0 <= rows) & (rows < nwave)
+        rows = N.clip(rows, 0, nwave-1)
+
+        #- [nspec, 2*ndiag+1, ncore] indices into R for every spectrum
+        offset = (nwave * N.arange(nspec))[:, None, None]
+        data = R[rows + offset, cols + offset]
+        data *= inside
+        return ResolutionMatrix(data)
+
+    def matrix(self, ispec):
+        """
+        Return scipy.sparse.dia_matrix resolution matrix of spectrum ispec
+        """
+        return scipy.sparse.dia_matrix( (self.data[ispec], self.offsets),
+                                        shape=(self.nwave, self.nwave) )
+
+    def dot(self, flux):
+        """
+        Return R_i flux[i] for every spectrum i
+
+        flux : array[nspec, nwave], or [nwave] to apply to every spectrum
+        """
+        flux = N.asarray(flux)
+        result = N.zeros(N.broadcast(self.data[:, 0], flux).shape)
+        for k, offset in enumerate(self.offsets):
+            #- result[row] += R[row, row+offset] * flux[row+offset]
+            if offset >= 0:
+                result[..., 0:self.nwave-offset] += \
+                    self.data[:, k, offset:] * flux[..., offset:]
+            else:
+                result[..., -offset:] += \
+                    self.data[:, k, 0:self.nwave+offset] * flux[..., 0:self.nwave+offset]
+        return result
+
+    def tdot(self, flux):
+        """
+        Return R_i^T flux[i] for every spectrum i
+
+        flux : array[nspec, nwave], or [nwave] to apply to every spectrum
+        """
+        flux = N.asarray(flux)
+        result = N.zeros(N.broadcast(self.data[:, 0], flux).shape)
+        for k, offset in enumerate(self.offsets):
+            #- result[col] += R[col-offset, col] * flux[col-offset]
+            if offset >= 0:
+                result[..., offset:] += \
+                    self.data[:, k, offset:] * flux[..., 0:self.nwave-offset]
+            else:
+                result[..., 0:self.nwave+offset] += \
+                    self.data[:, k, 0:self.nwave+offset] * flux[..., -offset:]
+        return result
+
+    def write(self, filename, extname='RESOLUTION', dtype=N.float64,
+              header=None):
+        """
+        Append as an image HDU to filename, optionally converting to dtype,
+        e.g. numpy.float32 for half the size
+        """
+        hdr = [dict(name='NDIAG', value=self.ndiag,
+                    comment='Number of off-diagonal elements')]
+        if header is not None:
+            hdr.extend(header)
+        fitsio.write(filename, self.data.astype(dtype), extname=extname,
+                     header=hdr)
+
+    @staticmethod
+    def read(filename, extname='RESOLUTION'):
+        """
+        Read ResolutionMatrix from filename HDU extname
+        """
+        return ResolutionMatrix(fitsio.read(filename, extname))
@@ -0,0 +1,319 @@
+"""
+Run extraction patches in parallel across a pool of processes
+
+The input image and ivar are placed in shared memory once and inherited
+by the worker processes; each worker writes the core of each patch that
+it extracts directly into shared output arrays.  Since every output bin is
+owned by exactly one patch, the results do not depend upon the order in
+which the patches are run.  Model image pieces are returned to this
+process to be accumulated, so workers never add into the same pixels.
+
+With a single process, the projection matrices of upcoming patches are
+built in a background thread while the current patch is solved.
+"""
+
+import sys
+import traceback
+from time import time
+import threading
+import multiprocessing as MP
+import numpy as N
+
+from specter.extract.patch import extract_patch, patch_projection
+from specter.extract.patch import estimate_patch_memory
+from specter.util.sharedmem import shared_array, as_shared, limit_blas_threads
+from specter.util.pipeline import prefetch
+
+#- Filled by _set_worker in each worker process (or this process)
+_worker = dict()
+
+def _set_worker(img, imgivar, psf, patches, specmin, ndiag, regularize,
+                profile, fibermask, max_memory, mixed_precision, keep_going,
+                model, flux, ivar, Rd):
+    """
+    Store shared inputs and outputs for use by _extract_one
+    """
+    _worker.update(img=img, imgivar=imgivar, psf=psf, patches=patches,
+        specmin=specmin, ndiag=ndiag, regularize=regularize,
+        profile=profile, fibermask=fibermask, max_memory=max_memory,
+        mixed_precision=mixed_precision, keep_going=keep_going, model=model,
+        flux=flux, ivar=ivar, Rd=Rd)
+
+def _init_worker(*args):
+    """
+    Initialize a worker process with one BLAS thread and the shared arrays
+    """
+    limit_blas_threads(1)
+    _set_worker(*args)
+
+class _ModelPieces(list):
+    """
+    Collect (xyrange, image) model pieces from extract_patch
+    """
+    def add(self, xyrange, image):
+        self.append( (xyrange, image) )
+
+def _project_one(ipatch):
+    """
+    Return (ipatch, A, prof) with the projection matrix A for
+    patches[ipatch], or A=None if the patch will be split or building A
+    fails, in which case _extract_one builds it or reports the error
+
+    prof is None unless profiling, in which case it is a dictionary of the
+    time_projection, cache_hits, and cache_misses of building A
+    """
+    w = _worker
+    patch = w['patches'][ipatch]
+    if w['max_memory'] is not None and \
+       estimate_patch_memory(patch) > w['max_memory']:
+        return ipatch, None, None
+    try:
+        #- Spots are only evaluated while holding the lock, so the cache
+        #- stats of just this patch's projection can be measured here
+        with w['psflock']:
+            t0 = time()
+            nhit, nmiss = w['psf'].cache_stats()
+            A = patch_projection(w['imgivar'], w['psf'], patch,
+                                 fibermask=w['fibermask'])
+            nhit2, nmiss2 = w['psf'].cache_stats()
+            prof = dict(time_projection=time()-t0,
+                        cache_hits=nhit2-nhit, cache_misses=nmiss2-nmiss)
+    except Exception:
+        return ipatch, None, None
+    if w['profile']:
+        return ipatch, A, prof
+    else:
+        return ipatch, A, None
+
+def _extract_one(ipatch, A=None, aprof=None):
+    """
+    Extract patches[ipatch] and write results into the output arrays,
+    using projection matrix A if it was built ahead of time, in which case
+    aprof is the profile of building it from _project_one
+
+    Returns (ipatch, profile, error, pieces, core) where profile is None
+    unless requested, error is None unless the patch failed with keep_going
+    set, in which case it is the formatted traceback, pieces is a list of
+    model image (xyrange, image) pieces if the model was requested, else
+    None, and core is the (flux, ivar, Rd) core results of the patch if
+    there are no output arrays to write them into, else None
+    """
+    w = _worker
+    patch = w['patches'][ipatch]
+    pieces = _ModelPieces() if w['model'] else None
+
+    #- The PSF spot cache isn't thread safe, so hold the lock if PSF spots
+    #- may be evaluated while the prefetch thread is running.  With A built
+    #- ahead of time, spots are only evaluated if the patch is split after
+    #- a MemoryError, which extract_patch does holding splitlock.
+    psflock = w.get('psflock')
+    if psflock is None:
+        psflock, splitlock = _nolock, None
+    elif A is not None:
+        psflock, splitlock = _nolock, psflock
+    else:
+        splitlock = None
+    try:
+        with psflock:
+            results = extract_patch(w['img'], w['imgivar'], w['psf'],
+                patch, ndiag=w['ndiag'], regularize=w['regularize'],
+                profile=w['profile'], fibermask=w['fibermask'],
+                max_memory=w['max_memory'], model=pieces, A=A,
+                splitlock=splitlock, mixed_precision=w['mixed_precision'])
+    except Exception:
+        if w['keep_going']:
+            return ipatch, None, traceback.format_exc(), None, None
+        raise
+    specflux, specivar, Rd = results[0:3]
+    prof = results[3] if w['profile'] else None
+    if prof is not None and aprof is not None:
+        for key in aprof:
+            prof[key] += aprof[key]
+
+    if w['flux'] is None:
+        return ipatch, prof, None, pieces, (specflux, specivar, Rd)
+
+    ii, jj = _core_slices(patch, w['specmin'])
+    w['flux'][ii, jj] = specflux
+    w['ivar'][ii, jj] = specivar
+    w['Rd'][ii, :, jj] = Rd
+
+    return ipatch, prof, None, pieces, None
+
+class _NoLock(object):
+    def __enter__(self):
+        pass
+    def __exit__(self, *args):
+        pass
+
+_nolock = _NoLock()
+
+def _core_slices(patch, specmin):
+    """
+    Return (spectrum, wavelength) slices of the output arrays owned by patch
+    """
+    speclo, spechi = patch.specrange
+    ii = slice(speclo-specmin, spechi-specmin)
+    jj = slice(patch.iwave, patch.iwave+patch.ncore)
+    return ii, jj
+
+def extract_patches(img, imgivar, psf, patches, nwave, specrange,
+                    ndiag=10, regularize=0.0, numcores=1, verbose=False,
+                    profile=False, fibermask=None, skip=None, callback=None,
+                    failed=None, max_memory=None, model=None, pipeline=True,
+                    cache=None, outputs=True, mixed_precision=False):
+    """
+    Extract a list of patches, returning the combined outputs
+
+    Inputs:
+        img[npix_y, npix_x] : full CCD image, either a numpy array or an
+            ImageSections object that reads only the patch subimages
+        imgivar[npix_y, npix_x] : inverse variance of img, likewise
+        psf : PSF object
+        patches : list of Patch objects from plan_patches()
+        nwave : number of output wavelengths
+        specrange : (specmin, specmax) python style range of spectra
+
+    Optional Inputs:
+        ndiag : number of off-diagonal resolution matrix elements to keep
+        regularize : ex2d regularization amount
+        numcores : number of processes to use; 1 runs in this process
+        verbose : if True, print progress for each patch
+        profile : if True, also return a list of per-patch profile
+            dictionaries; see extract_patch and ex2d
+        fibermask : array[psf.nspec] of fiber mask values, nonzero = bad;
+            if None, each patch derives a mask from imgivar
+        skip : collection of Patch.ipatch values to leave out, e.g. patches
+            already completed in a checkpoint; their outputs are left as 0
+        callback : function called in this process as
+            callback(patch, flux, ivar, Rd) after each patch completes,
+            with the core results for just that patch
+        failed : if a list, patches that raise an exception are appended
+            to it as (Patch.ipatch, traceback) and the remaining patches are still
+            extracted; otherwise the exception is raised
+        max_memory : approximate memory budget in bytes per worker; patches
+            exceeding it are split, see extract_patch
+        model : ModelImage (or any object with an add(xyrange, image)
+            method) into which the model image of the extracted flux bins
+            is accumulated; see extract_patch
+        pipeline : if True and numcores is 1, build projection matrices for
+            upcoming patches in a background thread while the current patch
+            is solved.  This is serial only: with numcores > 1 the pool
+            workers already keep the cores busy and pipeline is ignored
+        cache : PatchCache of results to reuse for patches whose inputs
+            are unchanged; newly extracted patches are added to it.  Cached
+            results are not used if model is requested.
+        outputs : if False, don't allocate the combined output arrays and
+            return None in their place; results are only passed to callback,
+            e.g. to write each bundle as soon as its patches are done
+        mixed_precision : passed to ex2d; see its accuracy there
+
+    Returns (flux, ivar, Rd):
+        flux[nspec, nwave]
+        ivar[nspec, nwave]
+        Rd[nspec, 2*ndiag+1, nwave] : diagonals of the resolution matrix
+
+    or (flux, ivar, Rd, profiles) if profile is True
+    """
+    specmin, specmax = specrange
+    nspec = specmax - specmin
+    if skip is None:
+        todo = range(len(patches))
+    else:
+        todo = [i for i, p in enumerate(patches) if p.ipatch not in skip]
+
+    #- Look up cached results and extract only the rest
+    cached = dict()
+    if cache is not None:
+        keys = dict()
+        for i in todo:
+            keys[i] = cache.key(img, imgivar, patches[i], ndiag, regularize,
+                                fibermask, max_memory, mixed_precision)
+            if model is None:
+                result = cache.get(keys[i])
+                if result is not None:
+                    cached[i] = result
+        todo = [i for i in todo if i not in cached]
+    numcores = max(1, min(numcores, len(todo)))
+
+    if numcores > 1:
+        #- ImageSections are read by each worker as needed instead
+        if isinstance(img, N.ndarray):
+            img = as_shared(img)
+        if isinstance(imgivar, N.ndarray):
+            imgivar = as_shared(imgivar)
+
+    if not outputs:
+        flux = ivar = Rd = None
+    elif numcores > 1:
+        flux = shared_array( (nspec, nwave) )
+        ivar = shared_array( (nspec, nwave) )
+        Rd = shared_array( (nspec, 2*ndiag+1, nwave) )
+    else:
+        flux = N.zeros( (nspec, nwave) )
+        ivar = N.zeros( (nspec, nwave) )
+        Rd = N.zeros( (nspec, 2*ndiag+1, nwave) )
+
+    for i in sorted(cached):
+        patch = patches[i]
+        if outputs:
+            ii, jj = _core_slices(patch, specmin)
+            flux[ii, jj], ivar[ii, jj], Rd[ii, :, jj] = cached[i]
+        if callback is not None:
+            callback(patch, *cached[i])
+        if verbose:
+            print "cached {}".format(patch)
+
+    initargs = (img, imgivar, psf, patches, specmin, ndiag, regularize,
+                profile, fibermask, max_memory, mixed_precision,
+                failed is not None, model is not None, flux, ivar, Rd)
+
+    pool = fetched = None
+    if numcores == 1:
+        _set_worker(*initargs)
+        if pipeline:
+            _worker['psflock'] = threading.Lock()
+            fetched = prefetch(_project_one, todo, maxsize=2)
+            results = (_extract_one(i, A, aprof) for i, A, aprof in fetched)
+        else:
+            results = (_extract_one(i) for i in todo)
+    else:
+        pool = MP.Pool(numcores, initializer=_init_worker, initargs=initargs)
+        results = pool.imap_unordered(_extract_one, todo)
+
+    profiles = [None,] * len(patches)
+    try:
+        for n, (ipatch, prof, err, pieces, core) in enumerate(results):
+            patch = patches[ipatch]
+            if err is not None:
+                print >> sys.stderr, "ERROR: {} failed\n{}".format(patch, err)
+                failed.append( (patch.ipatch, err) )
+                continue
+
+            profiles[ipatch] = prof
+            if pieces is not None:
+                for xyrange, image in pieces:
+                    model.add(xyrange, image)
+            if core is None:
+                ii, jj = _core_slices(patch, specmin)
+                core = (flux[ii, jj], ivar[ii, jj], Rd[ii, :, jj])
+            if cache is not None:
+                cache.put(keys[ipatch], *core)
+            if callback is not None:
+                callback(patch, *core)
+            if verbose:
+                print "{}/{} {}".format(n+1, len(todo), patch)
+                sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        #- Stop the prefetch thread before it can see the cleared _worker
+        if fetched is not None:
+            fetched.close()
+        _worker.clear()
+
+    if profile:
+        return flux, ivar, Rd, profiles
+    else:
+        return flux, ivar, Rd
@@ -0,0 +1,261 @@
+"""
+Choose extraction patch geometry for a PSF
+
+The best patch size depends upon the PSF: the spot extent sets how many
+border wavelengths each patch needs, the falloff of the resolution matrix
+sets how many diagonals are worth keeping, and the cost of the ex2d solve
+relative to the projection sets how many core wavelengths per patch
+amortize the borders best.  These are measured with a short calibration
+run of small ex2d solves for the PSF in question.  The patch size and
+number of workers can then be limited to fit within a memory budget.
+"""
+
+from time import time
+import numpy as N
+from scipy.optimize import nnls
+
+from specter.extract.ex2d import ex2d
+from specter.extract.patch import plan_patches, estimate_patch_memory
+
+def spot_extent(psf, specrange, wavelengths, frac=1e-4):
+    """
+    Return the largest half-height in pixels of PSF spots, sampled at the
+    ends and middle of specrange and wavelengths, that contains all but
+    frac of the spot flux
+    """
+    specmin, specmax = specrange
+    ispec = sorted(set([specmin, (specmin+specmax)//2, specmax-1]))
+    nwave = len(wavelengths)
+    ww = [wavelengths[nwave//10], wavelengths[nwave//2], wavelengths[-1-nwave//10]]
+
+    halfheight = 0
+    for i in ispec:
+        for w in ww:
+            xslice, yslice, pix = psf.xypix(i, w)
+            ycum = N.cumsum(pix.sum(axis=1))
+            ycum /= ycum[-1]
+            ylo = yslice.start + N.searchsorted(ycum, 0.5*frac)
+            yhi = yslice.start + N.searchsorted(ycum, 1-0.5*frac)
+            y = psf.y(i, w)
+            halfheight = max(halfheight, y-ylo, yhi+1-y)
+
+    return int(N.ceil(halfheight))
+
+def fiber_bundles(psf):
+    """
+    Return the number of fibers per bundle from gaps in the spacing of the
+    fiber traces, or None if there are no gaps or they are not regular
+    """
+    if psf.nspec < 3:
+        return None
+
+    wmid = 0.5*(psf.wmin + psf.wmax)
+    dx = N.diff(psf.x(None, wmid))
+    gaps = N.where(dx > 1.5*N.median(dx))[0]
+    if len(gaps) == 0:
+        return None
+
+    sizes = N.diff(N.concatenate( ([-1], gaps, [psf.nspec-1]) ))
+    if N.all(sizes == sizes[0]):
+        return int(sizes[0])
+    else:
+        return None
+
+#- Candidate numbers of core wavelengths per patch.  Extraction results
+#- depend slightly on the patch boundaries, so only a coarse set of values
+#- is used to keep the choice stable against timing noise.
+_nwsteps = (10, 15, 20, 25, 30, 40, 50, 60, 80, 100, 125, 150, 200, 250)
+
+def calibrate(psf, specrange, wavelengths, nwave=None, rtol=1e-3, nrepeat=3):
+    """
+    Time ex2d solves of specrange spectra for several numbers of wavelengths
+
+    Inputs:
+        psf : PSF object
+        specrange : (specmin, specmax) python style range of spectra
+        wavelengths : 1D array of output wavelengths; calibration patches
+            are taken from its middle
+
+    Optional Inputs:
+        nwave : numbers of wavelengths to time; default reaches ~800 flux
+            bins so that the cost of the dense solve is measured
+        rtol : resolution matrix elements smaller than rtol times the
+            diagonal are not counted for ndiag
+        nrepeat : number of times to repeat each solve; the fastest is used
+
+    Returns (nflux, times, ndiag):
+        nflux : array of number of flux bins in each calibration solve
+        times : array of fastest ex2d wall times for each solve
+        ndiag : number of resolution matrix off-diagonals above rtol
+    """
+    nspec = specrange[1] - specrange[0]
+    dw = wavelengths[1] - wavelengths[0]
+    wmid = wavelengths[len(wavelengths)//2]
+    if nwave is None:
+        nw = max(40, 800//nspec)
+        nwave = (nw//8, nw//4, nw//2, nw)
+
+    nflux = list()
+    times = list()
+    for i, nw in enumerate(sorted(nwave)):
+        ww = wmid + dw*(N.arange(nw) - nw//2)
+        xyrange = xmin, xmax, ymin, ymax = psf.xyrange(specrange, ww)
+        image = N.zeros( (ymax-ymin, xmax-xmin) )
+        ivar = N.ones(image.shape)
+
+        #- Warm up the PSF spot cache with the first one
+        if i == 0:
+            ex2d(image, ivar, psf, specrange, ww, xyrange=xyrange)
+
+        dt = list()
+        for j in range(nrepeat):
+            t0 = time()
+            results = ex2d(image, ivar, psf, specrange, ww, xyrange=xyrange,
+                           full_output=True)
+            dt.append(time() - t0)
+        times.append(min(dt))
+        nflux.append(nspec*nw)
+
+    #- Resolution falloff from the middle spectrum of the largest solve,
+    #- using the central columns to avoid edge effects
+    R = results['R']
+    i = nspec//2
+    Rx = R[i*nw:(i+1)*nw, i*nw:(i+1)*nw]
+    ndiag = 0
+    for j in range(nw//2-1, nw//2+2):
+        k = N.where(N.abs(Rx[:, j]) > rtol*Rx[j, j])[0]
+        ndiag = max(ndiag, N.max(N.abs(k-j)))
+
+    return N.array(nflux), N.array(times), int(ndiag)
+
+def tune_patches(psf, wavelengths, specrange, bundlesize=None, nwstep=None,
+                 ndiag=None, border=None, maxstep=200, verbose=False):
+    """
+    Choose extraction patch parameters for a PSF
+
+    Inputs:
+        psf : PSF object
+        wavelengths : uniformly spaced 1D array of output wavelengths
+        specrange : (specmin, specmax) python style range of spectra
+
+    Optional Inputs:
+        bundlesize, nwstep, ndiag, border : if not None, use these values
+            instead of choosing them
+        maxstep : maximum number of core wavelengths per patch
+        verbose : if True, print the calibration timings
+
+    Returns dictionary with keys:
+        bundlesize : number of spectra per bundle, from the gaps between
+            fiber bundles in the PSF, or 20 if there are no gaps
+        border : border in CCD rows beyond each patch core, from the
+            PSF spot extent
+        ndiag : number of resolution matrix off-diagonals to keep, from
+            the resolution matrix falloff
+        nwstep : number of core wavelengths per patch, minimizing the
+            calibrated ex2d time per output wavelength including borders
+            over a coarse set of candidate values
+    """
+    specmin, specmax = specrange
+    nspec = specmax - specmin
+    nwave = len(wavelengths)
+    dw = wavelengths[1] - wavelengths[0]
+
+    if bundlesize is None:
+        bundlesize = fiber_bundles(psf) or 20
+    bundlesize = min(bundlesize, nspec)
+
+    if border is None:
+        #- Wavelengths outside the core affect the core pixels out to twice
+        #- the spot half-height
+        border = 2*spot_extent(psf, specrange, wavelengths)
+
+    if ndiag is None or nwstep is None:
+        #- Calibrate with a bundle from the middle of specrange
+        speclo = specmin + (nspec - bundlesize)//2
+        calrange = (speclo, speclo+bundlesize)
+        nflux, times, caldiag = calibrate(psf, calrange, wavelengths)
+        if verbose:
+            for n, t in zip(nflux, times):
+                print "calibration nflux {:5d}  {:.3f} sec".format(n, t)
+
+    if ndiag is None:
+        ndiag = caldiag
+
+    if nwstep is None:
+        #- Fit time = a n + b n^2 + c n^3 for n flux bins
+        basis = lambda n: N.array([n, n**2, n**3], dtype=float).T
+        coeff = nnls(basis(nflux), times)[0]
+
+        #- Border wavelengths on both sides, in bins
+        wmid = wavelengths[nwave//2]
+        ispec = (specmin+specmax)//2
+        rows_per_bin = abs(psf.y(ispec, wmid+dw) - psf.y(ispec, wmid))
+        nborder = 2*int(N.ceil(border / rows_per_bin))
+
+        steps = N.array([n for n in _nwsteps if n <= min(maxstep, nwave)])
+        if len(steps) == 0:
+            steps = N.array([min(maxstep, nwave)])
+        cost = basis(bundlesize*(steps+nborder)).dot(coeff) / steps
+        nwstep = int(steps[N.argmin(cost)])
+
+    return dict(bundlesize=int(bundlesize), nwstep=nwstep, ndiag=ndiag,
+                border=int(border))
+
+def fit_memory(psf, wavelengths, specrange, bundlesize, nwstep, max_memory,
+               border=None, minstep=5):
+    """
+    Shrink patches until every patch is estimated to fit within max_memory
+
+    nwstep is reduced first, down to minstep, and then bundlesize.
+
+    Inputs:
+        psf : PSF object
+        wavelengths : uniformly spaced 1D array of output wavelengths
+        specrange : (specmin, specmax) python style range of spectra
+        bundlesize, nwstep : starting patch size
+        max_memory : memory budget in bytes per patch
+
+    Optional Inputs:
+        border : see plan_patches
+        minstep : smallest nwstep to consider before shrinking bundlesize
+
+    Returns (bundlesize, nwstep, peak) where peak is the largest estimated
+    patch memory in bytes.  Raises ValueError if even single spectrum
+    patches of minstep wavelengths don't fit.
+    """
+    while True:
+        patches = plan_patches(psf, wavelengths, specrange, bundlesize,
+                               nwstep, border=border)
+        peak = max([estimate_patch_memory(p) for p in patches])
+        if peak <= max_memory:
+            return bundlesize, nwstep, peak
+        elif nwstep > minstep:
+            nwstep = max(minstep, int(0.7*nwstep))
+        elif bundlesize > 1:
+            bundlesize = (bundlesize+1)//2
+        else:
+            raise ValueError, "Patches need {:.0f} MB > {:.0f} MB memory budget".format(peak/1e6, max_memory/1e6)
+
+def available_memory():
+    """
+    Return available system memory in bytes, or None if unknown
+    """
+    try:
+        with open('/proc/meminfo') as fx:
+            for line in fx:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def max_workers(max_memory, shared=0):
+    """
+    Return the number of workers with max_memory bytes each that fit in
+    the available system memory, after allocating shared bytes of shared
+    memory, or None if the available memory is unknown
+    """
+    avail = available_memory()
+    if avail is None:
+        return None
+    return max(1, int((avail - shared) // max_memory))
@@ -0,0 +1,101 @@
+"""
+Tabulated cross-dispersion profiles of a PSF for row-by-row extraction
+
+The cross-dispersion profile of a spectrum on a CCD row is the PSF spot
+summed along y.  ProfileTable samples the spots of each spectrum once on a
+grid of wavelengths and tabulates the profile integrated over pixels for a
+grid of sub-pixel trace positions (phases), so that ex1d can interpolate
+profiles from the table instead of evaluating a Gaussian on every row.
+Unlike a Gaussian with the fitted xsigma, the table keeps the actual shape
+of the PSF, e.g. the non-Gaussian tails of a GaussHermite PSF.
+"""
+
+import numpy as N
+from scipy.interpolate import PchipInterpolator
+
+class ProfileTable(object):
+    """
+    Cross-dispersion profiles of a range of spectra vs. wavelength and phase
+    """
+    def __init__(self, psf, specrange=None, nwave=20, nphase=20):
+        """
+        psf : PSF object
+        specrange : (specmin, specmax) python style range of spectra to
+            tabulate; default all spectra of the PSF
+        nwave : number of wavelengths sampled per spectrum, evenly spaced
+            in CCD rows
+        nphase : number of sub-pixel phases per pixel
+
+        self.table[nspec, nwave, nphase+1, noffset] is the fraction of
+        the flux of spectrum specmin+i at wavelength self.wave[i, j] that
+        falls in column floor(x) + self.offsets[k] when the trace center
+        x is a fraction k/nphase of a pixel past floor(x).
+        """
+        specmin, specmax = specrange if (specrange is not None) else (0, psf.nspec)
+        self.specmin, self.specmax = specmin, specmax
+        nspec = specmax - specmin
+        self.nphase = nphase
+
+        #- Normalized spot profiles and the x of their first pixel edge
+        #- relative to the trace center
+        yy = N.linspace(0, psf.npix_y-1, nwave)
+        self.wave = N.zeros((nspec, nwave))
+        spots = list()
+        for i in range(nspec):
+            ispec = specmin + i
+            self.wave[i] = psf.wavelength(ispec, y=yy)
+            for w in self.wave[i]:
+                xx, yslice, pix = psf.xypix(ispec, w)
+                prof = pix.sum(axis=0)
+                prof /= prof.sum()
+                spots.append( (xx.start - 0.5 - psf.x(ispec, w), prof) )
+
+        #- Columns relative to floor(x) that any profile can reach
+        lo = int(N.floor(min([e0 for e0, prof in spots]))) - 1
+        hi = int(N.ceil(max([e0+len(prof) for e0, prof in spots]))) + 1
+        self.offsets = N.arange(lo, hi)
+
+        #- Integrate each profile over pixels at every phase by interpolating
+        #- its cumulative distribution at the pixel edges
+        phase = N.arange(nphase+1) / float(nphase)
+        edges = self.offsets[None, :] - 0.5 - phase[:, None]
+        edges = N.hstack([edges, edges[:, -1:]+1])
+        self.table = N.zeros((nspec*nwave, nphase+1, len(self.offsets)))
+        for n, (e0, prof) in enumerate(spots):
+            x = e0 + N.arange(len(prof)+1)
+            cdf = PchipInterpolator(x, N.concatenate([[0.0], N.cumsum(prof)]))
+            c = cdf(N.clip(edges, x[0], x[-1]))
+            self.table[n] = N.diff(c, axis=1)
+        self.table = self.table.reshape((nspec, nwave, nphase+1, len(self.offsets)))
+
+    def profiles(self, ispec, wavelength, x):
+        """
+        Interpolate profiles of spectrum ispec at wavelength[n] with trace
+        centers x[n]
+
+        Returns (columns[n, noffset], profile[n, noffset]) such that
+        profile[i, k] is the fraction of the flux of row i in CCD column
+        columns[i, k]
+        """
+        if ispec < self.specmin or ispec >= self.specmax:
+            raise ValueError, "spectrum %d not in table for spectra %d:%d" % \
+                (ispec, self.specmin, self.specmax)
+        wave = self.wave[ispec-self.specmin]
+        table = self.table[ispec-self.specmin]
+        x = N.asarray(x, dtype=float)
+        ix = N.floor(x).astype(int)
+
+        #- Bilinear interpolation in wavelength and phase
+        fw = N.interp(wavelength, wave, N.arange(len(wave)))
+        iw = N.minimum(fw.astype(int), len(wave)-2)
+        fw -= iw
+        fp = (x - ix) * self.nphase
+        ip = N.minimum(fp.astype(int), self.nphase-1)
+        fp -= ip
+
+        fw = fw[:, None]
+        fp = fp[:, None]
+        prof = (1-fw) * ((1-fp)*table[iw, ip] + fp*table[iw, ip+1]) + \
+               fw * ((1-fp)*table[iw+1, ip] + fp*table[iw+1, ip+1])
+
+        return ix[:, None] + self.offsets, prof
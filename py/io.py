@@ -6,6 +6,7 @@ Stephen Bailey, LBL
 January 2013
 """
 
+import os
 import fitsio
 import numpy as N
 
@@ -121,3 +122,294 @@ def read_simspec_table(filename):
     #- return results
     return dict(flux=spectra.flux, wavelength=w, units=units, objtype=objtype)
     
+
+class SpectraWriter(object):
+    """
+    Write extracted spectra to a FITS file one bundle at a time.
+
+    The FLUX, IVAR, WAVELENGTH, and RESOLUTION HDUs are allocated up
+    front and rows are written as soon as each bundle is done, so the full
+    set of spectra never needs to be held in memory.  The FLUX header
+    keyword NSPECOUT counts the spectra written so far so that readers
+    can use a file which is still being written.
+    """
+    def __init__(self, filename, nspec, wavelengths, ndiag, header=None,
+                 resolution_dtype='f8'):
+        """
+        filename : output FITS filename, overwritten if it exists
+        nspec : total number of spectra
+        wavelengths : 1D array of output wavelengths
+        ndiag : number of off-diagonal resolution matrix elements, or
+            None to write no RESOLUTION HDU
+        header : optional header for the FLUX HDU
+        resolution_dtype : RESOLUTION HDU data type, e.g. 'f4' for half
+            the size
+        """
+        nwave = len(wavelengths)
+        self.filename = filename
+        self.nspecout = 0
+        self._rdtype = N.dtype(resolution_dtype)
+
+        fx = fitsio.FITS(filename, 'rw', clobber=True)
+        fx.create_image_hdu(dims=[nspec, nwave], dtype='f8', extname='FLUX')
+        if header is not None:
+            fx['FLUX'].write_keys(header)
+        fx['FLUX'].write_key('NSPECOUT', 0, comment='Number of spectra written')
+        fx.create_image_hdu(dims=[nspec, nwave], dtype='f8', extname='IVAR')
+        fx.write(N.asarray(wavelengths, dtype='f8'), extname='WAVELENGTH')
+        if ndiag is not None:
+            fx.create_image_hdu(dims=[nspec, 2*ndiag+1, nwave],
+                                dtype=resolution_dtype, extname='RESOLUTION')
+            fx['RESOLUTION'].write_key('NDIAG', ndiag,
+                                       comment='Number of off-diagonal elements')
+        fx.reopen()
+        self._fx = fx
+
+    def write(self, ispec, flux, ivar, Rd=None):
+        """
+        Write flux[n, nwave], ivar[n, nwave], and Rd[n, 2*ndiag+1, nwave]
+        into rows ispec:ispec+n of the output and flush them to disk;
+        Rd is not needed if the writer was created with ndiag=None
+        """
+        fx = self._fx
+        fx['FLUX'].write(flux, start=[ispec, 0])
+        fx['IVAR'].write(ivar, start=[ispec, 0])
+        if Rd is not None:
+            fx['RESOLUTION'].write(Rd.astype(self._rdtype, copy=False),
+                                   start=[ispec, 0, 0])
+        self.nspecout += flux.shape[0]
+        fx['FLUX'].write_key('NSPECOUT', self.nspecout, comment='Number of spectra written')
+        fx.reopen()
+
+    def close(self):
+        self._fx.close()
+
+#- numpy dtypes of FITS image BITPIX values
+_bitpix_dtype = {8:'u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+
+def memmap_image(filename, ext=0):
+    """
+    Return a read-only numpy memmap of FITS image HDU ext of filename, or
+    None if the HDU is compressed or scaled and can't be memory mapped
+    """
+    fx = fitsio.FITS(filename)
+    hdu = fx[ext]
+    hdr = hdu.read_header()
+    scaled = hdr.get('BSCALE', 1) != 1 or hdr.get('BZERO', 0) != 0
+    if hdu.is_compressed() or scaled:
+        fx.close()
+        return None
+    shape = tuple(hdu.get_dims())
+    offset = hdu.get_offsets()['data_start']
+    fx.close()
+    return N.memmap(filename, mode='r', offset=offset,
+                    dtype=_bitpix_dtype[hdr['BITPIX']], shape=shape)
+
+class ImageSections(object):
+    """
+    Full FITS image or .npy array that reads only the sections that are sliced
+
+    Uncompressed, unscaled FITS images and .npy files are memory mapped;
+    other FITS images use fitsio section reads.  Slicing returns a float64
+    numpy array of just that section, e.g. image[ymin:ymax, xmin:xmax].
+    Copies from memory mapped files release the GIL, so sections can be
+    read concurrently from several threads.
+    Objects are safe to use from forked worker processes, which reopen the
+    file as needed.
+    """
+    def __init__(self, filename, ext=0):
+        """
+        filename : FITS or .npy filename
+        ext : FITS HDU name or number; ignored for .npy files
+        """
+        self.filename = filename
+        self.ext = ext
+        self._pid = None
+        self._open()
+        self.ndim = len(self.shape)
+        self.dtype = N.dtype(N.float64)
+
+    def _open(self):
+        self._pid = os.getpid()
+        if self.filename.endswith('.npy'):
+            self._data = N.load(self.filename, mmap_mode='r')
+            self.shape = self._data.shape
+            return
+
+        self._data = memmap_image(self.filename, self.ext)
+        if self._data is None:
+            self._fx = fitsio.FITS(self.filename)
+            self._data = self._fx[self.ext]
+            self.shape = tuple(self._data.get_dims())
+        else:
+            self.shape = self._data.shape
+
+    def __getitem__(self, key):
+        if self._pid != os.getpid():
+            self._open()
+        if key is Ellipsis:
+            key = (slice(None),) * self.ndim
+        return N.array(self._data[key], dtype=N.float64)
+
+    def read(self):
+        """Return the full array as float64"""
+        return self[...]
+
+    def __getstate__(self):
+        return dict(filename=self.filename, ext=self.ext)
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], state['ext'])
+
+def _first_image(filename):
+    """
+    Return the first FITS HDU number with data, which is 1 for compressed
+    images, or 0 for .npy files
+    """
+    if filename.endswith('.npy'):
+        return 0
+    fx = fitsio.FITS(filename)
+    ext = 0 if fx[0].has_data() else 1
+    fx.close()
+    return ext
+
+class ImageReader(object):
+    """
+    Read subregions of a CCD image and its inverse variance
+
+    self.image and self.ivar are ImageSections objects that can be sliced
+    like full frame arrays while reading only the requested sections.
+    """
+    def __init__(self, filename, ivarfile=None):
+        """
+        filename : FITS file with the image in the first HDU with data and
+            its inverse variance in the next HDU, or a .npy image file
+        ivarfile : .npy or FITS inverse variance file; required for .npy
+            images, default the HDU after the image in filename otherwise
+        """
+        self.filename = filename
+        self._ext = _first_image(filename)
+        self.image = ImageSections(filename, self._ext)
+        if ivarfile is not None:
+            self.ivar = ImageSections(ivarfile, _first_image(ivarfile))
+        elif filename.endswith('.npy'):
+            raise ValueError, "ivarfile is required for .npy image {}".format(filename)
+        else:
+            self.ivar = ImageSections(filename, self._ext+1)
+        if self.image.shape != self.ivar.shape:
+            raise ValueError, "image shape {} != ivar shape {}".format(
+                self.image.shape, self.ivar.shape)
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def header(self):
+        """FITS header of the image, or an empty header for .npy files"""
+        if self.filename.endswith('.npy'):
+            return fitsio.FITSHDR()
+        return fitsio.read_header(self.filename, self._ext)
+
+    def read(self, xyrange=None):
+        """
+        Return (image, ivar) float64 arrays of xyrange (xmin, xmax, ymin, ymax),
+        or of the full image if xyrange is None
+        """
+        if xyrange is None:
+            return self.image.read(), self.ivar.read()
+        xmin, xmax, ymin, ymax = xyrange
+        return (self.image[ymin:ymax, xmin:xmax],
+                self.ivar[ymin:ymax, xmin:xmax])
+
+def _read_bundle(filename):
+    """
+    Return (flux, ivar, Rd) arrays of exspec output filename, with the
+    data types of the file
+    """
+    fx = fitsio.FITS(filename)
+    results = tuple([fx[ext].read() for ext in ('FLUX', 'IVAR', 'RESOLUTION')])
+    fx.close()
+    return results
+
+def merge_bundles(filenames, outfile, nspec=None):
+    """
+    Merge exspec output files of separate bundles of spectra into one file
+
+    Inputs:
+        filenames : list of exspec output filenames
+        outfile : output filename, overwritten if it exists
+
+    Optional Inputs:
+        nspec : expected total number of spectra; default is inferred from
+            the SPECMIN and SPECMAX header keywords of the inputs
+
+    Bundles are written into the preallocated output HDUs as they are
+    read, so only one bundle is held in memory at once.  The RESOLUTION
+    HDU keeps the data type of the inputs, e.g. float32.
+
+    Raises ValueError if the inputs have different wavelengths or number
+    of resolution diagonals, are incomplete, overlap, or leave gaps in the
+    range of spectra.  Returns the number of spectra written.
+    """
+    if len(filenames) == 0:
+        raise ValueError, "No input files to merge"
+
+    #- Gather and check the dimensions of every input
+    bundles = list()
+    for filename in filenames:
+        fx = fitsio.FITS(filename)
+        hdr = fx[0].read_header()
+        ww = fx['WAVELENGTH'].read()
+        rdims = fx['RESOLUTION'].get_dims()
+        rbitpix = fx['RESOLUTION'].read_header()['BITPIX']
+        fx.close()
+
+        specmin, specmax = hdr['SPECMIN'], hdr['SPECMAX']+1
+        if rdims[0] != specmax-specmin:
+            raise ValueError, "{} has {} spectra instead of SPECMIN-SPECMAX {}-{}".format(
+                filename, rdims[0], specmin, specmax-1)
+        if hdr.get('NSPECOUT', rdims[0]) < rdims[0]:
+            raise ValueError, "{} is incomplete with {} of {} spectra".format(
+                filename, hdr['NSPECOUT'], rdims[0])
+        if len(bundles) == 0:
+            header, wavelengths, ndiag2 = hdr, ww, rdims[1]
+            rdtype = N.dtype(_bitpix_dtype[rbitpix]).newbyteorder('=')
+        elif not N.array_equal(ww, wavelengths):
+            raise ValueError, "{} wavelengths differ from {}".format(
+                filename, filenames[0])
+        elif rdims[1] != ndiag2:
+            raise ValueError, "{} has {} resolution diagonals instead of {}".format(
+                filename, rdims[1], ndiag2)
+        bundles.append( (specmin, specmax, filename) )
+
+    #- Spectra must be covered exactly once
+    bundles.sort()
+    for (lo1, hi1, f1), (lo2, hi2, f2) in zip(bundles[:-1], bundles[1:]):
+        if lo2 < hi1:
+            raise ValueError, "{} and {} overlap".format(f1, f2)
+        elif lo2 > hi1:
+            raise ValueError, "Spectra {}-{} are missing".format(hi1, lo2-1)
+    specmin, specmax = bundles[0][0], bundles[-1][1]
+    if nspec is not None and nspec != specmax-specmin:
+        raise ValueError, "Input files have {} instead of {} spectra".format(
+            specmax-specmin, nspec)
+    nspec = specmax - specmin
+
+    header['SPECMIN'] = specmin
+    header['SPECMAX'] = specmax-1
+    header['NSPEC'] = nspec
+    for key in ('NSPECOUT', 'EXTNAME'):
+        if key in header:
+            header.delete(key)
+
+    #- Write each bundle into the output as it is read
+    writer = SpectraWriter(outfile, nspec, wavelengths, ndiag2//2,
+                           header=header, resolution_dtype=rdtype)
+    try:
+        for lo, hi, filename in bundles:
+            writer.write(lo-specmin, *_read_bundle(filename))
+    finally:
+        writer.close()
+
+    return nspec
@@ -5,6 +5,11 @@ from monospot import MonoSpotPSF
 from monospot import MonoSpotPSF
 from gausshermite import GaussHermitePSF
 from gausshermite2 import GaussHermite2PSF
+from parallel import project_parallel
+from trail import TrailKernels
+from lines import project_lines
+from projector import ProjectionOperator, projection_operator
+from workspace import SimWorkspace
 
 def load_psf(filename, psftype=None):
     """
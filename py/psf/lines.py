@@ -0,0 +1,125 @@
+"""
+Project sparse emission line lists onto the CCD
+
+Arc lamp spectra are a few hundred delta function lines.  PSF.project
+walks every wavelength sample of every spectrum and adds one spot at a
+time; project_lines instead selects the lines with photons on the CCD for
+each spectrum in one step, evaluates their spots together with
+PSF._xypix_many, and adds batches of spots to the image with a single
+bincount over the columns spanned by the batch.
+"""
+
+import numpy as N
+
+def _kept(psf, ispec, wavelength):
+    """
+    Return boolean array of which wavelength[] of spectrum ispec have
+    spots that PSF.project would add to the image
+    """
+    wmin, wmax = psf.wavelength(ispec, y=(0, psf.npix_y))
+    wmax = min(wmax, psf.wavelength(ispec, y=psf.npix_y-0.5))
+    return (wmin <= wavelength) & (wavelength <= wmax)
+
+def _spot_pixels(psf, ispec, wavelength, xyrange):
+    """
+    Return xpix, ypix, iwave, weight for the pixels within xyrange of the
+    spots of spectrum ispec at each of wavelength[], where iwave is the
+    index of the wavelength of each pixel
+    """
+    xmin, xmax, ymin, ymax = xyrange
+
+    #- Stack the spots of each shape and keep their pixels on xyrange
+    spots = dict()
+    for j, (xx, yy, pix) in enumerate(psf._xypix_many(ispec, wavelength)):
+        spots.setdefault(pix.shape, list()).append((j, xx.start, yy.start, pix))
+    xpix, ypix, iwave, weight = list(), list(), list(), list()
+    for (ny, nx), sp in spots.items():
+        j = N.array([s[0] for s in sp])[:, None, None]
+        x0 = N.array([s[1] for s in sp])[:, None, None]
+        y0 = N.array([s[2] for s in sp])[:, None, None]
+        ix = x0 + N.arange(nx)[None, None, :]
+        iy = y0 + N.arange(ny)[None, :, None]
+        ix, iy, j = N.broadcast_arrays(ix, iy, j)
+        ok = (xmin <= ix) & (ix < xmax) & (ymin <= iy) & (iy < ymax)
+        xpix.append(ix[ok])
+        ypix.append(iy[ok])
+        iwave.append(j[ok])
+        weight.append(N.array([s[3] for s in sp])[ok])
+
+    if len(xpix) == 0:
+        return [N.zeros(0, dtype=int)]*3 + [N.zeros(0)]
+    return [N.concatenate(x) for x in (xpix, ypix, iwave, weight)]
+
+def _add_pixels(img, xyrange, xpix, ypix, wpix):
+    """
+    Add weights wpix at CCD pixels (xpix, ypix) into img covering xyrange
+    """
+    xmin, xmax, ymin, ymax = xyrange
+    xpix = N.concatenate(xpix)
+    ypix = N.concatenate(ypix)
+    wpix = N.concatenate(wpix)
+    x0, x1 = xpix.min(), xpix.max()+1
+    nx = x1 - x0
+    flat = (ypix-ymin)*nx + (xpix-x0)
+    band = N.bincount(flat, weights=wpix, minlength=(ymax-ymin)*nx)
+    img[:, x0-xmin:x1-xmin] += band.reshape((ymax-ymin, nx))
+
+def project_lines(psf, wavelength, phot, specmin=0, xyrange=None, out=None,
+                  batchsize=1000000):
+    """
+    Returns 2D image of emission lines projected onto the CCD
+
+    Inputs:
+        psf : PSF object
+        wavelength[nline] or wavelength[nspec, nline] in Angstroms
+        phot[nline] or phot[nspec, nline] as photons on CCD per line
+
+    Optional Inputs:
+        specmin : starting spectrum number
+        xyrange : (xmin, xmax, ymin, ymax) range of CCD pixels
+        out : array[ymax-ymin, xmax-xmin] to add the lines to instead of
+            returning a new image
+        batchsize : number of pixels to collect before adding them to
+            the image
+
+    Lines are kept or dropped the same as with PSF.project, and the result
+    agrees with PSF.project up to floating point rounding.
+    """
+    if xyrange is None:
+        xyrange = (0, psf.npix_x, 0, psf.npix_y)
+    xmin, xmax, ymin, ymax = xyrange
+    if out is None:
+        out = N.zeros((ymax-ymin, xmax-xmin))
+    elif out.shape != (ymax-ymin, xmax-xmin):
+        raise ValueError, "out shape {} != xyrange shape {}".format(
+            out.shape, (ymax-ymin, xmax-xmin))
+
+    phot = N.atleast_2d(phot)
+    wavelength = N.asarray(wavelength)
+    xpix, ypix, wpix = list(), list(), list()
+    npix = 0
+    for i in range(phot.shape[0]):
+        ispec = specmin + i
+        wspec = wavelength[i] if wavelength.ndim == 2 else wavelength
+
+        #- Lines with photons whose spots are centered on the CCD
+        ii = (phot[i] > 0.0) & _kept(psf, ispec, wspec)
+        if not N.any(ii):
+            continue
+
+        x, y, j, w = _spot_pixels(psf, ispec, wspec[ii], xyrange)
+        if len(x) > 0:
+            xpix.append(x)
+            ypix.append(y)
+            wpix.append(w * phot[i, ii][j])
+            npix += len(x)
+
+        if npix >= batchsize:
+            _add_pixels(out, xyrange, xpix, ypix, wpix)
+            xpix, ypix, wpix = list(), list(), list()
+            npix = 0
+
+    if npix > 0:
+        _add_pixels(out, xyrange, xpix, ypix, wpix)
+
+    return out
@@ -0,0 +1,113 @@
+"""
+Project spectra onto a CCD image in parallel across bands of rows
+
+The image is a single array in shared memory.  Each worker process owns a
+band of rows and adds into it only the spots that can reach those rows,
+clipped to the band, so the workers never write the same pixels and the
+memory needed is about one image regardless of the number of processes.
+Every pixel receives the same contributions in the same order as
+PSF.project, so the result is identical to a serial projection.
+"""
+
+import multiprocessing as MP
+import numpy as N
+
+from specter.util.sharedmem import shared_array, limit_blas_threads
+
+#- Filled by _init_worker in each worker process
+_worker = dict()
+
+def _init_worker(psf, wavelength, phot, yspot, specmin, xyrange, pad, img):
+    """
+    Store shared inputs and the output image for use by _project_band
+    """
+    limit_blas_threads(1)
+    _worker.update(psf=psf, wavelength=wavelength, phot=phot, yspot=yspot,
+                   specmin=specmin, xyrange=xyrange, pad=pad, img=img)
+
+def _project_band(yrange):
+    """
+    Add the spots that reach rows yrange = (ylo, yhi) into those rows
+    """
+    w = _worker
+    ylo, yhi = yrange
+    xmin, xmax, ymin, ymax = w['xyrange']
+    band = w['img'][ylo-ymin:yhi-ymin]
+    for i in range(w['phot'].shape[0]):
+        ii = (w['yspot'][i] >= ylo - w['pad']) & (w['yspot'][i] < yhi + w['pad'])
+        if N.any(ii):
+            w['psf'].project(w['wavelength'][i, ii], w['phot'][i, ii],
+                specmin=w['specmin']+i, xyrange=(xmin, xmax, ylo, yhi),
+                out=band)
+    return yrange
+
+def _spot_height(psf, specrange, wavelength):
+    """
+    Return the height in rows of the tallest of a sample of spots
+    """
+    specmin, specmax = specrange
+    wmin = max(N.min(wavelength), psf.wmin)
+    wmax = min(N.max(wavelength), psf.wmax)
+    height = 1
+    for ispec in set([specmin, (specmin+specmax)//2, specmax-1]):
+        for w in N.linspace(wmin, wmax, 5):
+            yy = psf.xypix(ispec, w)[1]
+            height = max(height, yy.stop - yy.start)
+    return height
+
+def project_parallel(psf, wavelength, phot, specmin=0, xyrange=None,
+                     numcores=None, nband=None):
+    """
+    Returns 2D image of spectra projected onto the CCD, see PSF.project
+
+    Inputs:
+        psf : PSF object
+        wavelength[nwave] or wavelength[nspec, nwave] in Angstroms
+        phot[nwave] or phot[nspec, nwave] as photons on CCD per bin
+
+    Optional Inputs:
+        specmin : starting spectrum number
+        xyrange : (xmin, xmax, ymin, ymax) range of CCD pixels
+        numcores : number of processes, default all cores
+        nband : number of bands of rows, default 2*numcores so that the
+            bands even out between processes
+
+    The returned image is in shared memory.  Spots are assigned to bands
+    by their center; spots much taller than the sampled spot heights
+    could be truncated at the band edges.
+    """
+    if numcores is None:
+        numcores = MP.cpu_count()
+    if nband is None:
+        nband = 2*numcores
+
+    if xyrange is None:
+        xyrange = (0, psf.npix_x, 0, psf.npix_y)
+    xmin, xmax, ymin, ymax = xyrange
+
+    phot = N.atleast_2d(phot)
+    nspec, nwave = phot.shape
+    wavelength = N.asarray(wavelength)
+    if wavelength.ndim == 1:
+        wavelength = N.tile(wavelength, (nspec, 1))
+
+    #- Spot centers and a margin for spots centered outside of a band
+    yspot = N.zeros(phot.shape)
+    for i in range(nspec):
+        yspot[i] = psf.y(specmin+i, wavelength[i])
+    pad = _spot_height(psf, (specmin, specmin+nspec), wavelength)
+
+    img = shared_array((ymax-ymin, xmax-xmin))
+    edges = N.linspace(ymin, ymax, min(nband, ymax-ymin)+1).astype(int)
+    bands = zip(edges[:-1], edges[1:])
+
+    initargs = (psf, wavelength, phot, yspot, specmin, xyrange, pad, img)
+    pool = MP.Pool(numcores, initializer=_init_worker, initargs=initargs)
+    try:
+        for yrange in pool.imap_unordered(_project_band, bands):
+            pass
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return img
@@ -0,0 +1,179 @@
+"""
+Sparse projection operator for simulating many exposures
+
+Simulating many exposures of the same spectra with the same PSF and
+wavelength grid (time series, dithers, noise studies) evaluates the same
+spots every time with PSF.project.  A ProjectionOperator is the sparse
+matrix A[npix, nspec*nwave] of those spots, built once, so that each
+exposure is a sparse matrix-vector product and a stack of exposures is a
+single sparse matrix-matrix product.  It can be written to a FITS file and
+read back for later runs.  The number of non-zero elements is about
+nspec * nwave * pixels per spot.
+"""
+
+import numpy as N
+import scipy.sparse
+import fitsio
+
+from specter.psf.lines import _kept, _spot_pixels
+
+class ProjectionOperator(object):
+    """
+    Sparse matrix projecting photons[nspec, nwave] onto CCD pixels
+    """
+    def __init__(self, A, wavelength, specmin, xyrange, salt=''):
+        """
+        A : sparse matrix[npix, nspec*nwave]
+        wavelength[nwave] or wavelength[nspec, nwave] in Angstroms
+        specmin : first spectrum
+        xyrange : (xmin, xmax, ymin, ymax) range of CCD pixels
+        salt : hash of the PSF that the operator can't hash itself,
+            e.g. input_hash('file:'+psffile)
+
+        Use projection_operator() to create one from a PSF or
+        ProjectionOperator.read() to read one from a file.
+        """
+        xmin, xmax, ymin, ymax = xyrange
+        wavelength = N.asarray(wavelength)
+        nwave = wavelength.shape[-1]
+        if A.shape[0] != (ymax-ymin)*(xmax-xmin) or A.shape[1] % nwave != 0:
+            raise ValueError, "A shape {} inconsistent with xyrange {} and nwave {}".format(
+                A.shape, xyrange, nwave)
+        self.A = A.tocsr()
+        self.wavelength = wavelength
+        self.specmin = specmin
+        self.xyrange = tuple(xyrange)
+        self.salt = salt
+
+    @property
+    def nspec(self):
+        return self.A.shape[1] // self.wavelength.shape[-1]
+
+    @property
+    def nwave(self):
+        return self.wavelength.shape[-1]
+
+    @property
+    def shape(self):
+        """Shape of the projected image"""
+        xmin, xmax, ymin, ymax = self.xyrange
+        return (ymax-ymin, xmax-xmin)
+
+    def matches(self, wavelength, specrange, xyrange, salt=''):
+        """
+        Return True if this operator is for these wavelength[], specrange
+        (specmin, specmax), xyrange, and PSF salt
+        """
+        wavelength = N.asarray(wavelength)
+        return (salt == self.salt) and \
+               (tuple(specrange) == (self.specmin, self.specmin+self.nspec)) and \
+               (tuple(xyrange) == self.xyrange) and \
+               (wavelength.shape == self.wavelength.shape) and \
+               N.allclose(wavelength, self.wavelength, rtol=0, atol=1e-8)
+
+    def project(self, phot, out=None):
+        """
+        Returns 2D image of phot projected onto the CCD, like PSF.project
+
+        phot[nspec, nwave] as photons on CCD per bin, or
+        phot[nexp, nspec, nwave] to return images[nexp, ny, nx] for many
+        exposures at once.  Like PSF.project, photons <= 0 are ignored.
+
+        out : array[ny, nx] (or [nexp, ny, nx]) to add the images to
+        """
+        phot = N.asarray(phot)
+        if phot.shape[-2:] != (self.nspec, self.nwave) or phot.ndim > 3:
+            raise ValueError, "phot shape {} != (nspec, nwave) {}".format(
+                phot.shape, (self.nspec, self.nwave))
+
+        x = N.maximum(phot, 0.0).reshape((-1, self.nspec*self.nwave))
+        img = self.A.dot(x.T).T.reshape(phot.shape[:-2] + self.shape)
+        if out is not None:
+            out += img
+            return out
+        else:
+            return img
+
+    def write(self, filename):
+        """
+        Write to FITS filename with DATA, INDICES, INDPTR, and WAVELENGTH
+        HDUs for the compressed sparse rows of A; the salt is recorded in
+        the DATA header
+        """
+        xmin, xmax, ymin, ymax = self.xyrange
+        hdr = fitsio.FITSHDR()
+        hdr.add_record(dict(name='SPECMIN', value=self.specmin, comment='First spectrum'))
+        hdr.add_record(dict(name='NSPEC', value=self.nspec, comment='Number of spectra'))
+        hdr.add_record(dict(name='XMIN', value=xmin, comment='First CCD column'))
+        hdr.add_record(dict(name='XMAX', value=xmax, comment='Last CCD column + 1'))
+        hdr.add_record(dict(name='YMIN', value=ymin, comment='First CCD row'))
+        hdr.add_record(dict(name='YMAX', value=ymax, comment='Last CCD row + 1'))
+        hdr.add_record(dict(name='SALT', value=self.salt, comment='PSF hash'))
+        fx = fitsio.FITS(filename, 'rw', clobber=True)
+        fx.write(self.A.data, extname='DATA', header=hdr)
+        fx.write(self.A.indices.astype(N.int64), extname='INDICES')
+        fx.write(self.A.indptr.astype(N.int64), extname='INDPTR')
+        fx.write(N.asarray(self.wavelength, dtype='f8'), extname='WAVELENGTH')
+        fx.close()
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Read a ProjectionOperator written by write()
+        """
+        fx = fitsio.FITS(filename)
+        hdr = fx['DATA'].read_header()
+        data = fx['DATA'].read()
+        indices = fx['INDICES'].read()
+        indptr = fx['INDPTR'].read()
+        wavelength = fx['WAVELENGTH'].read()
+        fx.close()
+        xyrange = (hdr['XMIN'], hdr['XMAX'], hdr['YMIN'], hdr['YMAX'])
+        npix = (xyrange[3]-xyrange[2]) * (xyrange[1]-xyrange[0])
+        A = scipy.sparse.csr_matrix((data, indices, indptr),
+                                    shape=(npix, hdr['NSPEC']*wavelength.shape[-1]))
+        salt = str(hdr['SALT']).strip() if 'SALT' in hdr else ''
+        return cls(A, wavelength, hdr['SPECMIN'], xyrange, salt=salt)
+
+def projection_operator(psf, wavelength, specrange=None, xyrange=None, salt=''):
+    """
+    Build the ProjectionOperator for a PSF and wavelength grid
+
+    Inputs:
+        psf : PSF object
+        wavelength[nwave] or wavelength[nspec, nwave] in Angstroms
+
+    Optional Inputs:
+        specrange : (specmin, specmax) python style range of spectra,
+            default all
+        xyrange : (xmin, xmax, ymin, ymax) range of CCD pixels, default
+            the full CCD
+        salt : hash of the PSF to check with matches() before reusing a
+            saved operator, e.g. input_hash('file:'+psffile)
+
+    Spots are included or dropped the same as with PSF.project.
+    """
+    specmin, specmax = specrange if (specrange is not None) else (0, psf.nspec)
+    if xyrange is None:
+        xyrange = (0, psf.npix_x, 0, psf.npix_y)
+    xmin, xmax, ymin, ymax = xyrange
+    nx = xmax - xmin
+    wavelength = N.asarray(wavelength)
+    nwave = wavelength.shape[-1]
+
+    rows, cols, data = list(), list(), list()
+    for i in range(specmax - specmin):
+        ispec = specmin + i
+        wspec = wavelength[i] if wavelength.ndim == 2 else wavelength
+        iw = N.where(_kept(psf, ispec, wspec))[0]
+        x, y, j, w = _spot_pixels(psf, ispec, wspec[iw], xyrange)
+        rows.append((y-ymin)*nx + (x-xmin))
+        cols.append(i*nwave + iw[j])
+        data.append(w)
+
+    npix = (ymax-ymin) * nx
+    A = scipy.sparse.csr_matrix(
+        (N.concatenate(data), (N.concatenate(rows), N.concatenate(cols))),
+        shape=(npix, (specmax-specmin)*nwave))
+
+    return ProjectionOperator(A, wavelength, specmin, xyrange, salt=salt)
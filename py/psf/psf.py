@@ -203,6 +203,14 @@ class PSF(object):
         will take care of that.
         """
         raise NotImplementedError
+
+    def _xypix_many(self, ispec, wavelengths):
+        """
+        Return a list of xslice, yslice, pixels[iy,ix] from _xypix for
+        spectrum ispec at each of wavelengths[].  Subclasses may override
+        this with a vectorized version for projecting many spots at once.
+        """
+        return [self._xypix(ispec, w) for w in wavelengths]
         
     def xypix(self, ispec, wavelength, xmin=0, xmax=None, ymin=0, ymax=None):
         """
@@ -228,12 +236,15 @@ class PSF(object):
         key = (ispec, wavelength)
         try:
             if key in self._cache:
+                self._cache.nhit += 1
                 xx, yy, ccdpix = self._cache[key]
             else:
+                self._cache.nmiss += 1
                 xx, yy, ccdpix = self._xypix(ispec, wavelength)
                 self._cache[key] = (xx, yy, ccdpix)
         except AttributeError:
             self._cache = CacheDict(2500)
+            self._cache.nmiss += 1
             xx, yy, ccdpix = self._xypix(ispec, wavelength)
             
         xlo, xhi = xx.start, xx.stop
@@ -273,6 +284,15 @@ class PSF(object):
                              
         return xx, yy, ccdpix
 
+    def cache_stats(self):
+        """
+        Return (nhit, nmiss) counts for the cache of xypix spots
+        """
+        try:
+            return self._cache.nhit, self._cache.nmiss
+        except AttributeError:
+            return 0, 0
+
     def xyrange(self, spec_range, wavelengths):
         """
         Return recommended range of pixels which cover these spectra/fluxes:
@@ -498,7 +518,8 @@ class PSF(object):
     #         
     #     return image, xyrange
 
-    def project(self, wavelength, phot, specmin=0, xyrange=None, verbose=False):
+    def project(self, wavelength, phot, specmin=0, xyrange=None, verbose=False,
+                out=None):
         """
         Returns 2D image of spectra projected onto the CCD
 
@@ -511,6 +532,8 @@ class PSF(object):
         Optional inputs:
             specmin : starting spectrum number
             xyrange : (xmin, xmax, ymin, ymax) range of CCD pixels
+            out : array[ymax-ymin, xmax-xmin] to add the projected spectra
+                to instead of returning a new image
         """
         #- x,y ranges and number of pixels
         if xyrange is None:
@@ -528,7 +551,13 @@ class PSF(object):
         nspec, nw = phot.shape
 
         #- Create image to fill
-        img = N.zeros( (ny, nx) )
+        if out is None:
+            img = N.zeros( (ny, nx) )
+        elif out.shape != (ny, nx):
+            raise ValueError, "out shape {} != xyrange shape {}".format(
+                out.shape, (ny, nx))
+        else:
+            img = out
 
         #- Loop over spectra and wavelengths
         for i, ispec in enumerate(range(specmin, specmin+nspec)):
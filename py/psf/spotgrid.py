@@ -11,7 +11,7 @@ import os
 import numpy as N
 import fitsio
 from specter.psf import PSF
-from specter.util import LinearInterp2D, rebin_image, sincshift
+from specter.util import LinearInterp2D, rebin_image, sincshift, sincshift_many
 
 class SpotGridPSF(PSF):
     """
@@ -96,4 +96,47 @@ class SpotGridPSF(PSF):
 
         
         
-        
\ No newline at end of file
+        
+
+    def _xypix_many(self, ispec, wavelengths):
+        """
+        Return list of xslice, yslice, pix for spectrum ispec at each of
+        wavelengths[], same as _xypix but vectorized across wavelengths
+        """
+        wavelengths = N.asarray(wavelengths, dtype=float)
+        if len(wavelengths) == 0:
+            return list()
+
+        p = self._fiberpos[ispec]
+        xc, yc = self.xy(ispec, wavelengths)
+        rpix = int(round(self.CcdPixelSize / self.SpotPixelSize))
+        xoffset = (xc * rpix).astype(int) % rpix
+        yoffset = (yc * rpix).astype(int) % rpix
+
+        #- Place high res spots into grids aligned with CCD pixels and rebin
+        pix = self._fspot(p, wavelengths)
+        n, ny, nx = pix.shape
+        A = N.zeros(shape=(n, ny+rpix, nx+rpix))
+        for i in range(n):
+            A[i, yoffset[i]:yoffset[i]+ny, xoffset[i]:xoffset[i]+nx] = pix[i]
+        s = n, (ny+rpix)//rpix, rpix, (nx+rpix)//rpix, rpix
+        ccdpix = A.reshape(s).sum(-1).sum(2)
+
+        #- Fractional high-res pixel offsets
+        dxx = ((xc * rpix) % rpix - xoffset) / rpix
+        dyy = ((yc * rpix) % rpix - yoffset) / rpix
+        ccdpix = sincshift_many(ccdpix, dxx, dyy)
+        ccdpix = ccdpix.clip(0)
+        ccdpix /= N.sum(ccdpix, axis=(1,2))[:, None, None]
+
+        #- Where the [0,0] pixel of each spot goes on the CCD
+        xccd = N.floor(xc - ccdpix.shape[2]/2 + 1).astype(int)
+        yccd = N.floor(yc - ccdpix.shape[1]/2 + 1).astype(int)
+
+        spots = list()
+        for i in range(n):
+            xx = slice(xccd[i], xccd[i]+ccdpix.shape[2])
+            yy = slice(yccd[i], yccd[i]+ccdpix.shape[1])
+            spots.append( (xx, yy, ccdpix[i]) )
+
+        return spots
@@ -0,0 +1,182 @@
+"""
+Project smooth spectra onto the CCD with wavelength-integrated trail kernels
+
+For a continuum spectrum, the spots of neighboring wavelengths blend into
+a continuous trail, and the light that lands on the CCD from the
+wavelengths of one row only depends upon the spots within that row.
+TrailKernels averages the spots across the wavelength interval of a row,
+once every nstep rows of each spectrum.  An image is then the sum over
+rows of the photons of that row times a blend of the kernels of the
+anchor rows on either side, shifted by a whole number of rows.  Blending
+rather than shifting the kernels in x follows the slow tilt of the trace
+without resampling the spots.  That needs nsub spot evaluations per nstep
+rows instead of one per input wavelength bin.
+
+Since all photons of a row share one kernel, emission lines narrower than
+a row are smeared over the row; use PSF.project for those.
+
+The anchors stop a spot height short of the CCD ends so that their
+kernels are not truncated.  A clipped end kernel would be off by several
+percent of the peak for the rows beyond them, so the bins of those rows
+are projected with PSF.project instead.
+"""
+
+import numpy as N
+
+class TrailKernels(object):
+    """
+    Wavelength-integrated spot kernels of a range of spectra
+    """
+    def __init__(self, psf, specrange=None, nstep=50, nsub=4):
+        """
+        psf : PSF object
+        specrange : (specmin, specmax) python style range of spectra,
+            default all
+        nstep : number of rows between kernel anchors
+        nsub : number of spots averaged across the wavelengths of a row
+        """
+        specmin, specmax = specrange if (specrange is not None) else (0, psf.nspec)
+        self.psf = psf
+        self.specmin, self.specmax = specmin, specmax
+        self.nstep = nstep
+        nspec = specmax - specmin
+        ny = psf.npix_y
+
+        #- Anchor rows every nstep rows, far enough from the CCD edges
+        #- that their kernels are not truncated
+        yy = psf.xypix(specmin, psf.wavelength(specmin, y=ny//2))[1]
+        edge = min(yy.stop - yy.start, (ny-1)//2)
+        self.anchors = N.append(N.arange(edge, ny-1-edge, nstep), ny-1-edge)
+
+        #- Kernels[ispec][ianchor] = (xlo, dylo, K[y, x]) with K's lower
+        #- left pixel at column xlo, row anchor+dylo
+        self.kernels = list()
+        for i in range(nspec):
+            ispec = specmin + i
+            kk = list()
+            for r0 in self.anchors:
+                w0, w1 = psf.wavelength(ispec, y=N.array([r0-0.5, r0+0.5]))
+                ww = w0 + (N.arange(nsub)+0.5)/nsub * (w1-w0)
+                spots = [psf.xypix(ispec, w) for w in ww]
+                spots = [s for s in spots if s[2].size > 0]
+                if len(spots) == 0:
+                    kk.append( (0, 0, N.zeros((0, 0))) )
+                    continue
+                xlo = min([s[0].start for s in spots])
+                xhi = max([s[0].stop for s in spots])
+                ylo = min([s[1].start for s in spots])
+                yhi = max([s[1].stop for s in spots])
+                K = N.zeros((yhi-ylo, xhi-xlo))
+                for xx, yy, pix in spots:
+                    K[yy.start-ylo:yy.stop-ylo, xx.start-xlo:xx.stop-xlo] += pix
+                K /= nsub
+                kk.append( (xlo, ylo-r0, K) )
+            self.kernels.append(kk)
+
+    def project(self, wavelength, phot, specmin=None, xyrange=None, out=None):
+        """
+        Returns 2D image of spectra projected onto the CCD, see PSF.project
+
+        Inputs:
+            wavelength[nwave] or wavelength[nspec, nwave] in Angstroms
+            phot[nwave] or phot[nspec, nwave] as photons on CCD per bin
+
+        Optional Inputs:
+            specmin : first spectrum of phot, default the first in the table
+            xyrange : (xmin, xmax, ymin, ymax) range of CCD pixels
+            out : array[ymax-ymin, xmax-xmin] to add into
+        """
+        psf = self.psf
+        if specmin is None:
+            specmin = self.specmin
+        if xyrange is None:
+            xyrange = (0, psf.npix_x, 0, psf.npix_y)
+        xmin, xmax, ymin, ymax = xyrange
+        if out is None:
+            out = N.zeros((ymax-ymin, xmax-xmin))
+
+        phot = N.atleast_2d(phot)
+        nspec = phot.shape[0]
+        if specmin < self.specmin or specmin+nspec > self.specmax:
+            raise ValueError, "spectra %d:%d not in table for spectra %d:%d" % \
+                (specmin, specmin+nspec, self.specmin, self.specmax)
+        wavelength = N.asarray(wavelength)
+
+        for i in range(nspec):
+            wspec = wavelength[i] if wavelength.ndim == 2 else wavelength
+            self._project_one(specmin+i, wspec, phot[i], xyrange, out)
+
+        return out
+
+    def _project_one(self, ispec, wavelength, phot, xyrange, out):
+        """
+        Add spectrum ispec into out[ymax-ymin, xmax-xmin]
+        """
+        xmin, xmax, ymin, ymax = xyrange
+        ny = self.psf.npix_y
+        i = ispec - self.specmin
+
+        #- Photons per CCD row, treating each input bin as covering the y
+        #- range halfway to its neighbors.  Like PSF.project, only photons
+        #- with 0 <= y <= npix_y are kept; rows -1 and npix_y hold those
+        #- whose spots are centered just off the CCD.
+        y = self.psf.y(ispec, wavelength)
+        if len(y) < 2 or not N.any(phot > 0):
+            return
+
+        #- Bins beyond the first and last anchor rows go through the spots
+        outside = (y < self.anchors[0]-0.5) | (y > self.anchors[-1]+0.5)
+        if N.any(outside & (phot > 0)):
+            self.psf.project(wavelength[outside], phot[outside],
+                specmin=ispec, xyrange=xyrange, out=out)
+            phot = N.where(outside, 0.0, phot)
+            if not N.any(phot > 0):
+                return
+
+        yedges = N.concatenate([[1.5*y[0]-0.5*y[1]], 0.5*(y[1:]+y[:-1]),
+                                [1.5*y[-1]-0.5*y[-2]]])
+        cumphot = N.concatenate([[0.0], N.cumsum(N.maximum(phot, 0.0))])
+        rowedges = N.clip(N.arange(-1, ny+2) - 0.5, 0, ny)
+        rowphot = N.diff(N.interp(rowedges, yedges, cumphot))
+        rr = N.nonzero(rowphot)[0]
+        rowphot = rowphot[rr]
+        rr -= 1
+
+        #- Each row's kernel is a blend of the kernels of the anchors on
+        #- either side, each shifted by a whole number of rows.  The blend
+        #- follows the trace in x without resampling the kernels.
+        a0 = N.searchsorted(self.anchors, rr, side='right') - 1
+        a0 = N.clip(a0, 0, len(self.anchors)-2)
+        t = (rr - self.anchors[a0]) / N.diff(self.anchors).astype(float)[a0]
+        t = N.clip(t, 0.0, 1.0)
+        a = N.concatenate([a0, a0+1])
+        r = N.concatenate([rr, rr])
+        rp = N.concatenate([rowphot*(1-t), rowphot*t])
+
+        xpix, ypix, wpix = list(), list(), list()
+        for ia in N.unique(a):
+            xlo, dylo, K = self.kernels[i][ia]
+            ii = (a == ia) & (rp > 0)
+            if K.size == 0 or not N.any(ii):
+                continue
+            iy, ix = N.indices(K.shape)
+            weight = rp[ii][:, None, None] * K
+            yy = (r[ii] + dylo)[:, None, None] + iy
+            xpix.append(N.broadcast_to(xlo + ix, weight.shape).ravel())
+            ypix.append(N.broadcast_to(yy, weight.shape).ravel())
+            wpix.append(weight.ravel())
+        if len(wpix) == 0:
+            return
+        xpix = N.concatenate(xpix)
+        ypix = N.concatenate(ypix)
+        wpix = N.concatenate(wpix)
+
+        #- Sum into the columns spanned by this spectrum
+        ok = (xpix >= xmin) & (xpix < xmax) & (ypix >= ymin) & (ypix < ymax)
+        if not N.any(ok):
+            return
+        x0, x1 = xpix[ok].min(), xpix[ok].max()+1
+        nx = x1 - x0
+        flat = (ypix[ok]-ymin)*nx + (xpix[ok]-x0)
+        band = N.bincount(flat, weights=wpix[ok], minlength=(ymax-ymin)*nx)
+        out[:, x0-xmin:x1-xmin] += band.reshape((ymax-ymin, nx))
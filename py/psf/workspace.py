@@ -0,0 +1,176 @@
+"""
+Simulation workspace for incremental re-simulation
+
+A SimWorkspace holds a CCD image together with the contribution of each
+spectrum to it, cropped to the pixels that spectrum reaches and keyed by a
+hash of its wavelengths and photons.  Updating the workspace with new
+inputs re-projects only the spectra whose hash changed, subtracting their
+old contributions from the image and adding the new ones, so that changing
+a few spectra costs time proportional to those spectra.  The workspace can
+be saved to a file and reloaded by later runs.
+"""
+
+import os
+import tempfile
+import numpy as N
+
+from specter.util import input_hash
+from specter.psf.lines import _kept, _spot_pixels
+
+class SimWorkspace(object):
+    """
+    CCD image of projected spectra with per-spectrum contributions
+    """
+    def __init__(self, psf, xyrange=None, salt='', filename=None):
+        """
+        psf : PSF object
+        xyrange : (xmin, xmax, ymin, ymax) range of CCD pixels, default
+            the full CCD
+        salt : hash of inputs common to every spectrum that the workspace
+            can't hash itself, e.g. input_hash('file:'+psffile)
+        filename : if given, load the workspace saved there by save() if it
+            exists and has the same salt and xyrange; save() writes here
+
+        self.image[ny, nx] is the sum of the contributions of all spectra
+        projected so far.
+        """
+        if xyrange is None:
+            xyrange = (0, psf.npix_x, 0, psf.npix_y)
+        xmin, xmax, ymin, ymax = xyrange
+        self.psf = psf
+        self.xyrange = tuple(xyrange)
+        self.salt = salt
+        self.filename = filename
+        self.image = N.zeros((ymax-ymin, xmax-xmin))
+
+        #- contrib[ispec] = (key, (x0, x1, y0, y1), subimage[y1-y0, x1-x0])
+        self.contrib = dict()
+        self.nproject = 0
+        self.nreuse = 0
+
+        if filename is not None and os.path.exists(filename):
+            self._load(filename)
+
+    def key(self, ispec, wavelength, phot):
+        """
+        Return the hash key of spectrum ispec with wavelength[] and phot[]
+        """
+        return input_hash(self.salt, ispec, N.asarray(wavelength, dtype=float),
+                          N.asarray(phot, dtype=float))
+
+    def _project(self, ispec, wavelength, phot):
+        """
+        Return ((x0, x1, y0, y1), subimage) of spectrum ispec, cropped to
+        the pixels it reaches, or None if it reaches none
+        """
+        ii = (phot > 0.0) & _kept(self.psf, ispec, wavelength)
+        x, y, j, w = _spot_pixels(self.psf, ispec, wavelength[ii], self.xyrange)
+        if len(x) == 0:
+            return None
+        x0, x1 = x.min(), x.max()+1
+        y0, y1 = y.min(), y.max()+1
+        flat = (y-y0)*(x1-x0) + (x-x0)
+        sub = N.bincount(flat, weights=w*phot[ii][j], minlength=(y1-y0)*(x1-x0))
+        return (x0, x1, y0, y1), sub.reshape((y1-y0, x1-x0))
+
+    def _add(self, box, sub, sign):
+        xmin, xmax, ymin, ymax = self.xyrange
+        x0, x1, y0, y1 = box
+        self.image[y0-ymin:y1-ymin, x0-xmin:x1-xmin] += sign*sub
+
+    def update(self, wavelength, phot, specmin=0):
+        """
+        Update the image for spectra specmin, specmin+1, ... with new
+        inputs, re-projecting only those that changed
+
+        Inputs:
+            wavelength[nwave] or wavelength[nspec, nwave] in Angstroms
+            phot[nwave] or phot[nspec, nwave] as photons on CCD per bin
+
+        Returns list of the spectra that were re-projected.  Spectra not
+        in phot are left as they are.
+        """
+        phot = N.atleast_2d(phot)
+        wavelength = N.asarray(wavelength)
+        changed = list()
+        for i in range(phot.shape[0]):
+            ispec = specmin + i
+            wspec = wavelength[i] if wavelength.ndim == 2 else wavelength
+            key = self.key(ispec, wspec, phot[i])
+            if ispec in self.contrib and self.contrib[ispec][0] == key:
+                self.nreuse += 1
+                continue
+
+            #- Swap the old contribution for the new one
+            if ispec in self.contrib:
+                old = self.contrib.pop(ispec)
+                if old[1] is not None:
+                    self._add(old[1], old[2], -1)
+            result = self._project(ispec, wspec, phot[i])
+            if result is None:
+                self.contrib[ispec] = (key, None, None)
+            else:
+                box, sub = result
+                self._add(box, sub, +1)
+                self.contrib[ispec] = (key, box, sub)
+            self.nproject += 1
+            changed.append(ispec)
+
+        return changed
+
+    def remove(self, ispecs):
+        """
+        Remove the contributions of spectra ispecs[] from the image
+        """
+        for ispec in ispecs:
+            key, box, sub = self.contrib.pop(ispec)
+            if box is not None:
+                self._add(box, sub, -1)
+
+    def save(self, filename=None):
+        """
+        Save the workspace to filename, default self.filename
+        """
+        if filename is None:
+            filename = self.filename
+        ispec = sorted(self.contrib.keys())
+        keys = [self.contrib[i][0] for i in ispec]
+        boxes = N.zeros((len(ispec), 4), dtype=int)
+        subs = list()
+        for n, i in enumerate(ispec):
+            if self.contrib[i][1] is not None:
+                boxes[n] = self.contrib[i][1]
+                subs.append(self.contrib[i][2].ravel())
+        data = N.concatenate(subs) if len(subs) > 0 else N.zeros(0)
+
+        #- Write to a temporary file and rename so that readers never see
+        #- a partial file
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, tmpfile = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        with os.fdopen(fd, 'wb') as fx:
+            N.savez(fx, salt=self.salt, xyrange=self.xyrange, image=self.image,
+                    ispec=ispec, keys=keys, boxes=boxes, data=data)
+        os.rename(tmpfile, filename)
+
+    def _load(self, filename):
+        """
+        Load a workspace saved by save() if it is for the same salt and
+        xyrange
+        """
+        with N.load(filename) as fx:
+            if str(fx['salt']) != self.salt or \
+               tuple(fx['xyrange']) != self.xyrange:
+                return
+            self.image = fx['image']
+            data = fx['data']
+            n = 0
+            for ispec, key, box in zip(fx['ispec'], fx['keys'], fx['boxes']):
+                ispec = int(ispec)
+                x0, x1, y0, y1 = box
+                if x1 == x0:
+                    self.contrib[ispec] = (str(key), None, None)
+                    continue
+                size = (y1-y0)*(x1-x0)
+                sub = data[n:n+size].reshape((y1-y0, x1-x0))
+                self.contrib[ispec] = (str(key), tuple(box), sub)
+                n += size
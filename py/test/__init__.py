@@ -18,6 +18,7 @@ from specter.test.test_throughput import TestThroughput
 from specter.test.test_util import TestUtil
 from specter.test.test_extract import TestExtract
 from specter.test.test_pixspline import TestPixSpline
+from specter.test.test_resolution import TestResolution
 
 def test():
     """
@@ -34,6 +35,7 @@ def test():
     tests.append(load(TestUtil))
     tests.append(load(TestExtract))
     tests.append(load(TestPixSpline))
+    tests.append(load(TestResolution))
 
     suite = unittest.TestSuite(tests)
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -6,11 +6,26 @@ Unit tests for PSF classes.
 
 import sys
 import os
+import tempfile
+import signal
+import subprocess
+import shutil
 import numpy as N
 import unittest
 from specter.test import test_data_dir
 from specter.psf import load_psf
 from specter.extract.ex2d import ex2d
+from specter.extract import plan_patches, extract_patches
+from specter.extract import Checkpoint, tune_patches
+from specter.util import input_hash
+from specter.extract.checkpoint import read_params
+from specter.extract import estimate_patch_memory, split_patch
+from specter.extract.tune import fit_memory
+from specter.extract import ModelImage, PatchCache, ProfileTable
+from specter.extract import RectifiedImage, rectify
+from specter.extract.patch import patch_projection, extract_patch
+from specter.extract.ex1d import ex1d, resample_rows, Ex1dPool
+from specter.util.sharedmem import shared_array
 
 
 class TestExtract(unittest.TestCase):
@@ -150,7 +165,694 @@ class TestExtract(unittest.TestCase):
         flux, fluxivar, R = ex2d(img, ivar, self.psf, specrange, ww, xyrange=xyrange)
         
         self.assertTrue( N.all(flux == flux) )
-        
-        
+
+    def test_reject_outliers(self):
+        specrange = (0, self.nspec)
+        waverange = (self.ww[0], self.ww[-1])
+        xmin, xmax, ymin, ymax = self.psf.xyrange(specrange, waverange)
+        image = self.image.copy()
+        image[ymin+20, xmin+12] += 5000
+        image[ymin+30, xmin+40] += 2000
+        d = ex2d(image, self.ivar, self.psf, specrange, self.ww,
+                 full_output=True, reject_nsigma=5)
+
+        mask = d['mask']
+        self.assertEqual(mask.shape, (ymax-ymin, xmax-xmin))
+        self.assertTrue(mask[20, 12])
+        self.assertTrue(mask[30, 40])
+
+        #- Low-rank update should match extracting with those pixels masked
+        ivar = self.ivar.copy()
+        ivar[ymin:ymax, xmin:xmax][mask] = 0.0
+        d2 = ex2d(image, ivar, self.psf, specrange, self.ww, full_output=True)
+        self.assertTrue( N.allclose(d['flux'], d2['flux'], rtol=1e-8, atol=1e-6) )
+        self.assertTrue( N.allclose(d['ivar'], d2['ivar'], rtol=1e-8) )
+        self.assertTrue( N.allclose(d['R'], d2['R'], atol=1e-10) )
+
+    def test_profile(self):
+        specrange = (0, self.nspec)
+        d = ex2d(self.image, self.ivar, self.psf, specrange, self.ww,
+                 full_output=True, profile=True)
+        prof = d['profile']
+        for key in ('time_projection', 'time_icov', 'time_solve',
+                    'time_resolution'):
+            self.assertGreaterEqual(prof[key], 0.0)
+        self.assertEqual(prof['nflux'], self.nspec*len(self.ww))
+        self.assertEqual(prof['nnz_A'], d['A'].nnz)
+        self.assertEqual(prof['npix'], d['A'].shape[0])
+        self.assertGreaterEqual(prof['cond'], 1.0)
+
+        #- Projecting the same spots again should hit the cache
+        d = ex2d(self.image, self.ivar, self.psf, specrange, self.ww,
+                 full_output=True, profile=True)
+        self.assertEqual(d['profile']['cache_misses'], 0)
+        self.assertGreater(d['profile']['cache_hits'], 0)
+
+    def test_mixed_precision(self):
+        #- Bins wider than the PSF give a well conditioned iCov, whose
+        #- float32 R and ivar pass the accuracy check
+        specrange = (0, 5)
+        ww = N.arange(self.ww[0], self.ww[-1], 3.0)
+        phot = N.random.uniform(1, 1000, size=(5, len(ww)))
+        image = self.psf.project(ww, phot, verbose=False)
+        var = 1.0 + image
+        image += N.random.normal(scale=N.sqrt(var))
+        d1 = ex2d(image, 1.0/var, self.psf, specrange, ww, full_output=True)
+        d2 = ex2d(image, 1.0/var, self.psf, specrange, ww,
+                  full_output=True, mixed_precision=True)
+        self.assertEqual(d2['iCov'].dtype, N.float32)
+
+        #- Refined solution has float64 precision; R and ivar have the
+        #- documented float32 accuracy
+        scale = N.max(N.abs(d1['xflux']))
+        self.assertLess(N.max(N.abs(d1['xflux']-d2['xflux'])), 1e-7*scale)
+        self.assertLess(N.max(N.abs(d1['R']-d2['R'])), 1e-4)
+        self.assertTrue(N.allclose(d1['ivar'], d2['ivar'], rtol=1e-4, atol=0))
+        chi = (d1['flux']-d2['flux']) * N.sqrt(d1['ivar'])
+        self.assertLess(N.max(N.abs(chi)), 2e-3)
+        self.assertEqual(d2['flux'].dtype, N.float64)
+
+        #- A patch whose border bins are poorly constrained falls back to
+        #- float64 for R and ivar
+        p = plan_patches(self.psf, self.ww[15:35], (0, self.nspec), 5, 8)[0]
+        xmin, xmax, ymin, ymax = p.xyrange
+        args = (self.image[ymin:ymax, xmin:xmax], self.ivar[ymin:ymax, xmin:xmax],
+                self.psf, p.specrange, p.ww)
+        d1 = ex2d(*args, xyrange=p.xyrange, full_output=True, regularize=1.0)
+        d2 = ex2d(*args, xyrange=p.xyrange, full_output=True, regularize=1.0,
+                  mixed_precision=True)
+        self.assertEqual(d2['iCov'].dtype, N.float64)
+        self.assertTrue(N.all(d1['R'] == d2['R']))
+        self.assertTrue(N.all(d1['ivar'] == d2['ivar']))
+
+        #- Passed through extract_patches to ex2d
+        import specter.extract.patch
+        used = list()
+        def ex2d_spy(*args, **kwargs):
+            used.append(kwargs.get('mixed_precision'))
+            return ex2d(*args, **kwargs)
+        specter.extract.patch.ex2d = ex2d_spy
+        try:
+            extract_patches(self.image, self.ivar, self.psf, [p], len(self.ww),
+                            (0, self.nspec), mixed_precision=True)
+        finally:
+            specter.extract.patch.ex2d = ex2d
+        self.assertEqual(used, [True])
+
+    def test_mixed_precision_reject(self):
+        specrange = (0, self.nspec)
+        waverange = (self.ww[0], self.ww[-1])
+        xmin, xmax, ymin, ymax = self.psf.xyrange(specrange, waverange)
+        image = self.image.copy()
+        image[ymin+20, xmin+12] += 5000
+        image[ymin+30, xmin+40] += 2000
+        d1 = ex2d(image, self.ivar, self.psf, specrange, self.ww,
+                  full_output=True, reject_nsigma=5)
+        d2 = ex2d(image, self.ivar, self.psf, specrange, self.ww,
+                  full_output=True, reject_nsigma=5, mixed_precision=True)
+
+        #- ivar and R come from the downdated iCov, not the unmasked one
+        self.assertTrue(N.all(d1['mask'] == d2['mask']))
+        self.assertTrue(N.any(d2['mask']))
+        self.assertTrue(N.allclose(d1['xflux'], d2['xflux'], rtol=1e-8, atol=1e-6))
+        self.assertLess(N.max(N.abs(d1['R']-d2['R'])), 1e-4)
+        self.assertTrue(N.allclose(d1['ivar'], d2['ivar'], rtol=1e-4, atol=0))
+
+    def test_dead_fibers(self):
+        specrange = (0, self.nspec)
+        waverange = (self.ww[0], self.ww[-1])
+        nwave = len(self.ww)
+        fibermask = N.zeros(self.nspec, dtype=int)
+        fibermask[3] = 1
+        d1 = ex2d(self.image, self.ivar, self.psf, specrange, self.ww,
+                  full_output=True, fibermask=fibermask, profile=True)
+
+        #- Masked fiber is left out and reinserted with zero ivar
+        self.assertEqual(d1['profile']['nflux'], (self.nspec-1)*nwave)
+        self.assertTrue( N.all(d1['flux'][3] == 0.0) )
+        self.assertTrue( N.all(d1['ivar'][3] == 0.0) )
+        self.assertTrue( N.all(d1['ivar'][2] > 0.0) )
+        ii = slice(3*nwave, 4*nwave)
+        self.assertTrue( N.all(d1['R'][ii, ii] == N.identity(nwave)) )
+        self.assertEqual(d1['A'].shape[1], self.nspec*nwave)
+
+        #- Fully masked trace is detected from ivar
+        xmin, xmax, ymin, ymax = self.psf.xyrange(specrange, waverange)
+        x0, x1, y0, y1 = self.psf.xyrange((3, 4), waverange)
+        ivar = self.ivar.copy()
+        ivar[y0:y1, x0:x1] = 0.0
+        d2 = ex2d(self.image, ivar, self.psf, specrange, self.ww,
+                  full_output=True)
+        d3 = ex2d(self.image, ivar, self.psf, specrange, self.ww,
+                  full_output=True, fibermask=fibermask)
+        self.assertTrue( N.all(d2['ivar'][3] == 0.0) )
+        self.assertTrue( N.allclose(d2['flux'], d3['flux']) )
+
+    def test_extract_patches(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[15], self.ww[35], 1.0)
+        patches = plan_patches(self.psf, ww, specrange, 5, 8)
+
+        #- Every output wavelength owned by exactly one patch per bundle
+        nowned = N.zeros(len(ww), dtype=int)
+        for p in patches:
+            if p.specrange[0] == 0:
+                nowned[p.iwave:p.iwave+p.ncore] += 1
+        self.assertTrue( N.all(nowned == 1) )
+
+        #- Parallel results identical to serial results
+        r1 = extract_patches(self.image, self.ivar, self.psf, patches,
+                             len(ww), specrange, numcores=1)
+        r2 = extract_patches(self.image, self.ivar, self.psf, patches,
+                             len(ww), specrange, numcores=2)
+        for x1, x2 in zip(r1, r2):
+            self.assertTrue( N.all(x1 == x2) )
+
+        #- Without output arrays, the callback gets the same core results
+        done = list()
+        def callback(patch, flux, ivar, Rd):
+            ii = slice(*patch.specrange)
+            jj = slice(patch.iwave, patch.iwave+patch.ncore)
+            self.assertTrue( N.all(flux == r1[0][ii, jj]) )
+            self.assertTrue( N.all(ivar == r1[1][ii, jj]) )
+            self.assertTrue( N.all(Rd == r1[2][ii, :, jj]) )
+            done.append(patch.ipatch)
+        r3 = extract_patches(self.image, self.ivar, self.psf, patches,
+            len(ww), specrange, numcores=2, callback=callback, outputs=False)
+        self.assertEqual(r3, (None, None, None))
+        self.assertEqual(sorted(done), range(len(patches)))
+
+    def test_checkpoint(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[15], self.ww[35], 1.0)
+        patches = plan_patches(self.psf, ww, specrange, 5, 8)
+        flux, ivar, Rd = extract_patches(self.image, self.ivar, self.psf,
+            patches, len(ww), specrange)
+
+        fd, filename = tempfile.mkstemp(suffix='.fits')
+        os.close(fd)
+        os.remove(filename)
+        try:
+            #- Checkpoint first half of the patches
+            hashval = input_hash(self.image, self.ivar, ww, 5, 8)
+            chk = Checkpoint(filename, hashval, params=dict(nwstep=8))
+            half = range(len(patches)//2, len(patches))
+            extract_patches(self.image, self.ivar, self.psf, patches,
+                len(ww), specrange, skip=half, callback=chk.add)
+            chk.close()
+
+            #- Reopening finds them, and the rest completes the extraction
+            self.assertEqual(read_params(filename), dict(nwstep=8))
+            self.assertEqual(input_hash(read_params(filename)['nwstep']),
+                             input_hash(8))
+            chk = Checkpoint(filename, hashval)
+            chk.close()
+            self.assertEqual(sorted(chk.done.keys()), range(len(patches)//2))
+            r = extract_patches(self.image, self.ivar, self.psf, patches,
+                len(ww), specrange, skip=chk.done.keys())
+            for ipatch, (xflux, xivar, xRd) in chk.done.items():
+                p = patches[ipatch]
+                jj = slice(p.iwave, p.iwave+p.ncore)
+                r[0][p.specrange[0]:p.specrange[1], jj] = xflux
+                r[1][p.specrange[0]:p.specrange[1], jj] = xivar
+                r[2][p.specrange[0]:p.specrange[1], :, jj] = xRd
+            for x1, x2 in zip((flux, ivar, Rd), r):
+                self.assertTrue( N.all(x1 == x2) )
+
+            #- Different inputs are rejected
+            hash2 = input_hash(self.image, self.ivar, ww, 5, 9)
+            self.assertRaises(ValueError, Checkpoint, filename, hash2)
+
+            #- Appends go to the open file; a truncated last patch is dropped
+            chk = Checkpoint(filename, hashval)
+            p = patches[-1]
+            chk.add(p, *extract_patches(self.image, self.ivar, self.psf,
+                [p], len(ww), p.specrange)[0:3])
+            chk.close()
+            chk = Checkpoint(filename, hashval)
+            chk.close()
+            self.assertEqual(len(chk.done), len(patches)//2 + 1)
+            with open(filename, 'r+b') as fx:
+                fx.truncate(os.path.getsize(filename) - 2880)
+            chk = Checkpoint(filename, hashval)
+            self.assertEqual(sorted(chk.done.keys()), range(len(patches)//2))
+            chk.close()
+
+            #- An unreadable checkpoint is an error, not overwritten
+            with open(filename, 'wb') as fx:
+                fx.write('garbage')
+            self.assertRaises(IOError, Checkpoint, filename, hashval)
+            with open(filename, 'rb') as fx:
+                self.assertEqual(fx.read(), 'garbage')
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_checkpoint_killed(self):
+        #- Patches added before the process is killed can be resumed
+        script = """
+import os, sys, signal
+import numpy as N
+from specter.extract import Checkpoint
+
+class Patch(object):
+    def __init__(self, ipatch):
+        self.ipatch = ipatch
+
+chk = Checkpoint(sys.argv[1], 'killed')
+for i in range(3):
+    x = N.arange(2*7*5, dtype=float).reshape(2, 7, 5) + i
+    chk.add(Patch(i), x[:, 0], x[:, 1], x[:, 2:])
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+        fd, filename = tempfile.mkstemp(suffix='.fits')
+        os.close(fd)
+        os.remove(filename)
+        try:
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+            p = subprocess.Popen([sys.executable, '-c', script, filename],
+                                 env=env)
+            self.assertEqual(p.wait(), -signal.SIGKILL)
+
+            chk = Checkpoint(filename, 'killed')
+            chk.close()
+            self.assertEqual(sorted(chk.done.keys()), [0, 1, 2])
+            for i in range(3):
+                x = N.arange(2*7*5, dtype=float).reshape(2, 7, 5) + i
+                flux, ivar, Rd = chk.done[i]
+                self.assertTrue( N.all(flux == x[:, 0]) )
+                self.assertTrue( N.all(ivar == x[:, 1]) )
+                self.assertTrue( N.all(Rd == x[:, 2:]) )
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_tune_patches(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[0], self.ww[-1], 1.0)
+        params = tune_patches(self.psf, ww, specrange, bundlesize=5,
+                              maxstep=30)
+        self.assertEqual(params['bundlesize'], 5)
+        self.assertTrue(1 <= params['nwstep'] <= 30)
+        self.assertTrue(0 <= params['ndiag'] < 20)
+        self.assertTrue(params['border'] > 0)
+
+        #- Tuned border gives the same core as a generous border
+        patches1 = plan_patches(self.psf, ww, specrange, 5, params['nwstep'],
+                                border=params['border'])
+        patches2 = plan_patches(self.psf, ww, specrange, 5, params['nwstep'],
+                                border=3*params['border'])
+        r1 = extract_patches(self.image, self.ivar, self.psf, patches1,
+                             len(ww), specrange)
+        r2 = extract_patches(self.image, self.ivar, self.psf, patches2,
+                             len(ww), specrange)
+        chi = (r1[0] - r2[0]) * N.sqrt(r2[1])
+        self.assertLess(N.max(N.abs(chi)), 1e-3)
+
+    def test_memory(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[15], self.ww[35], 1.0)
+        patches = plan_patches(self.psf, ww, specrange, 5, 8)
+        mem = estimate_patch_memory(patches[0])
+
+        #- Split patches own the same output bins with less memory
+        for p in (patches[0], split_patch(self.psf, patches[0])[0]):
+            p1, p2 = split_patch(self.psf, p)
+            self.assertEqual(p1.ipatch, p.ipatch)
+            self.assertLess(estimate_patch_memory(p1), estimate_patch_memory(p))
+            if p1.specrange == p.specrange:
+                self.assertEqual(p1.ncore + p2.ncore, p.ncore)
+                self.assertEqual(p2.iwave, p.iwave + p1.ncore)
+                self.assertTrue(N.all(p1.ww[p1.core] == p.ww[p.core][0:p1.ncore]))
+                self.assertTrue(N.all(p2.ww[p2.core] == p.ww[p.core][p1.ncore:]))
+            else:
+                self.assertEqual(p1.specrange[1], p2.specrange[0])
+
+        #- Patches that are too big are split with consistent results
+        r1 = extract_patches(self.image, self.ivar, self.psf, patches,
+                             len(ww), specrange)
+        r2 = extract_patches(self.image, self.ivar, self.psf, patches,
+                             len(ww), specrange, max_memory=mem//2)
+        chi = (r1[0] - r2[0]) * N.sqrt(r1[1])
+        self.assertLess(N.max(N.abs(chi)), 0.5)
+        self.assertTrue( N.all(r2[1] > 0) )
+
+        #- Planner shrinks patches to fit the budget
+        bundlesize, nwstep, peak = fit_memory(self.psf, ww, specrange, 5, 8,
+                                              mem//2, minstep=2)
+        self.assertLessEqual(peak, mem//2)
+        self.assertTrue(nwstep < 8 or bundlesize < 5)
+
+    def test_failed_patches(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[15], self.ww[35], 1.0)
+        patches = plan_patches(self.psf, ww, specrange, 5, 8)
+        patches[1].specrange = (0, 1000)   #- will raise an exception
+        failed = list()
+        flux, ivar, Rd = extract_patches(self.image, self.ivar, self.psf,
+            patches, len(ww), specrange, failed=failed)
+        self.assertEqual([ipatch for ipatch, err in failed], [1,])
+        p = patches[2]
+        self.assertTrue( N.all(ivar[0:5, p.iwave:p.iwave+p.ncore] > 0) )
+
+        #- Without failed, the error is raised after stopping the thread
+        #- that builds projection matrices ahead
+        import threading
+        nthread = threading.active_count()
+        with self.assertRaises(Exception):
+            extract_patches(self.image, self.ivar, self.psf, patches,
+                            len(ww), specrange, pipeline=True)
+        self.assertEqual(threading.active_count(), nthread)
+
+    def test_model_image(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[15], self.ww[35], 1.0)
+        patches = plan_patches(self.psf, ww, specrange, 5, 8)
+
+        #- Every row of a bundle owned by exactly one patch
+        for speclo in (0, 5):
+            yr = [p.yrange for p in patches if p.specrange[0] == speclo]
+            for (y0, y1), (y2, y3) in zip(yr[:-1], yr[1:]):
+                self.assertEqual(y1, y2)
+
+        models = list()
+        for numcores, max_memory in ((1, None), (2, None), (1, 10**5)):
+            model = ModelImage(self.image.shape)
+            extract_patches(self.image, self.ivar, self.psf, patches,
+                len(ww), specrange, numcores=numcores, max_memory=max_memory,
+                model=model)
+            models.append(model)
+        self.assertTrue(N.allclose(models[0].image, models[1].image))
+        self.assertTrue(N.all(models[0].covered == models[2].covered))
+
+        #- Residuals away from the ends of the wavelength range are noise
+        model = models[0]
+        chi2 = model.chi2(self.image, self.ivar)
+        y0, y1 = patches[1].yrange[0], patches[-2].yrange[1]
+        self.assertLess(N.mean(chi2[y0:y1][model.covered[y0:y1]]), 1.5)
+        fiberchi2 = model.fiber_chi2(self.psf, self.image, self.ivar, specrange)
+        self.assertEqual(len(fiberchi2), self.nspec)
+        self.assertTrue(N.all(fiberchi2['NPIX'] > 0))
+        self.assertGreater(fiberchi2['CHI2'].sum(), 0.9*chi2.sum())
+
+    def test_pipeline(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[15], self.ww[35], 1.0)
+        patches = plan_patches(self.psf, ww, specrange, 5, 8)
+
+        #- Projection matrices built ahead of time give identical results
+        r1 = extract_patches(self.image, self.ivar, self.psf, patches,
+                             len(ww), specrange, pipeline=False)
+        r2 = extract_patches(self.image, self.ivar, self.psf, patches,
+                             len(ww), specrange, pipeline=True)
+        for x1, x2 in zip(r1, r2):
+            self.assertTrue( N.all(x1 == x2) )
+
+        #- Each patch's profile includes its own projection, and only the
+        #- PSF spots that it evaluated
+        prof1 = extract_patches(self.image, self.ivar, self.psf, patches,
+            len(ww), specrange, pipeline=False, profile=True)[3]
+        prof2 = extract_patches(self.image, self.ivar, self.psf, patches,
+            len(ww), specrange, pipeline=True, profile=True)[3]
+        for p1, p2 in zip(prof1, prof2):
+            self.assertGreater(p2['time_projection'], 0)
+            self.assertEqual(p1['cache_hits'] + p1['cache_misses'],
+                             p2['cache_hits'] + p2['cache_misses'])
+
+        p = patches[0]
+        xmin, xmax, ymin, ymax = p.xyrange
+        A = patch_projection(self.ivar, self.psf, p)
+        with self.assertRaises(ValueError):
+            ex2d(self.image[ymin:ymax, xmin:xmax], self.ivar[ymin:ymax, xmin:xmax],
+                 self.psf, p.specrange, p.ww[1:], xyrange=p.xyrange, A=A)
+
+        #- A patch split after a MemoryError holds the PSF lock while its
+        #- pieces build their own projection matrices
+        import threading
+        import specter.extract.patch
+        lock = threading.Lock()
+        locked = list()
+        def ex2d_nomem(*args, **kwargs):
+            if kwargs.get('A') is not None:
+                raise MemoryError
+            locked.append(lock.locked())
+            return ex2d(*args, **kwargs)
+        specter.extract.patch.ex2d = ex2d_nomem
+        try:
+            extract_patch(self.image, self.ivar, self.psf, p, A=A,
+                          splitlock=lock)
+        finally:
+            specter.extract.patch.ex2d = ex2d
+        self.assertGreater(len(locked), 1)
+        self.assertTrue(all(locked))
+        self.assertFalse(lock.locked())
+
+    def test_patch_cache(self):
+        specrange = (0, self.nspec)
+        ww = N.arange(self.ww[15], self.ww[35], 1.0)
+        patches = plan_patches(self.psf, ww, specrange, 5, 8)
+        psfhash = input_hash('file:' + test_data_dir() + "/psf-spot.fits")
+        cachedir = tempfile.mkdtemp()
+        try:
+            #- Second run comes entirely from the cache
+            cache = PatchCache(cachedir, psfhash)
+            r1 = extract_patches(self.image, self.ivar, self.psf, patches,
+                                 len(ww), specrange, cache=cache)
+            self.assertEqual(cache.nhit, 0)
+            cache = PatchCache(cachedir, psfhash)
+            r2 = extract_patches(self.image, self.ivar, self.psf, patches,
+                                 len(ww), specrange, cache=cache)
+            self.assertEqual(cache.nhit, len(patches))
+            for x1, x2 in zip(r1, r2):
+                self.assertTrue( N.all(x1 == x2) )
+
+            #- A different PSF doesn't reuse them, and a PSF hash is required
+            cache = PatchCache(cachedir, input_hash('another psf'))
+            extract_patches(self.image, self.ivar, self.psf, patches[0:1],
+                            len(ww), specrange, cache=cache)
+            self.assertEqual(cache.nhit, 0)
+            self.assertRaises(ValueError, PatchCache, cachedir, '')
+
+            #- A memory budget that splits patches changes their keys;
+            #- one that doesn't split them doesn't
+            p = patches[0]
+            key = cache.key(self.image, self.ivar, p, 10, 0.0)
+            nbytes = estimate_patch_memory(p)
+            self.assertEqual(key, cache.key(self.image, self.ivar, p, 10, 0.0,
+                                            max_memory=nbytes))
+            self.assertNotEqual(key, cache.key(self.image, self.ivar, p, 10, 0.0,
+                                               max_memory=nbytes//2))
+            self.assertNotEqual(key, cache.key(self.image, self.ivar, p, 10, 0.0,
+                                               mixed_precision=True))
+            cache = PatchCache(cachedir, psfhash)
+            extract_patches(self.image, self.ivar, self.psf, patches,
+                            len(ww), specrange, cache=cache, max_memory=10**5)
+            self.assertEqual(cache.nhit, 0)
+
+            #- Changing the pixels of one patch only reruns patches using them
+            image = self.image.copy()
+            xmin, xmax, ymin, ymax = patches[0].xyrange
+            image[ymin, xmin] += 1.0
+            cache = PatchCache(cachedir, psfhash)
+            extract_patches(image, self.ivar, self.psf, patches,
+                            len(ww), specrange, cache=cache)
+            self.assertGreater(cache.nmiss, 0)
+            self.assertLess(cache.nmiss, len(patches))
+
+            #- Size limit evicts the least recently used results
+            nbytes = cache._nbytes
+            cache = PatchCache(cachedir, psfhash, max_bytes=nbytes//2)
+            extract_patches(self.image, self.ivar, self.psf, patches[0:1],
+                            len(ww), specrange, cache=cache, regularize=0.1)
+            self.assertLessEqual(cache._nbytes, nbytes//2)
+            self.assertIsNotNone(cache.get(cache.key(self.image, self.ivar,
+                patches[0], 10, 0.1)))
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_ex1d(self):
+        specrange = (0, self.nspec)
+        yrange = (10, 60)
+        mask = N.zeros(self.image.shape, dtype=int)
+        flux, ivar = ex1d(self.image, mask, self.psf, specrange=specrange,
+                          yrange=yrange)
+        self.assertEqual(flux.shape, (self.nspec, 50))
+        self.assertTrue(N.all(ivar > 0))
+
+        #- Batching rows doesn't change the results
+        f2, iv2, model = ex1d(self.image, mask, self.psf, specrange=specrange,
+                              yrange=yrange, rows_per_batch=7, model=True)
+        self.assertTrue(N.allclose(flux, f2, rtol=1e-10, atol=1e-10))
+        self.assertTrue(N.allclose(ivar, iv2, rtol=1e-10, atol=1e-10))
+        self.assertTrue(N.any(model[10:60] != 0))
+
+        #- Groups and row chunks extracted in parallel give identical results
+        f4, iv4, m4 = ex1d(self.image, mask, self.psf, specrange=specrange,
+                           yrange=yrange, nspec_per_group=3, model=True,
+                           numcores=2, rows_per_chunk=20)
+        f5, iv5, m5 = ex1d(self.image, mask, self.psf, specrange=specrange,
+                           yrange=yrange, nspec_per_group=3, model=True)
+        self.assertTrue( N.all(f4 == f5) )
+        self.assertTrue( N.all(iv4 == iv5) )
+        self.assertTrue( N.all(m4 == m5) )
+
+        #- One pool reused for several chunks of rows and options
+        img = shared_array(self.image.shape)
+        img[...] = self.image
+        smask = shared_array(mask.shape, dtype=mask.dtype)
+        pool = Ex1dPool(img, smask, self.psf, 2)
+        try:
+            for ylo, yhi, reweight in ((10, 35, True), (35, 60, False)):
+                f6, iv6 = ex1d(img, smask, self.psf, specrange=specrange,
+                               yrange=(ylo, yhi), nspec_per_group=3,
+                               reweight=reweight, pool=pool)
+                f7, iv7 = ex1d(self.image, mask, self.psf, specrange=specrange,
+                               yrange=(ylo, yhi), nspec_per_group=3,
+                               reweight=reweight)
+                self.assertTrue( N.all(f6 == f7) )
+                self.assertTrue( N.all(iv6 == iv7) )
+            with self.assertRaises(ValueError):
+                ex1d(self.image, mask, self.psf, pool=pool)
+        finally:
+            pool.close()
+
+        #- Masked pixels get no weight
+        mask[30, :] = 1
+        f3, iv3 = ex1d(self.image, mask, self.psf, specrange=specrange,
+                       yrange=yrange)
+        self.assertTrue(N.all(N.isfinite(f3)))
+        self.assertTrue(N.all(iv3[:, 30-10] == 0))
+        self.assertTrue(N.all(f3[:, 30-10] == 0))
+
+    def test_profile_table(self):
+        table = ProfileTable(self.psf, (0, self.nspec))
+        self.assertTrue( N.allclose(table.table.sum(axis=-1), 1.0) )
+        with self.assertRaises(ValueError):
+            table.profiles(self.nspec, self.ww[0:1], [10.0])
+
+        #- Tabulated profiles model a smooth spectrum better than Gaussians
+        ww = self.psf.wavelength(0, y=N.arange(-10, 80))
+        phot = N.ones((self.nspec, len(ww))) * 100
+        img = self.psf.project(ww, phot, verbose=False)
+        mask = N.zeros(img.shape, dtype=int)
+        specrange, yrange = (0, self.nspec), (20, 50)
+        f1, iv1, m1 = ex1d(img, mask, self.psf, specrange=specrange,
+                           yrange=yrange, model=True)
+        f2, iv2, m2 = ex1d(img, mask, self.psf, specrange=specrange,
+                           yrange=yrange, model=True, profiles=table)
+        chi1 = N.sum((img - m1)[20:50]**2)
+        chi2 = N.sum((img - m2)[20:50]**2)
+        self.assertLess(chi2, chi1)
+        self.assertLess(N.abs(N.mean(f2) - 100), N.abs(N.mean(f1) - 100))
+
+    def test_ex1d_reweight(self):
+        specrange, yrange = (0, self.nspec), (10, 60)
+        mask = N.zeros(self.image.shape, dtype=int)
+        f1, iv1 = ex1d(self.image, mask, self.psf, specrange=specrange,
+                       yrange=yrange)
+        f2, iv2 = ex1d(self.image, mask, self.psf, specrange=specrange,
+                       yrange=yrange, reweight=False)
+        #- Same ivar, and readnoise weighting changes the flux by << sigma
+        self.assertTrue( N.allclose(iv1, iv2) )
+        self.assertLess( N.median(N.abs(f1-f2)*N.sqrt(iv1)), 0.5 )
+
+        #- Resampled back onto the rows' own wavelengths
+        ww = self.psf.wavelength(0, y=N.arange(20, 50))
+        rflux, rivar = resample_rows(self.psf, f1[0:1], iv1[0:1], ww,
+                                     specrange=(0, 1), yrange=yrange)
+        dwdy = N.gradient(self.psf.wavelength(0, y=N.arange(10, 60)))[10:40]
+        self.assertTrue( N.allclose(rflux[0], f1[0, 10:40]/dwdy) )
+        self.assertTrue( N.allclose(rivar[0], iv1[0, 10:40]*dwdy**2) )
+        rflux, rivar = resample_rows(self.psf, f1[0:1], iv1[0:1],
+            [ww[0]-100.0], specrange=(0, 1), yrange=yrange)
+        self.assertEqual(rivar[0, 0], 0.0)
+
+    def test_rectify(self):
+        #- Flux of a single spectrum is preserved row by row
+        ww = self.psf.wavelength(2, y=N.arange(-10, 80))
+        img = self.psf.project(ww, N.ones((1, len(ww)))*100, specmin=2,
+                               verbose=False)
+        ivar = N.ones(img.shape)
+        rect = rectify(img, ivar, self.psf, specrange=(2, 3), yrange=(10, 60),
+                       halfwidth=8)
+        self.assertEqual(rect.flux.shape, (1, 50, 17))
+        self.assertTrue( N.allclose(rect.flux.sum(axis=2)[0], img[10:60].sum(axis=1)) )
+
+        #- Variance of the two overlapping pixels weighted by overlap
+        f = N.floor(rect.xtrace - 8) + 1 - (rect.xtrace - 8)
+        var = f**2 + (1-f)**2
+        self.assertTrue( N.allclose(rect.ivar[0, :, 4], 1.0/var[0]) )
+        self.assertTrue( N.allclose(rect.overlap(), f) )
+
+        #- Boxcar ivar matches the scatter of noise realizations, including
+        #- the correlations between neighboring rectified pixels
+        var = 1.0 + img
+        fluxes = list()
+        for i in range(200):
+            noisy = img + N.random.normal(scale=N.sqrt(var))
+            rect = rectify(noisy, 1.0/var, self.psf, specrange=(0, 3),
+                           yrange=(10, 60), halfwidth=2)
+            flux, fivar = rect.boxcar()
+            fluxes.append(flux)
+        ratio = N.var(fluxes, axis=0) * fivar
+        self.assertTrue( abs(N.mean(ratio) - 1) < 0.03 )
+
+        #- Masked pixels and pixels off the CCD get ivar=0
+        ivar[30, :] = 0.0
+        rect = rectify(img, ivar, self.psf, specrange=(0, 3), yrange=(10, 60))
+        self.assertTrue( N.all(rect.ivar[:, 20] == 0) )
+        self.assertTrue( N.all(rect.ivar[:, 19] > 0) )
+        flux, fivar = rect.boxcar(2)
+        self.assertEqual(flux.shape, (3, 50))
+        self.assertTrue( N.all(fivar[:, 20] == 0) )
+
+        #- Memory mapped round trip
+        fd, filename = tempfile.mkstemp(suffix='.fits')
+        os.close(fd)
+        try:
+            rect.write(filename)
+            rect2 = RectifiedImage.read(filename)
+            self.assertTrue(isinstance(rect2.flux, N.memmap))
+            self.assertTrue( N.all(rect2.flux == rect.flux) )
+            self.assertTrue( N.all(rect2.ivar == rect.ivar) )
+            self.assertTrue( N.all(rect2.xtrace == rect.xtrace) )
+            self.assertEqual(rect2.ymin, 10)
+        finally:
+            os.remove(filename)
+
+    def test_cholesky_banded(self):
+        from specter.extract.ex1d import _cholesky_banded_solve
+        nr, n, nband = 4, 9, 2
+        M = N.zeros((nr, n, n))
+        for r in range(nr):
+            i, j = N.indices((n, n))
+            B = N.random.uniform(size=(n, n)) * (N.abs(i-j) <= 1) + N.eye(n)
+            M[r] = B.T.dot(B)
+        y = N.random.uniform(size=(nr, n))
+        Mb = [N.zeros((nr, n)) for k in range(nband+1)]
+        for k in range(nband+1):
+            for i in range(n-k):
+                Mb[k][:, i] = M[:, i, i+k]
+        x = _cholesky_banded_solve(Mb, y)
+        for r in range(nr):
+            self.assertTrue(N.allclose(x[r], N.linalg.solve(M[r], y[r])))
+
+    def test_gauss_profiles(self):
+        from specter.extract.ex1d import _gauss_profiles
+        from specter.util import gaussint
+        nr, nspec = 6, 8
+        xmin = N.array([0, 1, 2, 0, 1, 2])
+        x0 = 1.0 + 7.5*N.arange(nspec) + N.random.uniform(-1, 1, (nr, nspec))
+        xsigma = N.random.uniform(0.8, 1.3, (nr, nspec))
+        pix = xmin[:, None] + N.arange(int(x0.max()) + 8)
+        A, xlo, xhi = _gauss_profiles(pix, x0, xsigma)
+
+        #- Same as integrating every profile over every column, then
+        #- truncating at 5 sigma, including profiles cut by the row ends
+        xp, xc, sig = pix[:, :, None], x0[:, None, :], xsigma[:, None, :]
+        B = gaussint(xp+0.5, xc, sig) - gaussint(xp-0.5, xc, sig)
+        B *= (xp >= xlo[:, None, :]) & (xp < xhi[:, None, :])
+        self.assertTrue( N.all(A == B) )
+
 if __name__ == '__main__':
     unittest.main()           
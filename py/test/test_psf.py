@@ -6,10 +6,15 @@ Unit tests for PSF classes.
 
 import sys
 import os
+import tempfile
+import shutil
 import numpy as N
+import fitsio
 import unittest
 
-from specter.psf import load_psf
+from specter.psf import load_psf, project_parallel, project_lines, TrailKernels
+from specter.psf import ProjectionOperator, projection_operator, SimWorkspace
+from specter.util import input_hash
 from specter.test import test_data_dir
 
 class TestPSF(unittest.TestCase):
@@ -258,6 +263,170 @@ class TestPSF(unittest.TestCase):
         
         subimg = self.psf.project(ww, phot, xyrange=xyrange, verbose=False)
 
+    #- Test parallel projection into bands of a shared image
+    def test_project_parallel(self):
+        nspec = 5
+        ww = self.psf.wavelength(0)[1000:1100]
+        phot = N.random.uniform(0,100,(nspec, len(ww)))
+        xyrange = self.psf.xyrange((0, nspec), ww)
+        img = self.psf.project(ww, phot, specmin=1, xyrange=xyrange)
+        pimg = project_parallel(self.psf, ww, phot, specmin=1,
+                                xyrange=xyrange, numcores=2, nband=5)
+        self.assertTrue(N.all(pimg == img))
+
+        #- Accumulate into an existing image
+        img2 = N.ones(img.shape)
+        self.psf.project(ww, phot, specmin=1, xyrange=xyrange, out=img2)
+        self.assertTrue(N.allclose(img2, img+1))
+        with self.assertRaises(ValueError):
+            self.psf.project(ww, phot, xyrange=xyrange, out=img2[1:])
+
+    #- Test projection of a sparse line list
+    def test_project_lines(self):
+        nspec = 5
+        ww = N.linspace(self.psf.wmin-10, self.psf.wmax+10, 40)
+        phot = N.random.uniform(100, 1000, (nspec, len(ww)))
+        phot[:, ::5] = 0.0
+        img = self.psf.project(ww, phot, specmin=2)
+        limg = project_lines(self.psf, ww, phot, specmin=2)
+        self.assertTrue(N.allclose(limg, img, rtol=1e-10, atol=1e-10))
+
+        #- Subimage, several batches, and adding into an existing image
+        xyrange = self.psf.xyrange((2, 5), (ww[10], ww[20]))
+        img = self.psf.project(ww, phot[0:3], specmin=2, xyrange=xyrange)
+        limg = N.ones(img.shape)
+        project_lines(self.psf, ww, phot[0:3], specmin=2, xyrange=xyrange,
+                      out=limg, batchsize=100)
+        self.assertTrue(N.allclose(limg, img+1, rtol=1e-10, atol=1e-10))
+        with self.assertRaises(ValueError):
+            project_lines(self.psf, ww, phot, xyrange=xyrange, out=limg[1:])
+
+    #- Test the reusable sparse projection operator
+    def test_projection_operator(self):
+        nspec = 4
+        ww = self.psf.wavelength(2)[1000:1050]
+        xyrange = self.psf.xyrange((2, 2+nspec), ww)
+        op = projection_operator(self.psf, ww, (2, 2+nspec), xyrange, salt='test')
+        phot = N.random.uniform(-10, 100, (3, nspec, len(ww)))
+        for i in range(3):
+            img = self.psf.project(ww, phot[i], specmin=2, xyrange=xyrange)
+            self.assertTrue(N.allclose(op.project(phot[i]), img))
+        imgs = op.project(phot)
+        self.assertEqual(imgs.shape, (3,) + img.shape)
+        self.assertTrue(N.allclose(imgs[2], img))
+        with self.assertRaises(ValueError):
+            op.project(phot[:, 1:])
+
+        #- Round trip through a file
+        fd, filename = tempfile.mkstemp(suffix='.fits')
+        os.close(fd)
+        try:
+            op.write(filename)
+            op2 = ProjectionOperator.read(filename)
+            self.assertTrue(op2.matches(ww, (2, 2+nspec), xyrange, salt='test'))
+            self.assertFalse(op2.matches(ww, (1, 1+nspec), xyrange, salt='test'))
+            self.assertFalse(op2.matches(ww[1:], (2, 2+nspec), xyrange, salt='test'))
+            self.assertFalse(op2.matches(ww, (2, 2+nspec), xyrange))
+            self.assertTrue(N.all(op2.project(phot) == imgs))
+        finally:
+            os.remove(filename)
+
+    #- Test that an operator saved for one PSF file isn't reused for another
+    def test_projection_operator_psf(self):
+        psffile = test_data_dir() + "/psf-spot.fits"
+        psf = load_psf(psffile)
+        ww = psf.wavelength(2)[1000:1010]
+        xyrange = psf.xyrange((2, 4), ww)
+        op = projection_operator(psf, ww, (2, 4), xyrange,
+                                 salt=input_hash('file:'+psffile))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            otherfile = os.path.join(tmpdir, 'psf-other.fits')
+            shutil.copy(psffile, otherfile)
+            self.assertTrue(op.matches(ww, (2, 4), xyrange,
+                                       salt=input_hash('file:'+otherfile)))
+            fx = fitsio.FITS(otherfile, 'rw')
+            fx[0].write_key('COMMENT', 'modified copy')
+            fx.close()
+
+            filename = os.path.join(tmpdir, 'op.fits')
+            op.write(filename)
+            op2 = ProjectionOperator.read(filename)
+            self.assertTrue(op2.matches(ww, (2, 4), xyrange,
+                                        salt=input_hash('file:'+psffile)))
+            self.assertFalse(op2.matches(ww, (2, 4), xyrange,
+                                         salt=input_hash('file:'+otherfile)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    #- Test incremental re-simulation with per-spectrum contributions
+    def test_sim_workspace(self):
+        nspec = 4
+        ww = self.psf.wavelength(2)[1000:1050]
+        phot = N.random.uniform(0, 100, (nspec, len(ww)))
+        ws = SimWorkspace(self.psf, salt='test')
+        self.assertEqual(ws.update(ww, phot, specmin=2), [2, 3, 4, 5])
+        img = self.psf.project(ww, phot, specmin=2)
+        self.assertTrue(N.allclose(ws.image, img))
+
+        #- Only changed spectra are re-projected
+        self.assertEqual(ws.update(ww, phot, specmin=2), [])
+        phot[1] *= 2
+        phot[3] = 0.0
+        self.assertEqual(ws.update(ww, phot, specmin=2), [3, 5])
+        img = self.psf.project(ww, phot, specmin=2)
+        self.assertTrue(N.allclose(ws.image, img))
+
+        #- Save, reload, and remove a spectrum
+        fd, filename = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            ws.save(filename)
+            ws2 = SimWorkspace(self.psf, salt='test', filename=filename)
+            self.assertTrue(N.all(ws2.image == ws.image))
+            self.assertEqual(ws2.update(ww, phot, specmin=2), [])
+            ws2.remove([2])
+            img = self.psf.project(ww, phot[1:], specmin=3)
+            self.assertTrue(N.allclose(ws2.image, img))
+            ws3 = SimWorkspace(self.psf, salt='other', filename=filename)
+            self.assertEqual(len(ws3.contrib), 0)
+        finally:
+            os.remove(filename)
+
+    #- Test trail kernel projection of a smooth continuum
+    def test_trail_kernels(self):
+        specrange = (2, 5)
+        ww = self.psf.wavelength(3, y=N.arange(300, 500, 0.25))
+        phot = N.tile(N.linspace(100, 200, len(ww)), (3, 1))
+        img = self.psf.project(ww, phot, specmin=2)
+        trails = TrailKernels(self.psf, specrange, nstep=50)
+        timg = trails.project(ww, phot, specmin=2)
+
+        #- Same total flux, and same pixels away from the ends of the spectra
+        self.assertAlmostEqual(timg.sum()/img.sum(), 1.0, 3)
+        rows = slice(330, 470)
+        rms = N.sqrt(N.mean((timg[rows]-img[rows])**2) / N.mean(img[rows]**2))
+        self.assertLess(rms, 0.01)
+
+        #- Spectra outside of the table
+        with self.assertRaises(ValueError):
+            trails.project(ww, phot, specmin=3)
+
+    #- Test trail kernel projection at the ends of the CCD
+    def test_trail_kernels_edges(self):
+        ny = self.psf.npix_y
+        ww = self.psf.wavelength(3, y=N.arange(-5, ny+5, 0.25))
+        phot = N.tile(N.linspace(100, 200, len(ww)), (3, 1))
+        img = self.psf.project(ww, phot, specmin=2)
+        trails = TrailKernels(self.psf, (2, 5), nstep=50)
+        timg = trails.project(ww, phot, specmin=2)
+
+        self.assertAlmostEqual(timg.sum()/img.sum(), 1.0, 6)
+        for rows in (slice(0, 40), slice(ny-40, ny)):
+            err = N.abs(timg[rows]-img[rows]).max() / img.max()
+            self.assertLess(err, 0.01)
+
     #- Test the projection matrix gives same answer as psf.project()
     def test_projection_matrix(self):
         nspec = 5
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for banded resolution matrices
+"""
+
+import os
+import tempfile
+import unittest
+import numpy as N
+from specter.extract import ResolutionMatrix
+
+class TestResolution(unittest.TestCase):
+    """
+    Test specter.extract.resolution
+    """
+    def setUp(self):
+        N.random.seed(0)
+        self.nspec = 3
+        self.nwave = 30
+        self.ndiag = 4
+        n = self.nspec*self.nwave
+        self.R = N.random.uniform(size=(n, n))
+
+    def test_from_dense(self):
+        nw, ndiag = self.nwave, self.ndiag
+        core = slice(5, 25)
+        rm = ResolutionMatrix.from_dense(self.R, self.nspec, ndiag, core)
+        self.assertEqual(rm.data.shape, (self.nspec, 2*ndiag+1, 20))
+        self.assertEqual(rm.ndiag, ndiag)
+        for i in range(self.nspec):
+            Rx = self.R[nw*i:nw*(i+1), nw*i:nw*(i+1)]
+            for j in range(core.start, core.stop):
+                col = rm.data[i, :, j-core.start]
+                self.assertTrue( N.all(col == Rx[j-ndiag:j+ndiag+1, j]) )
+
+        #- Elements beyond the edges are 0
+        rm = ResolutionMatrix.from_dense(self.R, self.nspec, ndiag)
+        self.assertTrue( N.all(rm.data[:, 0:ndiag, 0] == 0.0) )
+        self.assertTrue( N.all(rm.data[:, ndiag+1:, -1] == 0.0) )
+
+    def test_dot(self):
+        rm = ResolutionMatrix.from_dense(self.R, self.nspec, self.ndiag)
+        flux = N.random.uniform(size=(self.nspec, self.nwave))
+        rflux = rm.dot(flux)
+        tflux = rm.tdot(flux)
+        for i in range(self.nspec):
+            R = rm.matrix(i)
+            self.assertTrue( N.allclose(rflux[i], R.dot(flux[i])) )
+            self.assertTrue( N.allclose(tflux[i], R.T.dot(flux[i])) )
+
+        #- 1D flux applied to every spectrum
+        self.assertTrue( N.allclose(rm.dot(flux[0])[1], rm.matrix(1).dot(flux[0])) )
+
+    def test_io(self):
+        rm = ResolutionMatrix.from_dense(self.R, self.nspec, self.ndiag)
+        fd, filename = tempfile.mkstemp(suffix='.fits')
+        os.close(fd)
+        os.remove(filename)
+        try:
+            rm.write(filename, dtype=N.float32)
+            rx = ResolutionMatrix.read(filename)
+            self.assertEqual(rx.data.dtype, N.float32)
+            self.assertTrue( N.allclose(rx.data, rm.data, rtol=1e-6) )
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,8 +8,12 @@ that we can read them.
 import os
 from os.path import basename
 from glob import glob
+import tempfile
 import unittest
 
+import numpy as N
+import fitsio
+
 import specter.io
 from specter.test import test_data_dir
 
@@ -27,6 +31,128 @@ class TestSpecIO(unittest.TestCase):
                 wipeout = e
         if wipeout:
             raise wipeout
+
+    def test_spectra_writer(self):
+        nspec, nwave, ndiag = 6, 20, 3
+        ww = 5000.0 + N.arange(nwave)
+        flux = N.random.uniform(size=(nspec, nwave))
+        ivar = N.random.uniform(size=(nspec, nwave))
+        Rd = N.random.uniform(size=(nspec, 2*ndiag+1, nwave))
+
+        fd, filename = tempfile.mkstemp(suffix='.fits')
+        os.close(fd)
+        try:
+            writer = specter.io.SpectraWriter(filename, nspec, ww, ndiag,
+                header=dict(FOO='bar'))
+            writer.write(0, flux[0:4], ivar[0:4], Rd[0:4])
+            self.assertEqual(fitsio.read_header(filename, 'FLUX')['NSPECOUT'], 4)
+            writer.write(4, flux[4:], ivar[4:], Rd[4:])
+            writer.close()
+
+            fx = fitsio.FITS(filename)
+            self.assertTrue( N.all(fx['FLUX'].read() == flux) )
+            self.assertTrue( N.all(fx['IVAR'].read() == ivar) )
+            self.assertTrue( N.all(fx['WAVELENGTH'].read() == ww) )
+            self.assertTrue( N.all(fx['RESOLUTION'].read() == Rd) )
+            hdr = fx['FLUX'].read_header()
+            self.assertEqual(hdr['NSPECOUT'], nspec)
+            self.assertEqual(hdr['FOO'].strip(), 'bar')
+            fx.close()
+
+            #- Without a resolution matrix
+            writer = specter.io.SpectraWriter(filename, nspec, ww, None)
+            writer.write(0, flux, ivar)
+            writer.close()
+            fx = fitsio.FITS(filename)
+            self.assertTrue( N.all(fx['FLUX'].read() == flux) )
+            self.assertFalse('RESOLUTION' in fx)
+            fx.close()
+        finally:
+            os.remove(filename)
+
+    def test_image_reader(self):
+        image = N.random.uniform(size=(30, 20))
+        ivar = N.random.uniform(size=(30, 20)).astype('f4')
+        counts = N.random.randint(0, 1000, size=(30, 20)).astype('i4')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            plain = tmpdir + '/plain.fits'
+            fitsio.write(plain, image)
+            fitsio.write(plain, ivar)
+            packed = tmpdir + '/packed.fits'
+            fitsio.write(packed, counts, compress='rice')
+            fitsio.write(packed, counts, compress='rice')
+            N.save(tmpdir + '/image.npy', image)
+            N.save(tmpdir + '/ivar.npy', ivar)
+
+            readers = [(specter.io.ImageReader(plain), image, ivar),
+                       (specter.io.ImageReader(packed), counts, counts),
+                       (specter.io.ImageReader(tmpdir + '/image.npy',
+                            ivarfile=tmpdir + '/ivar.npy'), image, ivar)]
+            for reader, img, iv in readers:
+                self.assertEqual(reader.shape, img.shape)
+                subimg, subivar = reader.read( (3, 11, 5, 25) )
+                self.assertEqual(subimg.dtype, N.float64)
+                self.assertTrue( N.all(subimg == img[5:25, 3:11]) )
+                self.assertTrue( N.all(subivar == iv[5:25, 3:11]) )
+                self.assertTrue( N.all(reader.image[...] == img) )
+
+            with self.assertRaises(ValueError):
+                specter.io.ImageReader(tmpdir + '/image.npy')
+        finally:
+            for filename in glob(tmpdir + '/*'):
+                os.remove(filename)
+            os.rmdir(tmpdir)
+
+    def test_merge_bundles(self):
+        nwave, ndiag = 15, 2
+        ww = 5000.0 + N.arange(nwave)
+        flux = N.random.uniform(size=(9, nwave))
+        Rd = N.random.uniform(size=(9, 2*ndiag+1, nwave))
+        tmpdir = tempfile.mkdtemp()
+
+        def write_bundle(filename, lo, hi, ww=ww, rdtype='f8'):
+            hdr = dict(SPECMIN=lo, SPECMAX=hi-1, NSPEC=hi-lo)
+            writer = specter.io.SpectraWriter(filename, hi-lo, ww, ndiag,
+                                              header=hdr, resolution_dtype=rdtype)
+            writer.write(0, flux[lo:hi], 2*flux[lo:hi], Rd[lo:hi])
+            writer.close()
+
+        try:
+            bundles = list()
+            for lo, hi in ((3, 6), (0, 3), (6, 9)):
+                bundles.append(tmpdir + '/bundle{}.fits'.format(lo))
+                write_bundle(bundles[-1], lo, hi)
+            outfile = tmpdir + '/merged.fits'
+            nspec = specter.io.merge_bundles(bundles, outfile)
+            self.assertEqual(nspec, 9)
+            self.assertTrue( N.all(fitsio.read(outfile, 'FLUX') == flux) )
+            self.assertTrue( N.all(fitsio.read(outfile, 'IVAR') == 2*flux) )
+            self.assertTrue( N.all(fitsio.read(outfile, 'RESOLUTION') == Rd) )
+            hdr = fitsio.read_header(outfile, 'FLUX')
+            self.assertEqual( (hdr['SPECMIN'], hdr['SPECMAX'], hdr['NSPEC']), (0, 8, 9) )
+
+            #- float32 resolution stays float32
+            for lo, hi in ((3, 6), (0, 3), (6, 9)):
+                write_bundle(tmpdir + '/bundle{}.fits'.format(lo), lo, hi,
+                             rdtype='f4')
+            specter.io.merge_bundles(bundles, outfile)
+            R = fitsio.read(outfile, 'RESOLUTION')
+            self.assertEqual(R.dtype.itemsize, 4)
+            self.assertTrue( N.all(R == Rd.astype('f4')) )
+
+            #- Missing spectra, wrong count, and mismatched wavelengths
+            with self.assertRaises(ValueError):
+                specter.io.merge_bundles(bundles[1:], outfile)
+            with self.assertRaises(ValueError):
+                specter.io.merge_bundles(bundles, outfile, nspec=10)
+            write_bundle(bundles[2], 6, 9, ww=ww+0.5)
+            with self.assertRaises(ValueError):
+                specter.io.merge_bundles(bundles, outfile)
+        finally:
+            for filename in glob(tmpdir + '/*'):
+                os.remove(filename)
+            os.rmdir(tmpdir)
             
 if __name__ == '__main__':
     unittest.main()            
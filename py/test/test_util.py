@@ -6,11 +6,32 @@ Unit tests for PSF classes.
 
 import sys
 import os
+import time
+import threading
+import ctypes
+import multiprocessing as MP
 import numpy as np
 from numpy.polynomial import legendre
 from specter import util
+from specter.util.sharedmem import _loaded_libraries
 import unittest
 
+def _openblas_threads(nthreads):
+    """
+    Limit BLAS threads and return the OpenBLAS thread count, or None if
+    OpenBLAS isn't loaded
+    """
+    util.limit_blas_threads(nthreads)
+    for path in _loaded_libraries():
+        if 'openblas' in os.path.basename(path):
+            lib = ctypes.CDLL(path)
+            for name in ('openblas_get_num_threads', 'openblas_get_num_threads64_',
+                         'scipy_openblas_get_num_threads64_'):
+                func = getattr(lib, name, None)
+                if func is not None:
+                    return func()
+    return None
+
 class TestUtil(unittest.TestCase):
     """
     Test functions within specter.util
@@ -58,7 +79,78 @@ class TestUtil(unittest.TestCase):
         self.assertTrue(a.shape == util.sincshift2d(a, 0.1, 0.0).shape)
         self.assertTrue(a.shape == util.sincshift2d(a, 0.0, 0.1).shape)
         self.assertTrue(a.shape == util.sincshift2d(a, 0.1, 0.1).shape)
+
+        #- Vectorized shifts of a stack of images, including no shift
+        a = np.random.uniform(0, 1, (4, 6, 5))
+        dx = np.array([0.1, 0.0, -0.15, 0.0])
+        dy = np.array([0.2, 0.1, 0.0, 0.0])
+        b = util.sincshift_many(a, dx, dy)
+        for i in range(len(a)):
+            self.assertTrue(np.allclose(b[i], util.sincshift(a[i], dx[i], dy[i])))
+        self.assertTrue(np.all(b[3] == a[3]))
+
+    def test_interp2d(self):
+        x = np.arange(3.0)
+        y = np.arange(4.0)
+        data = np.random.uniform(0, 1, (3, 4, 2, 2))
+        f = util.LinearInterp2D(x, y, data)
+        self.assertTrue(np.allclose(f(1.0, 2.0), data[1, 2]))
+        yy = np.array([0.5, 1.0, 2.7])
+        fy = f(0.3, yy)
+        for i in range(len(yy)):
+            self.assertTrue(np.allclose(fy[i], f(0.3, yy[i])))
+        fxy = f(np.array([0.3, 1.5, 1.9]), yy)
+        self.assertTrue(np.allclose(fxy[1], f(1.5, 1.0)))
         
+    def test_pipeline(self):
+        self.assertEqual(list(util.prefetch(lambda x: x**2, range(10))),
+                         [x**2 for x in range(10)])
+        results = util.prefetch(lambda x: 1.0/x, [2, 1, 0, 4])
+        self.assertEqual(results.next(), 0.5)
+        self.assertEqual(results.next(), 1.0)
+        with self.assertRaises(ZeroDivisionError):
+            results.next()
+
+        #- close() stops the background thread
+        nthread = threading.active_count()
+        results = util.prefetch(lambda x: x, range(10), maxsize=1)
+        self.assertEqual(results.next(), 0)
+        results.close()
+        self.assertEqual(threading.active_count(), nthread)
+        self.assertEqual(list(results), [])
+
+        #- The background stage overlaps with the consumer
+        def slow(x):
+            time.sleep(0.05)
+            return x
+        t0 = time.time()
+        for x in util.prefetch(slow, range(10)):
+            time.sleep(0.05)
+        self.assertLess(time.time() - t0, 0.8)
+
+        out = list()
+        drain = util.Drain(lambda x, y: out.append(x+y), maxsize=1)
+        for i in range(5):
+            drain.put(i, 1)
+        drain.close()
+        self.assertEqual(out, range(1, 6))
+        drain = util.Drain(lambda x: 1.0/x)
+        drain.put(0)
+        with self.assertRaises(ZeroDivisionError):
+            drain.close()
+
+    def test_limit_blas_threads(self):
+        #- numpy and BLAS are already loaded in a forked worker
+        pool = MP.Pool(1)
+        try:
+            nthreads = pool.apply(_openblas_threads, (2,))
+        finally:
+            pool.close()
+            pool.join()
+        if nthreads is None:
+            self.skipTest('OpenBLAS not loaded')
+        self.assertEqual(nthreads, 2)
+
     # def test_rebin(self):
     #     x = np.arange(25)
     #     y = np.random.uniform(0.0, 5.0, size=len(x))
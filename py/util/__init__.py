@@ -1,5 +1,10 @@
 
+#- input_hash first: util imports specter.extract, which needs it
+from hashing import input_hash
+
 #- This polutes the namespace with other things like N, spdiags, ...
 from util import *
 from traceset import TraceSet
 from cachedict import CacheDict
+from sharedmem import shared_array, is_shared, as_shared, limit_blas_threads
+from pipeline import prefetch, Drain
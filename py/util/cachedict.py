@@ -7,6 +7,10 @@ class CacheDict(dict):
         self._keys = [None,]*n
         self._current = -1
         self._n = n
+
+        #- Hit and miss counters, to be incremented by users of the cache
+        self.nhit = 0
+        self.nmiss = 0
         
     def __setitem__(self, key, value):
         if key in self:
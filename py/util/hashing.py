@@ -0,0 +1,24 @@
+"""
+Hashes of inputs, used to key checkpoints, caches, and workspaces
+"""
+
+import hashlib
+import numpy as N
+
+def input_hash(*items):
+    """
+    Return hex digest hash of items, which may be numpy arrays, strings,
+    or filenames (prefixed with 'file:') whose contents should be hashed
+    """
+    h = hashlib.sha1()
+    for x in items:
+        if isinstance(x, N.ndarray):
+            h.update(str(x.dtype) + str(x.shape))
+            h.update(N.ascontiguousarray(x).data)
+        elif isinstance(x, str) and x.startswith('file:'):
+            with open(x[5:], 'rb') as fx:
+                for block in iter(lambda: fx.read(2**20), ''):
+                    h.update(block)
+        else:
+            h.update(repr(x))
+    return h.hexdigest()
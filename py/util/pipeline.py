@@ -0,0 +1,141 @@
+"""
+Overlap the stages of a calculation with background threads
+
+Disk reads with fitsio and most numpy and scipy linear algebra release the
+GIL, so running one stage in a background thread lets it proceed while the
+next stage works on earlier results.  Stages are connected by bounded
+queues so that a fast producer stays only a few items ahead.
+"""
+
+import sys
+import threading
+import Queue
+
+#- Marks the end of the items in a queue
+_done = object()
+
+def _put(queue, item, stop):
+    """
+    Put item on queue, giving up if the stop event is set while waiting
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def prefetch(func, items, maxsize=2):
+    """
+    Return an iterator over func(item) for each of items, in order
+
+    The results are computed by a background thread that starts right away
+    and stays at most maxsize results ahead of the consumer.  An exception
+    raised by func is raised by the iterator in place of that result.  The
+    iterator's close() method stops the thread and waits for it to finish,
+    e.g. before releasing state that func uses.
+    """
+    return _Prefetch(func, items, maxsize)
+
+class _Prefetch(object):
+    """
+    Iterator over results computed ahead by a background thread; see prefetch
+    """
+    def __init__(self, func, items, maxsize):
+        queue = Queue.Queue(maxsize)
+        stop = threading.Event()
+
+        #- The thread doesn't refer to self, so that an iterator that is
+        #- dropped without close() still stops it when garbage collected
+        def produce():
+            for item in items:
+                try:
+                    result = (True, func(item))
+                except Exception:
+                    result = (False, sys.exc_info())
+                if not _put(queue, result, stop) or not result[0]:
+                    return
+            _put(queue, _done, stop)
+
+        self._queue = queue
+        self._stop = stop
+        self._finished = False
+        self._thread = threading.Thread(target=produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._finished:
+            raise StopIteration
+        result = self._queue.get()
+        if result is _done:
+            self.close()
+            raise StopIteration
+        ok, value = result
+        if not ok:
+            self.close()
+            raise value[0], value[1], value[2]
+        return value
+
+    def close(self):
+        """
+        Stop computing results and wait for the background thread to finish
+        """
+        self._finished = True
+        self._stop.set()
+        self._thread.join()
+
+    def __del__(self):
+        self._stop.set()
+
+class Drain(object):
+    """
+    Call a function on queued arguments in a background thread, e.g. to
+    write results while the next ones are computed
+    """
+    def __init__(self, func, maxsize=2):
+        """
+        func : function to call as func(*args) for each put(*args)
+        maxsize : number of calls that can wait before put() blocks
+        """
+        self.func = func
+        self._queue = Queue.Queue(maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            if args is _done:
+                return
+            if self._error is None:
+                try:
+                    self.func(*args)
+                except Exception:
+                    self._error = sys.exc_info()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def put(self, *args):
+        """
+        Queue a call of func(*args); raises any earlier exception from func
+        """
+        self._raise()
+        self._queue.put(args)
+
+    def close(self):
+        """
+        Wait for the queued calls to finish; raises any exception from func
+        """
+        self._queue.put(_done)
+        self._thread.join()
+        self._raise()
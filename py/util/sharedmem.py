@@ -0,0 +1,111 @@
+"""
+numpy arrays in shared memory for use with multiprocessing
+
+Arrays created here must be created before the worker processes are
+forked so that the workers inherit the same underlying memory.  They can
+then be passed to the workers via multiprocessing.Pool initargs without
+being pickled.
+"""
+
+import os
+import ctypes
+import multiprocessing as MP
+import numpy as N
+
+#- Environment variables used by the various BLAS/LAPACK implementations
+_blas_thread_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                     'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+#- Runtime thread setting functions of already loaded libraries, by a
+#- substring of the library filename; each takes the number of threads
+_blas_thread_setters = (
+    ('openblas', ('openblas_set_num_threads', 'openblas_set_num_threads64_',
+                  'scipy_openblas_set_num_threads64_')),
+    ('mkl_rt', ('MKL_Set_Num_Threads',)),
+    ('gomp', ('omp_set_num_threads',)),
+    ('iomp', ('omp_set_num_threads',)),
+    ('libomp', ('omp_set_num_threads',)),
+    )
+
+def shared_array(shape, dtype=N.float64):
+    """
+    Return zero-initialized ndarray of shape and dtype backed by shared memory
+    """
+    dtype = N.dtype(dtype)
+    n = int(N.prod(shape))
+    buf = MP.RawArray(ctypes.c_char, max(1, n*dtype.itemsize))
+    return N.frombuffer(buf, dtype=dtype, count=n).reshape(shape)
+
+def is_shared(array):
+    """
+    Return True if array is backed by shared memory from shared_array()
+    """
+    base = array
+    while isinstance(base, N.ndarray):
+        base = base.base
+    return isinstance(base, ctypes.Array)
+
+def as_shared(array):
+    """
+    Return a copy of array in shared memory, or array itself if it
+    is already in shared memory
+    """
+    if is_shared(array):
+        return array
+    x = shared_array(array.shape, array.dtype)
+    x[...] = array
+    return x
+
+def _loaded_libraries():
+    """
+    Return list of shared library paths loaded by this process
+
+    Uses /proc/self/maps, so this is empty except on Linux
+    """
+    libs = list()
+    try:
+        with open('/proc/self/maps') as fx:
+            for line in fx:
+                fields = line.split(None, 5)
+                if len(fields) == 6:
+                    path = fields[5].strip()
+                    if '.so' in os.path.basename(path) and path not in libs:
+                        libs.append(path)
+    except IOError:
+        pass
+    return libs
+
+def limit_blas_threads(nthreads=1):
+    """
+    Limit BLAS/OpenMP libraries to nthreads threads
+
+    Sets the BLAS/OpenMP thread environment variables, which are read when
+    a library is first loaded, and calls the thread setting functions of
+    the OpenBLAS, MKL, and OpenMP libraries that are already loaded, e.g.
+    by numpy in a forked worker process.  Loaded libraries are only found
+    on Linux; elsewhere this must be called before numpy is imported.
+
+    Returns the number of loaded libraries that were limited
+    """
+    for key in _blas_thread_vars:
+        os.environ[key] = str(nthreads)
+
+    nlimited = 0
+    for path in _loaded_libraries():
+        name = os.path.basename(path)
+        for libname, funcnames in _blas_thread_setters:
+            if libname not in name:
+                continue
+            try:
+                lib = ctypes.CDLL(path)
+            except OSError:
+                break
+            for funcname in funcnames:
+                func = getattr(lib, funcname, None)
+                if func is not None:
+                    func(ctypes.c_int(nthreads))
+                    nlimited += 1
+                    break
+            break
+
+    return nlimited
@@ -58,6 +58,12 @@ class LinearInterp2D(object):
         dx = (x - self.x[ix-1]) / (self.x[ix] - self.x[ix-1])
         dy = (y - self.y[iy-1]) / (self.y[iy] - self.y[iy-1])
 
+        #- For arrays of x and/or y, broadcast the distances over the
+        #- interpolated dimensions of data
+        extra = (1,) * (self.data.ndim - 2)
+        dx = N.reshape(dx, N.shape(dx) + extra)
+        dy = N.reshape(dy, N.shape(dy) + extra)
+
         #- Interpolate, allowing x and/or y to be multi-dimensional
         #- NOTE: these are the slow steps, about equal time each
         
@@ -67,8 +73,15 @@ class LinearInterp2D(object):
         # dataxy = (data1.T*(1-dy) + data2.T*dy).T
 
         #- Updated without transposes
-        data1 = (self.data[ix-1,iy-1]*(1-dx) + self.data[ix,iy-1]*dx)
-        data2 = (self.data[ix-1,iy]*(1-dx) + self.data[ix,iy]*dx)
+        if N.ndim(x) == 0:
+            #- Single x: interpolate the small grid in x before picking
+            #- out the y values instead of for every y
+            datax = self.data[ix-1]*(1-dx) + self.data[ix]*dx
+            data1 = datax[iy-1]
+            data2 = datax[iy]
+        else:
+            data1 = (self.data[ix-1,iy-1]*(1-dx) + self.data[ix,iy-1]*dx)
+            data2 = (self.data[ix-1,iy]*(1-dx) + self.data[ix,iy]*dx)
         dataxy = (data1*(1-dy) + data2*dy)
 
         return dataxy
@@ -207,6 +220,45 @@ def sincshift(image, dx, dy, sincrad=10, dampfac=3.25):
 
     return image
 
+def _convolve_rows(a, kernels):
+    """
+    Convolve each row a[n, m] with kernels[n, k] (k odd), keeping the
+    central m elements like convolve(a[i], kernels[i], mode='same')
+    """
+    n, m = a.shape
+    k = kernels.shape[1]
+    pad = N.zeros((n, m + k - 1))
+    pad[:, k//2:k//2+m] = a
+    s0, s1 = pad.strides
+    windows = N.lib.stride_tricks.as_strided(pad, (n, m, k), (s0, s1, s1))
+    return N.einsum('nmk,nk->nm', windows, kernels[:, ::-1])
+
+def sincshift_many(images, dx, dy, sincrad=10, dampfac=3.25):
+    """
+    Return images[n, ny, nx] with image i shifted by dx[i], dy[i];
+    equivalent to calling sincshift() on each image but vectorized
+    """
+    s = N.arange(-sincrad, sincrad+1.0)
+    n, ny, nx = images.shape
+    dx = N.asarray(dx, dtype=float)
+    dy = N.asarray(dy, dtype=float)
+
+    #- Kernels for each shift; no shift is a delta function
+    kernels = list()
+    for d in (dx, dy):
+        xx = (s[None, :] - d[:, None]) * N.pi
+        shift = (N.abs(d) > 1e-6)[:, None]
+        xx = N.where(shift, xx, 1.0)
+        k = N.exp( -(xx/(dampfac*N.pi))**2 ) * N.sin(xx) / xx
+        kernels.append(N.where(shift, k, (s == 0)[None, :]))
+    sincx, sincy = kernels
+
+    #- Like sincshift(), convolve the raveled rows then raveled columns
+    images = _convolve_rows(images.reshape(n, ny*nx), sincx)
+    images = images.reshape(n, ny, nx).transpose(0, 2, 1).reshape(n, nx*ny)
+    images = _convolve_rows(images, sincy)
+    return images.reshape(n, nx, ny).transpose(0, 2, 1)
+
 def sincshift2d(image, dx, dy, sincrad=10, dampfac=3.25):
     """
     Return image shifted by dx, dy using full 2D sinc interpolation